@@ -2,11 +2,15 @@ import sys
 import imaplib
 import modules.python_require_min_pyversion  # checks for py >= 3.4, which we need for newer IMAP TLS support
 import modules.match_emails as match_emails
+from modules.daemon_mode import run_daemon_mode
 from modules.settings.get_config import get_config
 from modules.settings.default_counters_and_timers import create_default_timers, create_default_rule_counters
 from modules.settings.get_config import get_config
+from modules.settings.compile_rules import compile_rules
 from modules.email.IMAPServerConnection import IMAPServerConnection
+from modules.models.FolderCheckpoints import FolderCheckpoints
 from modules.email.smtp_send_completion_email import smtp_send_completion_email
+from modules.email.smtp_send import close_smtp_sessions, start_outbound_mail_queue, stop_outbound_mail_queue
 from modules.logging import LogMaster, add_log_files_from_config
 from modules.supportingfunctions import die_with_errormsg
 from modules.ui.display_headers import get_header_preconfig, get_header_postconfig
@@ -24,6 +28,7 @@ def main():
 
     # Get the configs
     (config, rules_mainfolder, rules_allfolders) = get_config()
+    compile_rules(rules_mainfolder, rules_allfolders)
 
     print(get_header_postconfig(config))
     rule_counters_mainfolder.new_counter(counter_name='rules_in_set', start_val=len(rules_mainfolder))
@@ -38,6 +43,12 @@ def main():
     # Set up Logging
     add_log_files_from_config(config)
     debug_rules_and_config(config, rules_mainfolder, rules_allfolders)
+    start_outbound_mail_queue(config)
+
+    # Load Checkpoints from previous runs, if incremental runs are configured
+    checkpoints = None
+    if config['incremental_checkpoint_file'] is not None:
+        checkpoints = FolderCheckpoints(config['incremental_checkpoint_file'])
 
     # Connect to IMAP
     imap_connection = IMAPServerConnection()
@@ -49,17 +60,25 @@ def main():
         global_timers.stop('overall')
         die_with_errormsg('IMAP Server Connection failed before we did anything, so we are now exiting.')
 
+    # Daemon Mode carries on from the highest UID known when the first pass over the main folder started
+    daemon_last_uid = imap_connection.get_currfolder_highest_uid()
+
     # Now we try to perform IMAP actions
     try:
         # Parse IMAP Emails
         global_timers.start('mainfolder')
-        match_emails.iterate_rules_over_mainfolder(imap_connection, config, rules_mainfolder, rule_counters_mainfolder)
+        mainfolder_checked_for_allfolders = match_emails.iterate_rules_over_mainfolder(imap_connection, config,
+            rules_mainfolder, rule_counters_mainfolder, checkpoints, rules_allfolders, rule_counters_allfolders)
         global_timers.stop('mainfolder')
 
         global_timers.start('allfolders')
-        match_emails.iterate_rules_over_allfolders(imap_connection, config, rules_allfolders, rule_counters_allfolders)
+        match_emails.iterate_rules_over_allfolders(imap_connection, config, rules_allfolders, rule_counters_allfolders, checkpoints,
+            skip_initial_folder=mainfolder_checked_for_allfolders)
         global_timers.stop('allfolders')
 
+        if config['daemon_mode']:
+            run_daemon_mode(imap_connection, config, rules_mainfolder, rule_counters_mainfolder, daemon_last_uid, checkpoints)
+
         imap_connection.disconnect()
     except KeyboardInterrupt as KI:
         # Someone ressed Ctrl-C, so close & cleanup
@@ -80,13 +99,20 @@ def main():
         LogMaster.exception('Error was: ')
         imap_connection.disconnect()
 
+    # Send the forward digests and the forwards still queued, so they are counted in the footers
+    match_emails.send_forward_digests(config, rules_mainfolder, rule_counters_mainfolder)
+    match_emails.send_forward_digests(config, rules_allfolders, rule_counters_allfolders)
+    stop_outbound_mail_queue()
+
     global_timers.stop('overall')
     # Print the Footers
     final_output = get_completion_footer(config, global_timers, rule_counters_mainfolder, rule_counters_allfolders)
     LogMaster.critical(final_output)
+    LogMaster.stop_background_logging()  # All log output (including the footer) is written before the completion email
 
     # Send Completion Email
     smtp_send_completion_email(config, final_output)
+    close_smtp_sessions()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import time
+import imaplib
+from modules.logging import LogMaster
+from modules.match_emails import iterate_rules_over_emails, get_search_criteria_for_rules, get_uid_range_search_criteria
+from modules.match_emails import get_headers_only_fetch_mode, get_partial_body_fetch_mode, get_emails_for_rules
+from modules.match_emails import send_forward_digests
+
+# Daemon mode keeps the IMAP connection open after the first full pass, waiting (IMAP IDLE, or NOOP polling)
+# on the main folder and checking the main folder rules against each newly-arrived email as it appears.
+
+
+def run_daemon_mode(imap_connection, config, rules, counters, last_uid, checkpoints=None):
+    """Runs until interrupted (Ctrl-C), checking new emails in the main folder against the main folder rules.
+
+    last_uid is the highest UID already checked; only emails with higher UIDs are checked."""
+    if (not config['assess_rules_againt_mainfolder']):
+        LogMaster.info('Daemon Mode Not Started: Main Folder rules processing has been disabled in the program config files.')
+        return None
+
+    folder_name = config['imap_initial_folder']
+    headers_only = get_headers_only_fetch_mode(config, 'main_folder')
+    partial_body = get_partial_body_fetch_mode(config, 'main_folder')
+    search_criteria = get_search_criteria_for_rules(config, rules)
+    uidvalidity = None
+    if last_uid is None:
+        last_uid = 0
+
+    LogMaster.log(40, 'Now commencing Daemon Mode: waiting for new emails in folder \"%s\" (IMAP IDLE supported?: %s)',
+        folder_name, imap_connection.idle_is_supported)
+
+    check_now = True  # Always check straight away, in case emails arrived since the first pass (or while disconnected)
+    while True:
+        try:
+            if not imap_connection.is_connected():
+                if not reconnect_to_folder(imap_connection, folder_name):
+                    time.sleep(config['daemon_reconnect_delay_secs'])
+                    continue
+                check_now = True
+
+            if uidvalidity != imap_connection.get_currfolder_uidvalidity():
+                if uidvalidity is not None:
+                    LogMaster.info('UIDVALIDITY of folder \"%s\" has changed, so only emails arriving from now will be checked.',
+                        folder_name)
+                    last_uid = imap_connection.get_currfolder_highest_uid() or 0
+                uidvalidity = imap_connection.get_currfolder_uidvalidity()
+
+            if not check_now:
+                if not imap_connection.wait_for_new_emails(config['daemon_idle_timeout_secs'], config['daemon_poll_interval_secs']):
+                    continue
+            check_now = False
+
+            last_uid = check_new_emails_in_currfolder(imap_connection, config, rules, counters, headers_only, partial_body,
+                search_criteria, last_uid)
+            send_forward_digests(config, rules, counters)  # Don't hold new emails back until the daemon stops
+
+            if (checkpoints is not None) and (uidvalidity is not None):
+                checkpoints.set_last_uid(rules.name, folder_name, uidvalidity, last_uid)
+                checkpoints.save()
+
+        except (imaplib.IMAP4.error, OSError) as socket_err:
+            # IMAP4.abort (connection lost) is an IMAP4.error; other IMAP4.errors are eg a failed reconnect or SELECT
+            LogMaster.error('IMAP Server connection lost during Daemon Mode; will reconnect. Error was: %s', repr(socket_err))
+            imap_connection.disconnect()
+            time.sleep(config['daemon_reconnect_delay_secs'])
+
+
+def check_new_emails_in_currfolder(imap_connection, config, rules, counters, headers_only, partial_body, search_criteria, last_uid):
+    """Checks all emails with UIDs above last_uid against the rules. Returns the new highest checked UID."""
+    # NB: "UID n:*" always includes the highest UID in the folder, even if it is less than n
+    new_uids = [uid for uid in imap_connection.get_list_uids_in_currfolder(get_uid_range_search_criteria(last_uid + 1))
+        if int(uid) > last_uid]
+    if len(new_uids) == 0:
+        return last_uid
+
+    highest_new_uid = max(int(uid) for uid in new_uids)
+    LogMaster.info('%s new email(s) found in folder \"%s\".', len(new_uids), imap_connection.get_currfolder())
+    if search_criteria is not None:
+        # Filtered again, in case the server's results stray outside the range (eg "UID n:m" never excludes the highest UID)
+        new_uids = [uid for uid in imap_connection.get_list_uids_in_currfolder(
+            get_uid_range_search_criteria(last_uid + 1, highest_new_uid, search_criteria))
+            if last_uid < int(uid) <= highest_new_uid]
+
+    iterate_rules_over_emails(imap_connection, config, rules, counters,
+        get_emails_for_rules(imap_connection, config, [rules], counters, new_uids, headers_only, partial_body))
+    imap_connection.flush_queued_actions()
+    return highest_new_uid
+
+
+def reconnect_to_folder(imap_connection, folder_name):
+    LogMaster.info('Daemon Mode: now reconnecting to IMAP Server.')
+    if not imap_connection.connect_to_server():
+        return False
+    if imap_connection.connect_to_folder(folder_name) == -1:
+        imap_connection.disconnect()
+        return False
+    return True
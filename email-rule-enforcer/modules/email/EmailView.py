@@ -0,0 +1,90 @@
+import email
+import email.errors
+import email.message
+import email.parser
+from modules.logging import LogMaster
+from modules.email.supportingfunctions_email import get_email_body, get_email_datetime, get_email_uniqueid, convert_internaldate_to_datetime
+from modules.email.supportingfunctions_email import get_email_addrfield_from, get_email_addrfield_to, get_email_addrfield_cc
+
+
+class lazy_email_field():
+    """Works out a field of an email the first time it is read, then keeps it as a plain attribute of that email.
+
+    Assigning to the field (eg the body text from a partial fetch) simply replaces it, and deleting it means it will be
+    worked out again the next time it is read."""
+    def __init__(self, get_field_value):
+        self.get_field_value = get_field_value
+        self.field_name = get_field_value.__name__
+        self.__doc__ = get_field_value.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.get_field_value(instance)
+        instance.__dict__[self.field_name] = value
+        return value
+
+
+class EmailView(email.message.Message):
+    """An email fetched from the IMAP server, as seen by the rules.
+
+    Only the headers are parsed up front. The body text, addresses, dates and unique id are each worked out the
+    first time they are used, so (eg) a rule set that only checks flags and sizes never decodes bodies, parses address
+    lists or hashes whole emails. Headers are read in the usual way (email_view['Subject'])."""
+    original_raw_email = None
+    server_date = None
+    headers_only = False
+
+    @classmethod
+    def parse(cls, raw_email_bytes):
+        return email.parser.BytesParser(_class=cls).parsebytes(raw_email_bytes, headersonly=True)
+
+    def is_field_worked_out(self, field_name):
+        return field_name in self.__dict__
+
+    def get_full_raw_email(self, imap_connection):
+        """The raw bytes of the whole email. If only its headers (or part of its body) were fetched, the whole email is
+        fetched the first time this is called, and kept for any later calls (eg several Forward actions).
+        Returns None if it couldn't be fetched."""
+        if not self.headers_only:
+            return self.original_raw_email
+        if 'full_raw_email' not in self.__dict__:
+            raw_email = imap_connection.get_raw_email_byuid(self.uid)
+            self.full_raw_email = None if raw_email is None else raw_email.raw_email_bytes
+        return self.full_raw_email
+
+    @lazy_email_field
+    def body(self):
+        if self.original_raw_email is None:
+            return ''
+        try:
+            full_email = email.message_from_bytes(self.original_raw_email)
+        except email.errors.MessageError as parse_error:
+            LogMaster.error('Error parsing the body of email UID %s, so it will be treated as empty. Email Error was: %s',
+                self.__dict__.get('uid_str'), parse_error)
+            return ''
+        return get_email_body(full_email)
+
+    @lazy_email_field
+    def date_datetime(self):
+        return get_email_datetime(self)
+
+    @lazy_email_field
+    def internaldate_datetime(self):
+        return convert_internaldate_to_datetime(self.server_date)
+
+    @lazy_email_field
+    def addr_from(self):
+        return get_email_addrfield_from(self)
+
+    @lazy_email_field
+    def addr_to(self):
+        return get_email_addrfield_to(self)
+
+    @lazy_email_field
+    def addr_cc(self):
+        return get_email_addrfield_cc(self)
+
+    @lazy_email_field
+    def unique_id(self):
+        return get_email_uniqueid(self, self.original_raw_email)
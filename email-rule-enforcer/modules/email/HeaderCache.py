@@ -0,0 +1,131 @@
+import sqlite3
+import threading
+import time
+from modules.logging import LogMaster
+
+
+class HeaderCache():
+    """Local (SQLite) store of the raw headers, size and INTERNALDATE of emails already fetched, so that they don't
+    need to be downloaded again by later runs: for cached emails, only their flags are fetched.
+
+    An email's headers, size and INTERNALDATE never change while it keeps its UID, so entries are keyed by account
+    (username, server and port, as one cache file may be used for several), folder, UID and the header fetch (all
+    headers, or a list of fields). Each folder's UIDVALIDITY is recorded too: if it changes, the UIDs may now be
+    different emails, so all the folder's entries are dropped.
+
+    Once the headers stored add up to more than max_bytes, the least recently used entries are removed.
+    The cache is shared by all the IMAP connections (which may be in different threads), so it is used under a lock."""
+    eviction_target = 0.9  # Fraction of max_bytes to evict down to, so eviction isn't needed again straight away
+    max_uids_per_query = 900  # Older SQLite versions allow at most 999 parameters per statement
+    schema_version = 2  # Version 1 had no account column
+
+    def __init__(self, filepath, max_bytes=104857600):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filepath, check_same_thread=False)
+        with self.db:
+            if self.db.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+                self.db.execute('DROP TABLE IF EXISTS folders')
+                self.db.execute('DROP TABLE IF EXISTS headers')
+                self.db.execute('PRAGMA user_version = %d' % self.schema_version)
+            self.db.execute('CREATE TABLE IF NOT EXISTS folders (account TEXT, folder TEXT, uidvalidity INTEGER, '
+                'PRIMARY KEY (account, folder))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS headers (account TEXT, folder TEXT, uid INTEGER, header_spec TEXT, '
+                'raw_headers BLOB, size INTEGER, server_date REAL, last_used REAL, PRIMARY KEY (account, folder, uid, header_spec))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS headers_last_used ON headers (last_used)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(LENGTH(raw_headers)), 0) FROM headers').fetchone()[0]
+        self.checked_folders = dict()  # (account, folder) -> uidvalidity already checked against the cache this run
+
+    def check_uidvalidity(self, account, folder, uidvalidity):
+        """Drops the folder's entries if its UIDVALIDITY isn't what it was when they were cached. Call under the lock."""
+        if self.checked_folders.get((account, folder)) == uidvalidity:
+            return
+        row = self.db.execute('SELECT uidvalidity FROM folders WHERE account = ? AND folder = ?', (account, folder)).fetchone()
+        if (row is None) or (row[0] != uidvalidity):
+            with self.db:
+                if row is not None:
+                    LogMaster.info('UIDVALIDITY of folder "%s" has changed (was %s, now %s), so its cached headers have been dropped.',
+                        folder, row[0], uidvalidity)
+                    self.total_bytes -= self.db.execute('SELECT COALESCE(SUM(LENGTH(raw_headers)), 0) FROM headers '
+                        'WHERE account = ? AND folder = ?', (account, folder)).fetchone()[0]
+                    self.db.execute('DELETE FROM headers WHERE account = ? AND folder = ?', (account, folder))
+                self.db.execute('INSERT OR REPLACE INTO folders (account, folder, uidvalidity) VALUES (?, ?, ?)',
+                    (account, folder, uidvalidity))
+        self.checked_folders[(account, folder)] = uidvalidity
+
+    def get_entries(self, account, folder, uidvalidity, header_spec, uid_list):
+        """Returns a dict of uid_str: (raw_headers, size, server_date) for the uids that are cached"""
+        entries = dict()
+        with self.lock:
+            self.check_uidvalidity(account, folder, uidvalidity)
+            uids = [int(uid) for uid in uid_list]
+            for index in range(0, len(uids), self.max_uids_per_query):
+                uid_batch = uids[index:index + self.max_uids_per_query]
+                rows = self.db.execute('SELECT uid, raw_headers, size, server_date FROM headers WHERE account = ? AND folder = ? '
+                    'AND header_spec = ? AND uid IN (%s)' % ', '.join('?' * len(uid_batch)), [account, folder, header_spec] + uid_batch)
+                for (uid, raw_headers, size, server_date) in rows:
+                    entries[str(uid)] = (bytes(raw_headers), size, None if server_date is None else time.localtime(server_date))
+            if len(entries) > 0:
+                now = time.time()
+                with self.db:
+                    self.db.executemany('UPDATE headers SET last_used = ? WHERE account = ? AND folder = ? AND uid = ? AND header_spec = ?',
+                        ((now, account, folder, int(uid_str), header_spec) for uid_str in entries))
+        return entries
+
+    def add_entries(self, account, folder, uidvalidity, header_spec, raw_emails):
+        """Caches the headers from a dict of uid_str: RawEmailResponse"""
+        rows = [(account, folder, int(uid_str), header_spec, raw_email.raw_email_bytes, raw_email.size,
+            None if raw_email.server_date is None else time.mktime(raw_email.server_date), time.time())
+            for (uid_str, raw_email) in raw_emails.items()
+            if (uid_str is not None) and (raw_email.raw_email_bytes is not None)]
+        if len(rows) == 0:
+            return
+        with self.lock:
+            self.check_uidvalidity(account, folder, uidvalidity)
+            with self.db:
+                for row in rows:
+                    # An entry being replaced (eg fetched by another connection meanwhile) no longer counts
+                    old_row = self.db.execute('SELECT LENGTH(raw_headers) FROM headers WHERE account = ? AND folder = ? AND uid = ? '
+                        'AND header_spec = ?', row[0:4]).fetchone()
+                    if old_row is not None:
+                        self.total_bytes -= old_row[0]
+                    self.db.execute('INSERT OR REPLACE INTO headers (account, folder, uid, header_spec, raw_headers, size, server_date, '
+                        'last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+                    self.total_bytes += len(row[4])
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is back under its target size. Call under the lock."""
+        target_bytes = self.max_bytes * self.eviction_target
+        evicted = 0
+        with self.db:
+            cursor = self.db.execute('SELECT account, folder, uid, header_spec, LENGTH(raw_headers) FROM headers ORDER BY last_used')
+            keys_to_evict = []
+            for (account, folder, uid, header_spec, length) in cursor:
+                if self.total_bytes <= target_bytes:
+                    break
+                keys_to_evict.append((account, folder, uid, header_spec))
+                self.total_bytes -= length
+                evicted += 1
+            self.db.executemany('DELETE FROM headers WHERE account = ? AND folder = ? AND uid = ? AND header_spec = ?', keys_to_evict)
+        LogMaster.debug('Header cache was over %s bytes, so the %s least recently used entries have been removed.',
+            self.max_bytes, evicted)
+
+
+header_caches = dict()
+header_caches_lock = threading.Lock()
+
+
+def get_header_cache(filepath, max_bytes):
+    """Returns the HeaderCache for the file (shared by every IMAP connection), or None if it can't be opened"""
+    with header_caches_lock:
+        if filepath not in header_caches:
+            try:
+                header_caches[filepath] = HeaderCache(filepath, max_bytes)
+            except sqlite3.Error as cache_error:
+                LogMaster.log(30, 'Failed to open header cache file %s, so all headers will be fetched from the IMAP Server. '
+                    'Error was: %s', filepath, cache_error)
+                header_caches[filepath] = None
+        return header_caches[filepath]
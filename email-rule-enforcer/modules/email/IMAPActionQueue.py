@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from modules.logging import LogMaster
+from modules.email.supportingfunctions_email import convert_uids_to_sequence_set, split_list_into_batches
+
+# The most UIDs sent in one command; runs of UIDs are sent as ranges, so this is rarely reached
+max_uids_per_command = 500
+
+
+class IMAPActionQueue():
+    """Collects the actions taken on emails in the current IMAP folder, so they can be sent as a few UID-set commands.
+
+    Flag changes are grouped into one UID STORE per flag, moves into one UID MOVE (or UID COPY, then STORE \\Deleted)
+    per destination folder, and permanent deletions into one UID EXPUNGE. Nothing is sent until flush(), which must
+    be called before leaving the folder. If batching is disabled, each action is sent as soon as it is queued."""
+    def __init__(self, imap_connection, batch_actions=True):
+        self.imap_connection = imap_connection
+        self.batch_actions = batch_actions
+        self.clear()
+
+    def clear(self):
+        """Forgets all queued actions, and which emails have been moved or deleted (eg on leaving the folder)"""
+        self._clear_queued_actions()
+        self.removed_uids = set()
+
+    def _clear_queued_actions(self):
+        self.flag_changes = OrderedDict()  # (operation, flag) -> set of uids
+        self.moves = OrderedDict()  # dest_folder -> list of uids
+        self.marked_read_for_move = dict()  # dest_folder -> set of uids, to be marked unread again if the move fails
+        self.expunge_uids = set()
+
+    def has_queued_actions(self):
+        return (any(len(uids) > 0 for uids in self.flag_changes.values()) or (len(self.moves) > 0) or
+                (len(self.expunge_uids) > 0))
+
+    def is_removed(self, uid):
+        """True if the email has been moved or deleted (or queued to be) since the folder was selected"""
+        return int(uid) in self.removed_uids
+
+    def add_flag(self, uid, flag):
+        self._queue_flag_change('+FLAGS', '-FLAGS', uid, flag)
+        self._flush_unless_batching()
+
+    def remove_flag(self, uid, flag):
+        self._queue_flag_change('-FLAGS', '+FLAGS', uid, flag)
+        self._flush_unless_batching()
+
+    def _queue_flag_change(self, operation, opposite_operation, uid, flag):
+        # The latest change to a flag wins, as it would if each change were sent straight away
+        uid = int(uid)
+        self.flag_changes.get((opposite_operation, flag), set()).discard(uid)
+        self.flag_changes.setdefault((operation, flag), set()).add(uid)
+
+    def move(self, uid, dest_folder, mark_as_read_on_move=False, is_read=None):
+        uid = int(uid)
+        if uid in self.removed_uids:
+            LogMaster.debug('Email UID %s is already being moved or deleted, so will not also be moved to folder %s', uid, dest_folder)
+            return
+        if (mark_as_read_on_move is True) and (is_read is not True):
+            self._queue_flag_change('+FLAGS', '-FLAGS', uid, '\\Seen')
+            self.marked_read_for_move.setdefault(dest_folder, set()).add(uid)
+        self.moves.setdefault(dest_folder, []).append(uid)
+        self.removed_uids.add(uid)
+        self._flush_unless_batching()
+
+    def delete_permanently(self, uid):
+        uid = int(uid)
+        if uid in self.removed_uids:
+            LogMaster.debug('Email UID %s is already being moved or deleted, so will not also be deleted', uid)
+            return
+        self._queue_flag_change('+FLAGS', '-FLAGS', uid, '\\Deleted')
+        self.expunge_uids.add(uid)
+        self.removed_uids.add(uid)
+        self._flush_unless_batching()
+
+    def apply_queued_flags(self, email_to_update):
+        """Updates an email's flags with the flag changes queued for it, as if they had been sent already"""
+        uid = int(email_to_update.uid)
+        imap_flags = list(email_to_update.imap_flags)
+        for (operation, flag), uids in self.flag_changes.items():
+            if uid not in uids:
+                continue
+            if (operation == '+FLAGS') and (flag not in imap_flags):
+                imap_flags.append(flag)
+            elif (operation == '-FLAGS') and (flag in imap_flags):
+                imap_flags.remove(flag)
+        email_to_update.imap_flags = imap_flags
+        email_to_update.is_read = self.imap_connection.is_email_currently_read_fromflags(imap_flags)
+
+    def _flush_unless_batching(self):
+        if not self.batch_actions:
+            self.flush()
+
+    def flush(self):
+        """Sends all queued actions to the IMAP server: flag changes first, then moves, then the expunge"""
+        if not self.has_queued_actions():
+            return
+        (flag_changes, moves, marked_read_for_move, expunge_uids) = (
+            self.flag_changes, self.moves, self.marked_read_for_move, self.expunge_uids)
+        self._clear_queued_actions()  # So that a failure part way through never sends the same actions twice
+
+        for (operation, flag), uids in flag_changes.items():
+            self._send_uid_set_command(uids, 'STORE', operation, '(%s)' % flag)
+
+        for dest_folder, uids in moves.items():
+            if self._move_emails(uids, dest_folder, expunge_uids):
+                LogMaster.log(20, 'Successfully moved %s email(s) to new folder. UIDs: %s, Dest Folder: %s',
+                    len(uids), convert_uids_to_sequence_set(uids), dest_folder)
+            else:
+                LogMaster.log(30, 'Failed to move email(s) (UIDs: %s) to folder %s', convert_uids_to_sequence_set(uids), dest_folder)
+                if len(marked_read_for_move.get(dest_folder, [])) > 0:
+                    # We need to unwind the Read status of any email that we may have marked as read
+                    LogMaster.log(30, 'We marked these emails as READ earlier, now unmarking (UIDs: %s)',
+                        convert_uids_to_sequence_set(marked_read_for_move[dest_folder]))
+                    self._send_uid_set_command(marked_read_for_move[dest_folder], 'STORE', '-FLAGS', '(\\Seen)')
+
+        if len(expunge_uids) > 0:
+            self.imap_connection.expunge_byuids(expunge_uids)
+            LogMaster.log(20, 'Expunged email(s) from folder. UIDs: %s', convert_uids_to_sequence_set(expunge_uids))
+
+    def _move_emails(self, uids, dest_folder, expunge_uids):
+        """Moves the emails with UID MOVE, or with UID COPY then STORE \\Deleted (the originals are then expunged)"""
+        all_moved = True
+        for uid_batch in split_list_into_batches(sorted(uids), max_uids_per_command):
+            uid_set = convert_uids_to_sequence_set(uid_batch)
+            if self.imap_connection.imapmove_is_supported:
+                result, data = self.imap_connection.uid_safe('MOVE', uid_set, dest_folder)
+            else:
+                result, data = self.imap_connection.uid_safe('COPY', uid_set, dest_folder)
+                if result == 'OK':
+                    self.imap_connection.set_flag_byuid(uid_set, '(\\Deleted)')
+                    expunge_uids.update(uid_batch)
+            if result != 'OK':
+                all_moved = False
+        return all_moved
+
+    def _send_uid_set_command(self, uids, command, *args):
+        for uid_batch in split_list_into_batches(sorted(uids), max_uids_per_command):
+            self.imap_connection.uid_safe(command, convert_uids_to_sequence_set(uid_batch), *args)
+
+    def __repr__(self):
+        return '%s:(flag changes: %s, moves: %s, expunge: %s)' % (
+            self.__class__.__name__, dict(self.flag_changes), dict(self.moves), self.expunge_uids)
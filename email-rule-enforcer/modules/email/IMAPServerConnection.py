@@ -2,12 +2,19 @@ import imaplib
 import socket
 import ssl
 import email
+import re
+import time
+import select
 import traceback
+from collections import OrderedDict
 from modules.logging import LogMaster
 from modules.supportingfunctions import strip_quotes
-from modules.email.supportingfunctions_email import convert_bytes_to_utf8
-from modules.email.supportingfunctions_email import get_email_body, get_email_datetime, get_email_uniqueid
-from modules.email.supportingfunctions_email import get_email_addrfield_from, get_email_addrfield_to, get_email_addrfield_cc
+from modules.email.supportingfunctions_email import convert_bytes_to_utf8, convert_uids_to_sequence_set, split_list_into_batches
+from modules.email.supportingfunctions_email import convert_internaldate_to_datetime
+from modules.email.EmailView import EmailView
+from modules.email.HeaderCache import get_header_cache
+from modules.email.IMAPActionQueue import IMAPActionQueue, max_uids_per_command
+import modules.email.bodystructure as bodystructure
 
 
 class RawEmailResponse():
@@ -31,15 +38,53 @@ class RawEmailResponse():
         return self.__str__()
 
 
+class EmailMetadata():
+    """The IMAP metadata of an email (no headers or body), for checking metadata-only Matches before a full fetch"""
+    def __init__(self, uid, raw_email, imap_folder):
+        self.uid = uid
+        self.uid_str = convert_bytes_to_utf8(uid)
+        self.imap_folder = imap_folder
+        self.size = raw_email.size
+        self.server_date = raw_email.server_date
+        self.internaldate_datetime = convert_internaldate_to_datetime(raw_email.server_date)
+        self.imap_flags = raw_email.flags
+        self.is_read = IMAPServerConnection.is_email_currently_read_fromflags(raw_email.flags)
+
+    def __getitem__(self, header_name):
+        return None  # No headers
+
+    def __repr__(self):
+        return '%s:(UID %s, Size %s, Flags: %s, ServerDate: %s)' % (
+            self.__class__.__name__, self.uid_str, self.size, self.imap_flags, self.internaldate_datetime)
+
+
 class IMAPServerConnection():
+    _fetch_response_start = re.compile(rb'^\d+ \(')
+    _fetch_response_uid = re.compile(rb'[( ]UID (\d+)')
+    _fetch_response_size = re.compile(rb'RFC822\.SIZE (\d+)')
+    _status_response_highestmodseq = re.compile(rb'HIGHESTMODSEQ (\d+)')
+    _idle_response_new_email = re.compile(rb'^\* \d+ (EXISTS|RECENT)')
+    _search_criteria_uid_range = re.compile(r'^UID [0-9*]+(:[0-9*]+)?')
+
     def __init__(self):
         self.imap_connection = None
         self.imapmove_is_supported = False
+        self.uidplus_is_supported = False
+        self.condstore_is_supported = False
+        self.idle_is_supported = False
+        self._idle_read_buffer = b''
         self._is_connected = False
         self.is_auth = False
         self.initial_folder = 'INBOX'
         self.deletions_folder = 'Trash'
         self.currfolder_name = ''
+        self.currfolder_selected_name = ''  # As sent to SELECT (eg quoted)
+        self.currfolder_uidvalidity = None
+        self.currfolder_uidnext = None
+        self.currfolder_highestmodseq = None
+        self.fetch_batch_size = 1
+        self.header_cache = None
+        self.action_queue = IMAPActionQueue(self)
         LogMaster.ultra_debug('New IMAP Server Connection object created')
 
     def set_parameters_from_config(self, config):
@@ -53,6 +98,10 @@ class IMAPServerConnection():
         self.empty_trash_on_exit = config["empty_trash_on_exit"]
         self.initial_folder = config["imap_initial_folder"]
         self.deletions_folder = config["imap_deletions_folder"]
+        self.fetch_batch_size = config["imap_fetch_batch_size"]
+        self.action_queue.batch_actions = config["imap_batch_actions"]
+        if config["imap_header_cache_file"] is not None:
+            self.header_cache = get_header_cache(config["imap_header_cache_file"], config["imap_header_cache_max_mb"] * 1048576)
 
     def connect(self):
         return self.connect_to_server()
@@ -110,17 +159,66 @@ class IMAPServerConnection():
         return self.connect_to_folder(self.initial_folder)
 
     def connect_to_folder(self, folder_name):
+        self.flush_queued_actions()  # Queued actions are by UID, so must be sent before leaving the folder
+        self.action_queue.clear()
+        self.currfolder_uidvalidity = None
+        self.currfolder_uidnext = None
+        self.currfolder_highestmodseq = None
         try:
             result = self.imap_connection.select(folder_name)
             msg_count = convert_bytes_to_utf8(result[1][0])
             self.currfolder_name = strip_quotes(folder_name)
+            self.currfolder_selected_name = folder_name
+            self.currfolder_uidvalidity = self._get_select_response_int('UIDVALIDITY')
+            self.currfolder_uidnext = self._get_select_response_int('UIDNEXT')
+            if self.condstore_is_supported:
+                self.currfolder_highestmodseq = self._get_currfolder_highestmodseq(folder_name)
             LogMaster.log(20, 'Successfully connected to IMAP Folder: \"%s\". Message Count: %s', folder_name, msg_count)
             return msg_count
         except imaplib.IMAP4.error:
             LogMaster.log(20, 'Failed to connect IMAP Folder: \"%s\". Returning -1 as msg_count.', folder_name)
             return -1
 
+    def _get_select_response_int(self, response_code):
+        """Returns an integer response code (eg UIDVALIDITY) sent by the server during the last SELECT, or None"""
+        try:
+            typ, data = self.imap_connection.response(response_code)
+            return int(data[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def _get_currfolder_highestmodseq(self, folder_name):
+        """Returns HIGHESTMODSEQ for the folder just selected, asking via STATUS if SELECT didn't include it"""
+        highestmodseq = self._get_select_response_int('HIGHESTMODSEQ')
+        if highestmodseq is None:
+            highestmodseq = self._get_status_highestmodseq(folder_name)
+        LogMaster.log(10, 'HIGHESTMODSEQ for IMAP Folder \"%s\" is: %s', folder_name, highestmodseq)
+        return highestmodseq
+
+    def _get_status_highestmodseq(self, folder_name):
+        try:
+            result, data = self.imap_connection.status(folder_name, '(HIGHESTMODSEQ)')
+            return int(self._status_response_highestmodseq.search(data[0]).group(1))
+        except (imaplib.IMAP4.error, AttributeError, TypeError, IndexError, ValueError):
+            return None
+
+    def refresh_currfolder_highestmodseq(self):
+        """Asks the server (via STATUS) for the current folder's HIGHESTMODSEQ again, eg once this run's own flag changes
+        and moves have been sent. Returns it, or the one from SELECT if it can't be refreshed."""
+        if self.currfolder_highestmodseq is not None:
+            highestmodseq = self._get_status_highestmodseq(self.currfolder_selected_name)
+            if highestmodseq is not None:
+                LogMaster.log(10, 'HIGHESTMODSEQ for IMAP Folder \"%s\" is now: %s', self.currfolder_name, highestmodseq)
+                self.currfolder_highestmodseq = highestmodseq
+        return self.currfolder_highestmodseq
+
     def disconnect(self):
+        try:
+            if self._is_connected:
+                self.flush_queued_actions()
+        except Exception as e:
+            LogMaster.log(30, 'Failed to send queued email actions before disconnecting. Error was: %s', repr(e))
+        self.action_queue.clear()
         try:
             self.imap_connection.logout()
         except Exception as e:
@@ -142,20 +240,271 @@ class IMAPServerConnection():
             self.imapmove_is_supported = False
         LogMaster.log(10, 'IMAP Command \"MOVE\" support now checked. Server Supports \"MOVE\"?: %s', self.imapmove_is_supported)
 
+        self.uidplus_is_supported = ('UIDPLUS' in self.capabilities())
+        LogMaster.log(10, 'IMAP Extension \"UIDPLUS\" support now checked. Server Supports \"UIDPLUS\"?: %s', self.uidplus_is_supported)
+
+        self.condstore_is_supported = False
+        if ('CONDSTORE' in self.capabilities()) or ('QRESYNC' in self.capabilities()):
+            self.condstore_is_supported = True
+            if 'ENABLE' in self.capabilities():
+                # Enabling CONDSTORE ensures that every SELECT reports the folder's HIGHESTMODSEQ
+                try:
+                    if hasattr(self.imap_connection, 'enable'):
+                        self.imap_connection.enable('CONDSTORE')
+                    else:
+                        # imaplib has no enable() before py3.5, nor does it know the command
+                        imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+                        self.imap_connection._simple_command('ENABLE', 'CONDSTORE')
+                except imaplib.IMAP4.error:
+                    pass
+        LogMaster.log(10, 'IMAP Extension \"CONDSTORE\" support now checked. Server Supports \"CONDSTORE\"?: %s', self.condstore_is_supported)
+
+        self.idle_is_supported = ('IDLE' in self.capabilities())
+        LogMaster.log(10, 'IMAP Command \"IDLE\" support now checked. Server Supports \"IDLE\"?: %s', self.idle_is_supported)
+
+    def wait_for_new_emails(self, idle_timeout, poll_interval):
+        """Blocks until the server reports new email in the current folder, or until a timeout.
+
+        Uses IMAP IDLE if the server supports it, otherwise polls with NOOP.
+        Returns True if new email may have arrived; the caller must still search for new UIDs."""
+        if self.idle_is_supported:
+            return self.idle(idle_timeout)
+        time.sleep(poll_interval)
+        return self.noop_check_for_new_emails()
+
+    def noop_check_for_new_emails(self):
+        self.imap_connection.noop()
+        new_emails = False
+        for response_code in ('EXISTS', 'RECENT'):
+            typ, data = self.imap_connection.response(response_code)
+            if (data is not None) and (data[0] is not None):
+                new_emails = True
+        return new_emails
+
+    def idle(self, timeout):
+        """Sends IMAP IDLE (RFC 2177) and waits up to timeout seconds for the server to report new email.
+
+        imaplib (before py3.14) has no IDLE support, so this sends the command and reads the responses on the
+        connection's socket directly; imaplib's own buffered reader would hide responses from select().
+        Returns True if the server sent EXISTS or RECENT while idling."""
+        conn = self.imap_connection
+        self._idle_read_buffer = b''
+        tag = conn._new_tag()
+        conn.send(tag + b' IDLE\r\n')
+        line = self._idle_read_line(timeout)
+        if (line is None) or (not line.startswith(b'+')):
+            conn.tagged_commands.pop(tag, None)
+            raise imaplib.IMAP4.abort('IMAP Server did not accept IDLE: %s' % line)
+        LogMaster.ultra_debug('IMAP IDLE started on folder \"%s\" for up to %s seconds', self.currfolder_name, timeout)
+
+        new_emails = False
+        stop_time = time.time() + timeout
+        while not new_emails:
+            line = self._idle_read_line(stop_time - time.time())
+            if line is None:
+                break
+            LogMaster.insane_debug('IMAP IDLE response: %s', line)
+            if self._idle_response_new_email.match(line):
+                new_emails = True
+
+        conn.send(b'DONE\r\n')
+        while True:
+            # Discard any remaining untagged responses up to the end of the IDLE command
+            line = self._idle_read_line(timeout)
+            if line is None:
+                raise imaplib.IMAP4.abort('IMAP Server did not end IDLE')
+            if line.startswith(tag + b' '):
+                break
+        conn.tagged_commands.pop(tag, None)
+
+        LogMaster.ultra_debug('IMAP IDLE ended on folder \"%s\". New email reported?: %s', self.currfolder_name, new_emails)
+        return new_emails
+
+    def _idle_read_line(self, timeout):
+        """Returns the next response line (without CRLF), or None if none arrives before the timeout.
+
+        Socket errors are raised as IMAP4.abort, as imaplib itself does, so that callers can reconnect."""
+        sock = self.imap_connection.sock
+        stop_time = time.time() + timeout
+        while b'\r\n' not in self._idle_read_buffer:
+            time_left = stop_time - time.time()
+            try:
+                if isinstance(sock, ssl.SSLSocket) and (sock.pending() > 0):
+                    pass  # Already decrypted and waiting; select() on the raw socket won't see it
+                elif (time_left <= 0) or (len(select.select([sock], [], [], time_left)[0]) == 0):
+                    return None
+                data = sock.recv(8192)
+            except (OSError, ValueError) as socket_err:  # ValueError: select() on a socket that has been closed
+                raise imaplib.IMAP4.abort('socket error during IDLE: %s' % repr(socket_err))
+            if not data:
+                raise imaplib.IMAP4.abort('socket error: EOF during IDLE')
+            self._idle_read_buffer += data
+        (line, self._idle_read_buffer) = self._idle_read_buffer.split(b'\r\n', 1)
+        return line
+
     def get_currfolder(self):
         return self.currfolder_name
 
+    def get_currfolder_uidvalidity(self):
+        return self.currfolder_uidvalidity
+
+    def get_currfolder_highestmodseq(self):
+        return self.currfolder_highestmodseq
+
+    def get_currfolder_highest_uid(self):
+        """Returns the highest UID that can exist in the current folder (based on UIDNEXT), or None if unknown"""
+        if self.currfolder_uidnext is None:
+            return None
+        return self.currfolder_uidnext - 1
+
     def get_list_alluids_in_currfolder(self):
         """Searches and returns  a list of all uids in folder, byte-format"""
-        result, data = self.imap_connection.uid('search', None, "ALL")
-        list_allemails = data[0].split()
-        LogMaster.log(10, 'List of all UIDs of emails in current folder: %s', convert_bytes_to_utf8(list_allemails))
-        return list_allemails
+        return self.get_list_uids_in_currfolder("ALL")
+
+    def get_list_uids_in_currfolder(self, search_criteria="ALL"):
+        """Searches and returns a list of uids in folder matching an IMAP SEARCH query, byte-format"""
+        try:
+            result, data = self.imap_connection.uid('search', None, search_criteria)
+        except imaplib.IMAP4.error as imap_error:
+            fallback_criteria = self.get_fallback_search_criteria(search_criteria)
+            if fallback_criteria is None:
+                raise
+            # Server didn't like our pushed-down query, so fall back to checking every email (in the UID range) client-side
+            LogMaster.log(30, 'IMAP server rejected search query, now searching for %s instead. Error was: %s',
+                fallback_criteria, imap_error)
+            return self.get_list_uids_in_currfolder(fallback_criteria)
+        list_emails = data[0].split()
+        LogMaster.log(10, 'List of UIDs of emails in current folder matching \"%s\": %s', search_criteria, convert_bytes_to_utf8(list_emails))
+        return list_emails
 
-    def get_emails_in_currfolder(self, headers_only=False):
+    @classmethod
+    def get_fallback_search_criteria(cls, search_criteria):
+        """The query to use if the server rejects search_criteria: just its leading UID range (which callers rely on to
+        keep new and already-checked emails apart), or ALL if it has none. None if there is nothing simpler to try."""
+        uid_range_match = cls._search_criteria_uid_range.match(search_criteria)
+        if uid_range_match is not None:
+            fallback_criteria = uid_range_match.group(0)
+        else:
+            fallback_criteria = "ALL"
+        if fallback_criteria == search_criteria.strip():
+            return None
+        return fallback_criteria
+
+    def get_list_changed_uids_in_currfolder(self, last_uid, modseq):
+        """Returns a list of uids (up to last_uid) whose flags have changed since modseq, byte-format. Needs CONDSTORE."""
+        if (not self.condstore_is_supported) or (last_uid < 1):
+            return []
+        result, data = self.uid_safe('FETCH', '1:%s' % last_uid, '(UID FLAGS)', '(CHANGEDSINCE %s)' % modseq)
+        if (result != 'OK') or (not isinstance(data, list)) or (data[0] is None):
+            return []
+        list_changed = [uid_str.encode('utf-8') for uid_str in self.parse_fetch_response(data) if uid_str is not None]
+        LogMaster.log(10, 'List of UIDs of emails in current folder changed since MODSEQ %s: %s', modseq, convert_bytes_to_utf8(list_changed))
+        return list_changed
+
+    def get_emails_in_currfolder(self, headers_only=False, search_criteria=None, partial_body=None):
         """Return parsed emails from the curent folder, without marking as read"""
-        for uid in self.get_list_alluids_in_currfolder():
-            yield self.get_parsed_email_byuid(uid, headers_only)
+        if search_criteria is None:
+            list_alluids = self.get_list_alluids_in_currfolder()
+        else:
+            list_alluids = self.get_list_uids_in_currfolder(search_criteria)
+        return self.get_emails_byuids(list_alluids, headers_only, partial_body)
+
+    def get_emails_byuids(self, uid_list, headers_only=False, partial_body=None):
+        """Return parsed emails for a list of uids in the current folder, without marking as read.
+
+        If partial_body is not None (and not headers_only), only the body text part is downloaded; see
+        get_emails_with_partial_body_byuids()"""
+        if (partial_body is not None) and (not headers_only):
+            yield from self.get_emails_with_partial_body_byuids(uid_list, partial_body)
+            return
+
+        # Cached headers are looked up (and their flags fetched) for the whole uid_list at once, not per batch
+        cached_emails = self.get_cached_raw_headers_byuids(uid_list, headers_only) if self.uses_header_cache(headers_only) else None
+
+        if (self.fetch_batch_size <= 1) and (cached_emails is None):
+            for uid in uid_list:
+                yield self.get_parsed_email_byuid(uid, headers_only)
+            return
+
+        for uid_batch in split_list_into_batches(uid_list, self.fetch_batch_size):
+            raw_emails = self.get_raw_emails_byuids(uid_batch, headers_only, cached_emails)
+            for uid in uid_batch:
+                yield self.parse_raw_email_response(uid, raw_emails.get(convert_bytes_to_utf8(uid)), headers_only)
+
+    def get_email_metadata_byuids(self, uid_list):
+        """Fetches just size, flags & INTERNALDATE for a list of uids. Returns a dict of uid_str: EmailMetadata
+
+        The metadata is small, so it is fetched in large batches (not fetch_batch_size, which sizes content fetches)"""
+        email_metadata = OrderedDict()
+        for uid_batch in split_list_into_batches(uid_list, max_uids_per_command):
+            result, data = self.uid_safe('FETCH', convert_uids_to_sequence_set(uid_batch), '(UID RFC822.SIZE FLAGS INTERNALDATE)')
+            if (result != 'OK') or (not isinstance(data, list)) or (data[0] is None):
+                continue
+            for (uid_str, raw_email) in self.parse_fetch_response(data).items():
+                if uid_str is not None:
+                    email_metadata[uid_str] = EmailMetadata(uid_str, raw_email, self.currfolder_name)
+        return email_metadata
+
+    def get_emails_with_partial_body_byuids(self, uid_list, max_bytes=0):
+        """Return parsed emails with all headers, but only the body text that get_email_body() would find.
+
+        Headers are fetched first, then BODYSTRUCTURE is used to fetch just the body text part (only its first
+        max_bytes, unless 0), so attachments are never downloaded. The emails are flagged headers_only, so that
+        forwarding still fetches the whole email. Emails with no usable BODYSTRUCTURE are fetched whole."""
+        cached_emails = self.get_cached_raw_headers_byuids(uid_list, headers_only=True) if self.uses_header_cache(True) else None
+        for uid_batch in split_list_into_batches(uid_list, self.fetch_batch_size):
+            raw_emails = self.get_raw_emails_byuids(uid_batch, headers_only=True, cached_emails=cached_emails)
+            text_parts = self.get_text_parts_byuids(uid_batch)
+            body_texts = self.get_text_part_bodies_byuids(text_parts, max_bytes)
+            for uid in uid_batch:
+                uid_str = convert_bytes_to_utf8(uid)
+                if uid_str not in text_parts:
+                    yield self.get_parsed_email_byuid(uid, headers_only=False)
+                    continue
+                parsed_email = self.parse_raw_email_response(uid, raw_emails.get(uid_str), headers_only=True)
+                if parsed_email is not None:
+                    parsed_email.body = body_texts.get(uid_str, '')
+                yield parsed_email
+
+    def get_text_parts_byuids(self, uid_list):
+        """Returns a dict of uid_str: TextPart (or None, if the email has no body text), from each email's BODYSTRUCTURE"""
+        text_parts = dict()
+        result, data = self.uid_safe('FETCH', convert_uids_to_sequence_set(uid_list), '(UID BODYSTRUCTURE)')
+        if (result != 'OK') or (not isinstance(data, list)) or (data[0] is None):
+            return text_parts
+
+        for response_line in bodystructure.join_fetch_response_literals(data):
+            uid_match = self._fetch_response_uid.search(response_line)
+            structure_start = response_line.find(b'BODYSTRUCTURE (')
+            if (uid_match is None) or (structure_start < 0):
+                continue
+            try:
+                (structure, end_pos) = bodystructure.parse_sexpr(response_line, structure_start + len(b'BODYSTRUCTURE '))
+            except ValueError as parse_error:
+                LogMaster.debug('Failed to parse BODYSTRUCTURE for UID %s: %s', uid_match.group(1), parse_error)
+                continue
+            text_parts[convert_bytes_to_utf8(uid_match.group(1))] = bodystructure.get_text_part(structure)
+        LogMaster.insane_debug('Body text parts found from BODYSTRUCTURE: %s', text_parts)
+        return text_parts
+
+    def get_text_part_bodies_byuids(self, text_parts, max_bytes=0):
+        """Fetches and decodes the body text parts, with one FETCH per distinct part number. Returns a dict of uid_str: str"""
+        uids_by_part_spec = OrderedDict()
+        for (uid_str, text_part) in text_parts.items():
+            if text_part is not None:
+                uids_by_part_spec.setdefault(text_part.part_spec, []).append(uid_str)
+
+        body_texts = dict()
+        for (part_spec, uid_list) in uids_by_part_spec.items():
+            partial_range = '<0.%s>' % max_bytes if max_bytes > 0 else ''
+            result, data = self.uid_safe('FETCH', convert_uids_to_sequence_set(uid_list),
+                '(UID BODY.PEEK[%s]%s)' % (part_spec, partial_range))
+            if (result != 'OK') or (not isinstance(data, list)) or (data[0] is None):
+                continue
+            for (uid_str, raw_part) in self.parse_fetch_response(data).items():
+                if uid_str in text_parts:
+                    body_texts[uid_str] = bodystructure.decode_text_part(raw_part.raw_email_bytes, text_parts[uid_str])
+        return body_texts
 
     @staticmethod
     def parse_flags(flags_raw):
@@ -187,41 +536,136 @@ class IMAPServerConnection():
             pass
         return ret_list
 
-    def get_raw_email_byuid(self, uid, headers_only=False):
-        if headers_only:
+    @staticmethod
+    def get_fetch_data_items(headers_only=False):
+        """headers_only may be True (all headers), or a list of header field names to fetch only those headers"""
+        if isinstance(headers_only, (list, tuple)) and (len(headers_only) > 0):
+            header_text = 'HEADER.FIELDS ({0})'.format(' '.join(field_name.upper() for field_name in headers_only))
+        elif headers_only:
             header_text = 'HEADER'
         else:
             header_text = ''
-        data_to_fetch = '(RFC822.SIZE FLAGS INTERNALDATE BODY.PEEK[{0}])'.format(header_text)
+        return '(UID RFC822.SIZE FLAGS INTERNALDATE BODY.PEEK[{0}])'.format(header_text)
 
+    @classmethod
+    def parse_fetch_response(cls, data):
+        """Splits a (possibly multi-message) FETCH response into an OrderedDict of uid_str: RawEmailResponse
+
+        imaplib returns each message as a (response_text, literal) tuple, followed by a closing bytes
+        item which may also carry data items sent after the literal (eg Gmail sends FLAGS last)."""
+        responses = []
+        curr_response = None
+        for item in data:
+            if item is None:
+                continue
+            if isinstance(item, tuple):
+                (response_text, literal) = (item[0], item[1])
+            else:
+                (response_text, literal) = (item, None)
+            if (curr_response is None) or cls._fetch_response_start.match(response_text):
+                curr_response = [response_text, literal]
+                responses.append(curr_response)
+            else:
+                curr_response[0] += response_text
+                if curr_response[1] is None:
+                    curr_response[1] = literal
+
+        parsed_responses = OrderedDict()
+        for (response_text, literal) in responses:
+            uid_match = cls._fetch_response_uid.search(response_text)
+            size_match = cls._fetch_response_size.search(response_text)
+            uid_str = None
+            email_size = 0
+            if uid_match:
+                uid_str = convert_bytes_to_utf8(uid_match.group(1))
+            if size_match:
+                email_size = int(size_match.group(1))
+            parsed_responses[uid_str] = RawEmailResponse(
+                raw_email_bytes=literal,
+                flags=cls.parse_flags(response_text),
+                size=email_size,
+                server_date=imaplib.Internaldate2tuple(response_text)
+            )
+        return parsed_responses
+
+    def get_raw_emails_byuids(self, uid_list, headers_only=False, cached_emails=None):
+        """Fetches a set of emails in a single UID FETCH command. Returns a dict of uid_str: RawEmailResponse"""
+        if len(uid_list) == 0:
+            return OrderedDict()
+        if self.uses_header_cache(headers_only):
+            return self.get_raw_headers_byuids_cached(uid_list, headers_only, cached_emails)
+        return self.fetch_raw_emails_byuids(uid_list, headers_only)
+
+    def uses_header_cache(self, headers_only):
+        return headers_only and (self.header_cache is not None) and (self.currfolder_uidvalidity is not None)
+
+    def get_header_cache_account(self):
+        """Identifies this mailbox in the header cache, which may be shared with other accounts and servers"""
+        return '%s@%s:%s' % (self.username, self.server_name, self.server_port)
+
+    def get_cached_raw_headers_byuids(self, uid_list, headers_only):
+        """Looks up the emails in the header cache, and fetches the flags of those that are cached (with one UID FETCH
+        for all of them, split only if there are more than max_uids_per_command). Returns a dict of
+        uid_str: RawEmailResponse for the cached emails, with None for those that have gone from the folder"""
+        header_spec = self.get_fetch_data_items(headers_only)
+        uid_strs = [convert_bytes_to_utf8(uid) for uid in uid_list]
+        cached_entries = self.header_cache.get_entries(self.get_header_cache_account(), self.currfolder_name,
+            self.currfolder_uidvalidity, header_spec, uid_strs)
+
+        cached_emails = dict()
+        for uid_batch in split_list_into_batches(list(cached_entries.keys()), max_uids_per_command):
+            result, data = self.uid_safe('FETCH', convert_uids_to_sequence_set(uid_batch), '(UID FLAGS)')
+            if (result != 'OK') or (not isinstance(data, list)):
+                continue  # Fetch them in full instead
+            flags_responses = self.parse_fetch_response(data) if data[0] is not None else dict()
+            for uid_str in uid_batch:
+                if uid_str in flags_responses:
+                    (raw_headers, size, server_date) = cached_entries[uid_str]
+                    cached_emails[uid_str] = RawEmailResponse(raw_headers, flags_responses[uid_str].flags, size, server_date)
+                else:
+                    cached_emails[uid_str] = None  # The email has gone from the folder
+        LogMaster.debug('Header cache: %s of %s emails had cached headers, so only their flags were fetched.',
+            sum(1 for cached_email in cached_emails.values() if cached_email is not None), len(uid_strs))
+        return cached_emails
+
+    def get_raw_headers_byuids_cached(self, uid_list, headers_only, cached_emails=None):
+        """As get_raw_emails_byuids, but the headers (with size & INTERNALDATE) of emails in the header cache aren't
+        fetched again. cached_emails is from get_cached_raw_headers_byuids(), which is called here if it wasn't already
+        called for a longer list of uids."""
+        if cached_emails is None:
+            cached_emails = self.get_cached_raw_headers_byuids(uid_list, headers_only)
+        uid_strs = [convert_bytes_to_utf8(uid) for uid in uid_list]
+
+        raw_emails = dict((uid_str, cached_emails[uid_str]) for uid_str in uid_strs if cached_emails.get(uid_str) is not None)
+        uncached_uids = [uid_str for uid_str in uid_strs if uid_str not in cached_emails]
+        if len(uncached_uids) > 0:
+            fetched_emails = self.fetch_raw_emails_byuids(uncached_uids, headers_only)
+            self.header_cache.add_entries(self.get_header_cache_account(), self.currfolder_name, self.currfolder_uidvalidity,
+                self.get_fetch_data_items(headers_only), fetched_emails)
+            raw_emails.update(fetched_emails)
+
+        return OrderedDict((uid_str, raw_emails[uid_str]) for uid_str in uid_strs if uid_str in raw_emails)
+
+    def fetch_raw_emails_byuids(self, uid_list, headers_only=False):
         try:
-            result, data = self.imap_connection.uid('fetch', uid, data_to_fetch)
+            result, data = self.imap_connection.uid('fetch', convert_uids_to_sequence_set(uid_list),
+                self.get_fetch_data_items(headers_only))
         except imaplib.IMAP4.error as imap_error:
+            LogMaster.debug('IMAP error occured during UID FETCH of %s emails: %s', len(uid_list), imap_error)
             result = 'NO'
             data = [None]  # I didn't make up this value: [None] can also emanate from imaplib responses.
 
         if (result == 'OK') and isinstance(data, list) and (data[0] is not None):
-            response = data[0][0]
-            raw_email_contents = data[0][1]
-            email_size = 0
-            email_flags = None
-            server_date = None
-            if isinstance(response, bytes):
-                # Sample size_and_flags_response: b'1 RFC822.SIZE 9500 (FLAGS (\\Seen) BODY[HEADER] {1234}'
-                response_utf8 = response.decode('utf-8', 'replace')
-                tokens = response_utf8.split(' ')
-                if len(tokens) > 3:
-                    email_size = tokens[2]
-                email_flags = self.parse_flags(response)
-                server_date = imaplib.Internaldate2tuple(response)
-            raw_email = RawEmailResponse(
-                raw_email_bytes=raw_email_contents,
-                flags=email_flags,
-                size=email_size,
-                server_date=server_date
-            )
+            return self.parse_fetch_response(data)
         else:
-            raw_email = None
+            return OrderedDict()
+
+    def get_raw_email_byuid(self, uid, headers_only=False):
+        raw_emails = self.get_raw_emails_byuids([uid], headers_only)
+        raw_email = raw_emails.get(convert_bytes_to_utf8(uid))
+        if (raw_email is None) and (len(raw_emails) == 1):
+            # Server didn't echo the UID back, but we only asked for one email
+            raw_email = list(raw_emails.values())[0]
         return raw_email
 
     def get_raw_headers_byuid(self, uid):
@@ -229,9 +673,12 @@ class IMAPServerConnection():
 
     def get_parsed_email_byuid(self, uid, headers_only=False):
         raw_email = self.get_raw_email_byuid(uid, headers_only)
-        if raw_email is not None:
+        return self.parse_raw_email_response(uid, raw_email, headers_only)
+
+    def parse_raw_email_response(self, uid, raw_email, headers_only=False):
+        if (raw_email is not None) and (raw_email.raw_email_bytes is not None):
             try:
-                parsed_email = self.parse_raw_email(raw_email.raw_email_bytes)
+                parsed_email = self.parse_raw_email(raw_email.raw_email_bytes, email_view=True)
             except imaplib.IMAP4.error as parse_error:
                 parsed_email = None
             else:
@@ -242,71 +689,33 @@ class IMAPServerConnection():
                 parsed_email.uid = uid
                 parsed_email.uid_str = convert_bytes_to_utf8(uid)
                 parsed_email.imap_folder = self.currfolder_name
-                parsed_email.date_datetime = get_email_datetime(parsed_email)
-                parsed_email.addr_from = get_email_addrfield_from(parsed_email)
-                parsed_email.addr_to = get_email_addrfield_to(parsed_email)
-                parsed_email.addr_cc = get_email_addrfield_cc(parsed_email)
                 parsed_email.imap_flags = raw_email.flags
                 parsed_email.is_read = self.is_email_currently_read_fromflags(parsed_email.imap_flags)
-                parsed_email.body = get_email_body(parsed_email)
-                parsed_email.unique_id = get_email_uniqueid(parsed_email, parsed_email.original_raw_email)
+                # The body, addresses, dates and unique id are worked out by the EmailView when first used
+                parsed_email.match_results = dict()  # Match -> result, so each distinct Match is only checked once
         else:
             parsed_email = None
         return parsed_email
 
     @staticmethod
-    def parse_raw_email(raw_email):
+    def parse_raw_email(raw_email, email_view=False):
+        """Parses a whole email, or (if email_view) just its headers into an EmailView, which parses the rest when needed"""
         ret_msg = None
         if isinstance(raw_email, bytes):
             raw_email_bytes = raw_email
         elif isinstance(raw_email, RawEmailResponse):
             raw_email_bytes = raw_email.raw_email_bytes
         try:
-            ret_msg = email.message_from_bytes(raw_email_bytes)
+            if email_view:
+                ret_msg = EmailView.parse(raw_email_bytes)
+            else:
+                ret_msg = email.message_from_bytes(raw_email_bytes)
         except email.errors.MessageError as e:
             # This isn't /handling/ the error per se: it's just changing
             # it into an imaplib error to match the rest of this class
             raise imaplib.IMAP4.error('Error parsing raw email. Email Error was: %s' % e)
         return ret_msg
 
-    def move_email(self, uid, dest_folder, mark_as_read_on_move=False):
-        intial_read_status = self.is_email_currently_read_byuid(uid)
-        this_func_marked_email_as_read = False
-
-        if (mark_as_read_on_move is True) and (intial_read_status is False):
-            self.mark_email_as_read_byuid(uid)
-            this_func_marked_email_as_read = True
-            LogMaster.log(10, 'Now Moving email to new folder with "mark_as_read" required, so now marking email as READ. Move Email UID: %s', uid)
-
-        # Now we try the IMAP move
-        try:
-            if self.imapmove_is_supported:
-                result, data = self.imap_connection.uid('MOVE', uid, dest_folder)
-                LogMaster.log(20, 'Successfully moved email to new folder. UID: %s, Dest Folder: %s', uid, dest_folder)
-            else:
-                result, data = self.imap_connection.uid('COPY', uid, dest_folder)
-                if result == 'OK':
-                    self.del_email(uid)
-                LogMaster.log(20, 'Successfully moved email to new folder. UID: %s, Dest Folder: %s', uid, dest_folder)
-        except imaplib.IMAP4.error as e:
-            LogMaster.log(30, 'Failed to move email (UID: %s)', uid)
-            if (this_func_marked_email_as_read is True):
-                # We need to unwind the Read status of any email that we may have marked as read
-                LogMaster.log(30, 'We marked this email as READ earlier, now unmarking (UID: %s)', uid)
-                self.mark_email_as_unread_byuid(uid)
-            return False
-
-        return True
-
-    def del_email(self, uid, perm_delete=False):
-        if perm_delete:
-            result, data = self.set_flag_byuid(uid, '(\\Deleted)')
-            self.expunge()
-            LogMaster.log(20, 'Deleted email (permanently). UID: %s', uid)
-        else:
-            self.move_email(uid, self.deletions_folder, mark_as_read_on_move=False)
-            LogMaster.log(20, 'Sent email to Deleted Items folder. UID: %s', uid)
-
     def is_email_currently_read_byuid(self, uid):
         return self.is_email_currently_read_fromflags(
             self.get_imap_flags_byuid(uid)
@@ -334,6 +743,19 @@ class IMAPServerConnection():
     def expunge(self):
         return self.imap_connection.expunge()
 
+    def expunge_byuids(self, uid_list):
+        """Expunges just these emails with UID EXPUNGE; without UIDPLUS, a plain EXPUNGE removes all \\Deleted emails"""
+        if not self.uidplus_is_supported:
+            return self.expunge()
+        for uid_batch in split_list_into_batches(sorted(int(uid) for uid in uid_list), max_uids_per_command):
+            self.uid_safe('EXPUNGE', convert_uids_to_sequence_set(uid_batch))
+
+    def flush_queued_actions(self):
+        """Sends all actions queued for emails in the current folder"""
+        if self.action_queue.has_queued_actions():
+            LogMaster.debug('Now sending queued email actions for folder \"%s\": %s', self.currfolder_name, self.action_queue)
+            self.action_queue.flush()
+
     def capabilities(self):
         return self.imap_connection.capabilities
 
@@ -0,0 +1,129 @@
+import email
+import os
+import queue
+import threading
+import uuid
+from modules.logging import LogMaster
+
+# forwards_sent/forwards_failed are counted by the sender threads and by the threads checking rules
+forward_counters_lock = threading.Lock()
+
+
+def count_forward_result(counters, success):
+    if counters is not None:
+        with forward_counters_lock:
+            counters.incr('forwards_sent' if success else 'forwards_failed')
+
+
+class OutboundMailQueue():
+    """Sends emails (eg forwards) from background sender threads, so that a slow SMTP server doesn't hold up
+    checking the next email against the rules.
+
+    Emails wait in a bounded queue: if it fills up, queueing another email blocks until a sender has made room.
+    Once an email has been sent (or has failed), the counters it was queued with are updated: forwards_sent or
+    forwards_failed. drain() waits until every queued email has been dealt with.
+
+    With a spool folder, each email is also written there when queued, and removed once sent (or renamed to .failed
+    if it couldn't be sent). Emails left in the spool folder by a run that didn't finish are sent by the next run."""
+    spool_file_ext = '.eml'
+    spool_failed_ext = '.failed'
+
+    def __init__(self, send_email_msg, num_senders=1, max_queued_emails=100, spool_folder=None):
+        self.send_email_msg = send_email_msg  # Function that sends an email, returning True if it was sent
+        self.queue = queue.Queue(max_queued_emails)
+        self.spool_folder = spool_folder
+        if spool_folder is not None:
+            os.makedirs(spool_folder, exist_ok=True)
+        self.senders = []
+        for sender_num in range(num_senders):
+            sender = threading.Thread(target=self.run, name='OutboundMail-%s' % sender_num)
+            sender.daemon = True  # drain() or stop() must be called before exiting; spooled emails are kept anyway
+            sender.start()
+            self.senders.append(sender)
+        self.queue_spooled_emails()
+
+    def put(self, email_msg, counters=None):
+        spool_file = self.spool_email(email_msg)
+        try:
+            self.queue.put_nowait((email_msg, counters, spool_file))
+        except queue.Full:
+            LogMaster.debug('Outbound mail queue is full (%s emails), so waiting for the SMTP senders to catch up.',
+                self.queue.maxsize)
+            self.queue.put((email_msg, counters, spool_file))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.send_queued_email(*item)
+            finally:
+                self.queue.task_done()
+
+    def send_queued_email(self, email_msg, counters, spool_file):
+        try:
+            success = self.send_email_msg(email_msg)
+        except Exception:
+            LogMaster.exception('Sending a queued email failed with an unexpected error:')
+            success = False
+        count_forward_result(counters, success)
+        self.unspool_email(spool_file, success)
+
+    def drain(self):
+        """Waits until every email queued so far has been sent, or has failed"""
+        if any(sender.is_alive() for sender in self.senders):
+            self.queue.join()
+
+    def stop(self):
+        """Sends every email queued so far, then ends the sender threads"""
+        for sender in self.senders:
+            self.queue.put(None)
+        for sender in self.senders:
+            sender.join()
+        self.senders = []
+
+    def spool_email(self, email_msg):
+        if self.spool_folder is None:
+            return None
+        spool_file = os.path.join(self.spool_folder, uuid.uuid4().hex + self.spool_file_ext)
+        try:
+            # Written under a temporary name first, so an unfinished write is never mistaken for a queued email
+            with open(spool_file + '.tmp', 'wb') as spool_fh:
+                spool_fh.write(email_msg.as_bytes())
+            os.replace(spool_file + '.tmp', spool_file)
+        except (OSError, UnicodeError, LookupError) as spool_err:
+            LogMaster.error('Could not write email to the outbound mail spool folder %s, so it will be sent without '
+                'being spooled. Error was: %s', self.spool_folder, repr(spool_err))
+            return None
+        return spool_file
+
+    def unspool_email(self, spool_file, success):
+        if spool_file is None:
+            return
+        try:
+            if success:
+                os.remove(spool_file)
+            else:
+                os.replace(spool_file, spool_file + self.spool_failed_ext)
+                LogMaster.error('Email could not be sent, so it has been kept as %s', spool_file + self.spool_failed_ext)
+        except OSError as spool_err:
+            LogMaster.error('Could not tidy up spooled email %s. Error was: %s', spool_file, repr(spool_err))
+
+    def queue_spooled_emails(self):
+        """Queues the emails left in the spool folder by an earlier run"""
+        if self.spool_folder is None:
+            return
+        spool_files = sorted((os.path.join(self.spool_folder, file_name) for file_name in os.listdir(self.spool_folder)
+            if file_name.endswith(self.spool_file_ext)), key=os.path.getmtime)
+        if len(spool_files) > 0:
+            LogMaster.info('Found %s emails in the outbound mail spool folder %s from an earlier run, so sending them now.',
+                len(spool_files), self.spool_folder)
+        for spool_file in spool_files:
+            try:
+                with open(spool_file, 'rb') as spool_fh:
+                    email_msg = email.message_from_bytes(spool_fh.read())
+            except OSError as spool_err:
+                LogMaster.error('Could not read spooled email %s. Error was: %s', spool_file, repr(spool_err))
+                continue
+            self.queue.put((email_msg, None, spool_file))
@@ -16,12 +16,23 @@ class SMTPServerConnection():
         self.is_connected = False
         self.is_connected_ssl = False
         self.login_errror = False
+        self.messages_sent = 0  # Since connecting; used by SMTPSessionPool to know when to RSET between messages
         self.set_try_tls_first()
 
     def send_message(self, email_msg):
-        return self.server_connection.send_message(email_msg)
+        ret_val = self.server_connection.send_message(email_msg)
+        self.messages_sent += 1
+        return ret_val
+
+    def reset(self):
+        """Sends RSET, so the connection can be used for another message. Raises an SMTPException (or OSError) if the
+        connection has been dropped."""
+        code, resp = self.server_connection.rset()
+        if code != 250:
+            raise smtplib.SMTPResponseException(code, resp)
 
     def connect(self):
+        self.messages_sent = 0
         if (self.use_tls):
             self.connect_ssl()
         else:
@@ -39,6 +50,15 @@ class SMTPServerConnection():
     def close(self):
         self.disconnect()
 
+    def quit(self):
+        """Politely ends the SMTP session (QUIT), then disconnects"""
+        try:
+            if self.is_connected:
+                self.server_connection.quit()
+        except Exception:
+            pass
+        self.disconnect()
+
     def set_try_tls_first(self):
         self.try_tls_first = True
         if (self.port == 25) or (self.port == 587):
@@ -0,0 +1,94 @@
+import smtplib
+import threading
+from modules.logging import LogMaster
+from modules.email.SMTPServerConnection import SMTPServerConnection
+
+# Errors that mean an SMTP connection has been lost (or the server is closing it, eg after being idle),
+# so the message can be sent again on a new connection
+connection_lost_errors = (smtplib.SMTPServerDisconnected, OSError)
+connection_closing_codes = frozenset([421])
+
+
+class SMTPSessionPool():
+    """Keeps SMTP sessions open between emails, so that each email sent doesn't need a new connection, EHLO, TLS
+    handshake and login.
+
+    Up to max_sessions sessions are opened, only when they are first needed (eg by several All Folders worker threads
+    forwarding emails at once). Each session is reset (RSET) before it is used for another email. If a session has
+    been dropped by the server, it is reconnected and the email sent again. close() ends all the sessions."""
+    def __init__(self, max_sessions=1, **connection_params):
+        self.max_sessions = max_sessions
+        self.connection_params = connection_params
+        self.idle_sessions = []
+        self.num_sessions = 0
+        self.closed = False
+        self.sessions_available = threading.Condition()
+
+    def get_session(self):
+        with self.sessions_available:
+            while True:
+                if len(self.idle_sessions) > 0:
+                    return self.idle_sessions.pop()
+                if self.num_sessions < self.max_sessions:
+                    self.num_sessions += 1
+                    return SMTPServerConnection(**self.connection_params)
+                self.sessions_available.wait()
+
+    def return_session(self, session):
+        with self.sessions_available:
+            if not self.closed:
+                self.idle_sessions.append(session)
+                self.sessions_available.notify()
+                return
+            self.num_sessions -= 1
+        session.quit()  # The pool was closed while this session was in use
+
+    def send_message(self, email_msg):
+        """Sends the email on a pooled session. Returns True if it was sent."""
+        session = self.get_session()
+        try:
+            return self._send_message_on_session(session, email_msg)
+        finally:
+            self.return_session(session)
+
+    def _send_message_on_session(self, session, email_msg):
+        for attempt in (1, 2):  # A second attempt is only made on a new connection, if the first was lost
+            try:
+                if not session.is_connected:
+                    session.connect()
+                    if not session.is_connected:
+                        LogMaster.error('Could not connect to the SMTP Server %s:%s.', self.connection_params.get('server_name'),
+                            self.connection_params.get('port'))
+                        return False
+                    LogMaster.debug('New SMTP session opened to %s:%s.', self.connection_params.get('server_name'),
+                        self.connection_params.get('port'))
+                elif session.messages_sent > 0:
+                    session.reset()
+                session.send_message(email_msg)
+                return True
+            except connection_lost_errors as lost_error:
+                LogMaster.info('SMTP session was lost (%s), so will reconnect.', repr(lost_error))
+                session.disconnect()
+            except smtplib.SMTPResponseException as smtp_error:
+                if smtp_error.smtp_code not in connection_closing_codes:
+                    LogMaster.error('SMTP Server refused email: %s', repr(smtp_error))
+                    return False
+                LogMaster.info('SMTP Server is closing the session (%s), so will reconnect.', repr(smtp_error))
+                session.disconnect()
+            except smtplib.SMTPException as smtp_error:
+                # eg all recipients refused: the session is still usable, as it is reset before the next email
+                LogMaster.error('SMTP Send failed: %s', repr(smtp_error))
+                return False
+        return False
+
+    def close(self):
+        """Ends all the idle sessions (QUIT). Sessions in use are ended when they are returned to the pool."""
+        with self.sessions_available:
+            self.closed = True
+            (idle_sessions, self.idle_sessions) = (self.idle_sessions, [])
+            self.num_sessions -= len(idle_sessions)
+        for session in idle_sessions:
+            session.quit()
+        if len(idle_sessions) > 0:
+            LogMaster.debug('Closed %s SMTP session(s) to %s:%s.', len(idle_sessions), self.connection_params.get('server_name'),
+                self.connection_params.get('port'))
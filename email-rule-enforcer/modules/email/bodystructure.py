@@ -0,0 +1,174 @@
+import re
+import binascii
+import codecs
+import quopri
+
+# Parses IMAP BODYSTRUCTURE responses (RFC 3501 section 7.4.2), to find the body part that get_email_body() would use,
+# so that just that part can be fetched (rather than the whole email, attachments and all).
+
+_sexpr_token = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))', re.DOTALL)
+_quoted_escape = re.compile(rb'\\(.)', re.DOTALL)
+_literal_size = re.compile(rb'\{\d+\}$')
+
+
+class TextPart():
+    def __init__(self, part_spec, encoding=None, charset=None):
+        self.part_spec = part_spec
+        self.encoding = encoding
+        self.charset = charset
+
+    def __repr__(self):
+        return '%s:(part %s, encoding %s, charset %s)' % (self.__class__.__name__, self.part_spec, self.encoding, self.charset)
+
+
+def join_fetch_response_literals(data):
+    """Joins an imaplib FETCH response back into one line per email, with each literal replaced by a quoted string"""
+    lines = []
+    curr_line = b''
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            quoted_literal = b'"' + item[1].replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+            curr_line += _literal_size.sub(b'', item[0]) + quoted_literal
+        else:
+            curr_line += item
+            lines.append(curr_line)
+            curr_line = b''
+    if curr_line != b'':
+        lines.append(curr_line)
+    return lines
+
+
+def parse_sexpr(data, start=0):
+    """Parses a parenthesised IMAP list starting at data[start]. Returns (nested lists of str/None, end position)"""
+    stack = [[]]
+    pos = start
+    while True:
+        token = _sexpr_token.match(data, pos)
+        if token is None:
+            raise ValueError('Unparseable IMAP list at position %s' % pos)
+        pos = token.end()
+        (open_paren, close_paren, quoted, atom) = token.groups()
+        if open_paren:
+            stack.append([])
+            continue
+        elif close_paren:
+            closed_list = stack.pop()
+            stack[-1].append(closed_list)
+            if len(stack) == 1:
+                return (stack[0][0], pos)
+            continue
+        elif quoted is not None:
+            value = _quoted_escape.sub(rb'\1', quoted).decode('utf-8', 'replace')
+        elif atom.upper() == b'NIL':
+            value = None
+        else:
+            value = atom.decode('utf-8', 'replace')
+        if len(stack) == 1:
+            return (value, pos)
+        stack[-1].append(value)
+
+
+def is_multipart(structure):
+    return isinstance(structure, list) and (len(structure) > 0) and isinstance(structure[0], list)
+
+
+def join_part_spec(parent_part_spec, part_num):
+    if parent_part_spec == '':
+        return str(part_num)
+    return '%s.%s' % (parent_part_spec, part_num)
+
+
+def get_lower(structure, index):
+    try:
+        return structure[index].lower()
+    except (IndexError, AttributeError):
+        return None
+
+
+def get_param(params, param_name):
+    if not isinstance(params, list):
+        return None
+    for index in range(0, len(params) - 1, 2):
+        if isinstance(params[index], str) and (params[index].lower() == param_name):
+            return params[index + 1]
+    return None
+
+
+def make_text_part(structure, part_spec):
+    return TextPart(part_spec, encoding=get_lower(structure, 5), charset=get_param(structure[2], 'charset'))
+
+
+def is_attachment(structure):
+    """Single part: the disposition follows the basic fields, lines (text), envelope/body/lines (message) and md5"""
+    body_type = get_lower(structure, 0)
+    if body_type == 'text':
+        disposition_index = 9
+    elif (body_type == 'message') and (get_lower(structure, 1) == 'rfc822'):
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    try:
+        disposition = structure[disposition_index]
+        return isinstance(disposition, list) and ('attachment' in str(disposition[0]).lower())
+    except IndexError:
+        return False
+
+
+def find_text_part(structure, part_spec=''):
+    """Finds the first text/plain part that isn't an attachment, in the same order as email.message.walk()"""
+    if is_multipart(structure):
+        part_num = 0
+        for sub_structure in structure:
+            if not isinstance(sub_structure, list):
+                break  # Sub-parts are followed by the multipart subtype & extension data
+            part_num += 1
+            text_part = find_text_part(sub_structure, join_part_spec(part_spec, part_num))
+            if text_part is not None:
+                return text_part
+        return None
+
+    if (not isinstance(structure, list)) or (len(structure) < 7):
+        return None
+    if (get_lower(structure, 0) == 'message') and (get_lower(structure, 1) == 'rfc822') and (len(structure) > 8):
+        encapsulated_structure = structure[8]
+        if is_multipart(encapsulated_structure):
+            return find_text_part(encapsulated_structure, part_spec)
+        return find_text_part(encapsulated_structure, join_part_spec(part_spec, 1))
+    if (get_lower(structure, 0) == 'text') and (get_lower(structure, 1) == 'plain') and (not is_attachment(structure)):
+        return make_text_part(structure, part_spec)
+    return None
+
+
+def get_text_part(structure):
+    """Returns the TextPart that get_email_body() would use for an email with this BODYSTRUCTURE, or None if none.
+
+    Like get_email_body(), the body of a non-multipart email is used whatever its content type."""
+    if is_multipart(structure):
+        return find_text_part(structure)
+    if isinstance(structure, list) and (len(structure) >= 7):
+        return make_text_part(structure, '1')
+    return None
+
+
+def decode_text_part(raw_bytes, text_part):
+    """Decodes a (possibly truncated) body part using its transfer-encoding and charset"""
+    if raw_bytes is None:
+        return ''
+    if text_part.encoding == 'base64':
+        base64_bytes = re.sub(rb'[^A-Za-z0-9+/=]', b'', raw_bytes)
+        base64_bytes = base64_bytes[:len(base64_bytes) - (len(base64_bytes) % 4)]  # Partial fetches may end mid-block
+        try:
+            raw_bytes = binascii.a2b_base64(base64_bytes)
+        except binascii.Error:
+            pass
+    elif text_part.encoding == 'quoted-printable':
+        raw_bytes = quopri.decodestring(raw_bytes)
+
+    charset = text_part.charset or 'utf-8'
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = 'utf-8'
+    return raw_bytes.decode(charset, 'replace')
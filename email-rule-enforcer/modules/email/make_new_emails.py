@@ -1,3 +1,4 @@
+import email.message
 from email.mime.multipart import MIMEMultipart
 from email.mime.nonmultipart import MIMENonMultipart
 from email.mime.message import MIMEMessage
@@ -5,7 +6,21 @@ from email.mime.text import MIMEText
 from email.headerregistry import Address
 
 
+class RawEmail(email.message.Message):
+    """An email kept as its raw bytes, to be attached (in a MIMEMessage) without parsing it and then generating it
+    again: the generators write the bytes back as they are, apart from line endings."""
+    def __init__(self, raw_email_bytes):
+        super().__init__()
+        # With no Content-Type of its own, the generators treat it as a single text part. Bytes that aren't ASCII are
+        # carried as surrogates, just as the email parser does, so BytesGenerator writes them back unchanged.
+        self.set_payload(raw_email_bytes.decode('ascii', 'surrogateescape'))
+
+    def _write_headers(self, generator):
+        pass  # The headers are already in the raw bytes
+
+
 def new_email_forward(email_from, email_to, subject, bodytext, email_to_attach, cc=None, bcc=None):
+    """email_to_attach may be a parsed email, or the raw bytes of one"""
     # Create the container (outer) email message.
     msg = MIMEMultipart()
     msg['Subject'] = subject
@@ -17,10 +32,23 @@ def new_email_forward(email_from, email_to, subject, bodytext, email_to_attach,
     msg['To'] = _to
 
     body = MIMEText(bodytext)
-    attachment = MIMEMessage(email_to_attach)
     msg.attach(body)
-    msg.attach(attachment)
+    msg.attach(new_email_attachment(email_to_attach))
+
+    return msg
+
+
+def new_email_attachment(email_to_attach):
+    if isinstance(email_to_attach, bytes):
+        return MIMEMessage(RawEmail(email_to_attach))
+    return MIMEMessage(email_to_attach)
+
 
+def new_email_forward_digest(email_from, email_to, subject, bodytext, emails_to_attach, cc=None, bcc=None):
+    """As new_email_forward, with several emails (parsed, or their raw bytes) attached"""
+    msg = new_email_forward(email_from, email_to, subject, bodytext, emails_to_attach[0], cc, bcc)
+    for email_to_attach in emails_to_attach[1:]:
+        msg.attach(new_email_attachment(email_to_attach))
     return msg
 
 
@@ -1,5 +1,15 @@
+import atexit
+import threading
 from modules.logging import LogMaster
-from modules.email.SMTPServerConnection import SMTPServerConnection
+from modules.email.SMTPSessionPool import SMTPSessionPool
+from modules.email.OutboundMailQueue import OutboundMailQueue, count_forward_result
+
+# SMTP sessions are kept open (one pool per SMTP server and login) for the whole run, and closed by close_smtp_sessions()
+smtp_session_pools = dict()
+smtp_session_pools_lock = threading.Lock()
+
+# Forwards are sent by background senders once start_outbound_mail_queue() has been called (only if smtp_outbound_queue_senders is set)
+outbound_mail_queue = None
 
 
 def send_email_from_config(config, email_msg):
@@ -10,13 +20,46 @@ def send_email_from_config(config, email_msg):
     smtp_use_tls = config["smtp_use_tls"]
     smtp_auth_required = config["smtp_auth_required"]
     smtplib_debug = config["smtp_smtplib_debug"]
+    smtp_connection_pool_size = config["smtp_connection_pool_size"]
+
+    return send_email(smtp_server_name, smtp_port, smtp_username, smtp_password,
+        email_msg, smtp_use_tls, smtp_auth_required, smtplib_debug, smtp_connection_pool_size)
+
+
+def queue_email_from_config(config, email_msg, counters=None):
+    """Sends the email from the outbound mail queue if it has been started, otherwise straight away.
+    counters (if given) get forwards_sent or forwards_failed once it has been sent."""
+    if outbound_mail_queue is not None:
+        outbound_mail_queue.put(email_msg, counters)
+        return
+    count_forward_result(counters, send_email_from_config(config, email_msg))
+
+
+def start_outbound_mail_queue(config):
+    global outbound_mail_queue
+    if (config['smtp_outbound_queue_senders'] < 1) or (outbound_mail_queue is not None):
+        return
+    outbound_mail_queue = OutboundMailQueue(lambda email_msg: send_email_from_config(config, email_msg),
+        num_senders=config['smtp_outbound_queue_senders'],
+        max_queued_emails=config['smtp_outbound_queue_max_emails'],
+        spool_folder=config['smtp_outbound_spool_folder'])
+
 
-    send_email(smtp_server_name, smtp_port, smtp_username, smtp_password,
-        email_msg, smtp_use_tls, smtp_auth_required, smtplib_debug)
+def drain_outbound_mail_queue():
+    """Waits until every email queued so far has been sent (or has failed), so their counters are up to date"""
+    if outbound_mail_queue is not None:
+        outbound_mail_queue.drain()
+
+
+def stop_outbound_mail_queue():
+    global outbound_mail_queue
+    if outbound_mail_queue is not None:
+        outbound_mail_queue.stop()
+        outbound_mail_queue = None
 
 
 def send_email(smtp_server_name, smtp_port, smtp_username, smtp_password,
-                email_msg, smtp_use_tls=False, smtp_auth_required=False, smtplib_debug=False):
+                email_msg, smtp_use_tls=False, smtp_auth_required=False, smtplib_debug=False, smtp_connection_pool_size=1):
     LogMaster.log(30, "Now sending email via smtp. Details are:\nFrom: %s\nTo: %s\nSubject: %s",
         email_msg["from"], email_msg["to"], email_msg["subject"])
     LogMaster.debug("""
@@ -25,19 +68,15 @@ Server Name and port, TLS Required: %s:%s, %s\n
 Auth Required, Username: %s, %s""",
         smtp_server_name, smtp_port, smtp_use_tls, smtp_auth_required, smtp_username)
 
-    success = False
-    server_conn = SMTPServerConnection(server_name=smtp_server_name,
+    session_pool = get_smtp_session_pool(smtp_connection_pool_size, server_name=smtp_server_name,
         port=smtp_port, username=smtp_username, password=smtp_password,
         use_tls=smtp_use_tls, auth_required=smtp_auth_required,
         smtplib_debug=smtplib_debug)
-    server_conn.connect()
-    if server_conn.is_connected:
-        try:
-            server_conn.send_message(email_msg)
-            success = True
-        except:
-            pass
-    server_conn.disconnect()
+    try:
+        success = session_pool.send_message(email_msg)
+    except Exception:
+        LogMaster.exception('SMTP Send failed with an unexpected error:')
+        success = False
 
     if (success):
         LogMaster.log(30, "SMTP Send was successful.")
@@ -47,3 +86,23 @@ Auth Required, Username: %s, %s""",
     return success
 
 
+def get_smtp_session_pool(max_sessions, **connection_params):
+    pool_key = tuple(sorted(connection_params.items()))
+    with smtp_session_pools_lock:
+        if pool_key not in smtp_session_pools:
+            smtp_session_pools[pool_key] = SMTPSessionPool(max_sessions, **connection_params)
+        return smtp_session_pools[pool_key]
+
+
+def close_smtp_sessions():
+    """Ends every SMTP session opened during the run"""
+    with smtp_session_pools_lock:
+        session_pools = list(smtp_session_pools.values())
+        smtp_session_pools.clear()
+    for session_pool in session_pools:
+        session_pool.close()
+
+
+atexit.register(close_smtp_sessions)  # In case the run ends some other way (eg an unhandled error)
+
+
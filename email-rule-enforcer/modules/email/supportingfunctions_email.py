@@ -2,6 +2,7 @@ import time
 import datetime
 import email.utils
 import hashlib
+import modules.models.tzinfo_UTC as tzinfo_UTC
 
 
 def convert_emaildate_to_datetime(email_date_rfc2822):
@@ -9,6 +10,13 @@ def convert_emaildate_to_datetime(email_date_rfc2822):
     return parsed_datetime
 
 
+def convert_internaldate_to_datetime(internaldate_tuple):
+    """Converts an INTERNALDATE (as a local time.struct_time from imaplib.Internaldate2tuple) to a UTC datetime"""
+    if internaldate_tuple is None:
+        return None
+    return datetime.datetime.fromtimestamp(time.mktime(internaldate_tuple), tzinfo_UTC.utc)
+
+
 def convert_emaildate_to_datetimestr(email_date_rfc2822):
     return convert_emaildate_to_datetime(email_date_rfc2822).isoformat(' ')
 
@@ -26,6 +34,31 @@ def convert_bytes_to_utf8(byte_thing):
         return byte_thing
 
 
+def convert_uids_to_sequence_set(uid_list):
+    """Converts a list of uids (bytes, str or int) into a compact IMAP sequence-set string, eg '1:4,7,9:10'"""
+    uid_ints = sorted(set(int(uid) for uid in uid_list))
+    ranges = []
+    for uid in uid_ints:
+        if ranges and (uid == ranges[-1][1] + 1):
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    sequence_set = []
+    for (range_start, range_end) in ranges:
+        if range_start == range_end:
+            sequence_set.append(str(range_start))
+        else:
+            sequence_set.append('%s:%s' % (range_start, range_end))
+    return ','.join(sequence_set)
+
+
+def split_list_into_batches(list_to_split, batch_size):
+    """Yields successive slices of a list, each no longer than batch_size"""
+    batch_size = max(1, batch_size)
+    for index in range(0, len(list_to_split), batch_size):
+        yield list_to_split[index:index + batch_size]
+
+
 def get_email_uniqueid(parsed_message, raw_message):
     uniqueid = None
     try:
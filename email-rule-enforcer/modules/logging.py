@@ -1,6 +1,10 @@
 import logging
 import sys
 import datetime
+import queue
+import threading
+import atexit
+from collections import OrderedDict
 from modules.models.LogfileSettings import LogfileSettings
 from modules.supportingfunctions import die_with_errormsg
 from modules.models.Singleton import Singleton
@@ -12,12 +16,103 @@ except ImportError:
     console_colours = False
 
 
+class BackgroundLogWriter():
+    """Writes log records to their handlers (console, log files) from a background thread, so that the thread doing
+    the work doesn't wait on terminal or file I/O.
+
+    Records wait in a bounded queue: if it fills up, logging blocks until there is room, so no record is ever dropped.
+    The writer takes all the records waiting (up to batch_size) at once, and flushes each handler once per batch."""
+    def __init__(self, max_queued_records=10000, batch_size=500):
+        self.queue = queue.Queue(max_queued_records)
+        self.batch_size = batch_size
+        self.thread = threading.Thread(target=self.run, name='BackgroundLogWriter')
+        self.thread.daemon = True  # flush() or stop() must be called before exiting, or queued records are lost
+        self.thread.start()
+
+    def put(self, handlers, record):
+        self.queue.put((handlers, record))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self.write_batch(batch)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+            if any(item is None for item in batch):
+                return
+
+    @staticmethod
+    def write_batch(batch):
+        records_by_handler = OrderedDict()
+        for item in batch:
+            if item is not None:
+                (handlers, record) = item
+                for handler in handlers:
+                    records_by_handler.setdefault(handler, []).append(record)
+        for handler, records in records_by_handler.items():
+            if isinstance(handler, logging.StreamHandler) and (handler.stream is not None):  # Includes FileHandlers
+                # As StreamHandler.emit(), but flushing once for the whole batch
+                handler.acquire()
+                try:
+                    for record in records:
+                        if (record.levelno >= handler.level) and handler.filter(record):
+                            try:
+                                handler.stream.write(handler.format(record) + handler.terminator)
+                            except Exception:
+                                handler.handleError(record)
+                    handler.flush()
+                finally:
+                    handler.release()
+            else:
+                for record in records:
+                    handler.handle(record)
+
+    def flush(self):
+        """Waits until every record queued so far has been written"""
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class BackgroundLogHandler(logging.Handler):
+    """Takes the place of a LogController's handlers while background logging is on, queueing each record for them"""
+    def __init__(self, log_writer, target_handlers):
+        super().__init__()
+        self.log_writer = log_writer
+        self.target_handlers = target_handlers
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record):
+        try:
+            # The message is rendered now, in the logging thread, while its arguments (eg emails) are as they were
+            record.msg = self.format(record)
+            record.args = None
+            record.exc_info = None
+            record.exc_text = None
+            record.stack_info = None
+            self.log_writer.put(list(self.target_handlers), record)
+        except Exception:
+            self.handleError(record)
+
+
 class LogController():
     debug_this_class = False
     """Wraps around the standard Logger class, and builds logs the way we want to."""
     def __init__(self, name, log_level=10, filepath=None, console=False):
         # Sets up a new logger, and sets it to Null by default
         self.name = name
+        self.background_handler = None
         self.formatter_default = self.get_formatter_plainmsg()
         self.handler_null = logging.NullHandler()
         if console and console_colours:
@@ -65,7 +160,7 @@ class LogController():
         self.handler_console = self.get_handler_console()
         self.formatter = self.get_formatter_console()
         self.handler_console.setFormatter(self.formatter)
-        self.logger.addHandler(self.handler_console)
+        self.add_handler(self.handler_console)
         if self.debug_this_class:
             print("Log controller set to console; Controller name: ", self.name)
 
@@ -75,6 +170,41 @@ class LogController():
         if self.debug_this_class:
             print("Log controller level changed; Controller name: ", self.name, " New level is ", self.log_level)
 
+    def add_handler(self, handler):
+        if self.background_handler is not None:
+            self.background_handler.target_handlers.append(handler)
+        else:
+            self.logger.addHandler(handler)
+
+    def get_output_handlers(self):
+        if self.background_handler is not None:
+            return self.background_handler.target_handlers
+        return [handler for handler in self.logger.handlers if not isinstance(handler, logging.NullHandler)]
+
+    def get_output_level(self):
+        """The lowest level of message this controller actually outputs, or None if it has nowhere to output to"""
+        if len(self.get_output_handlers()) == 0:
+            return None
+        return self.logger.getEffectiveLevel()
+
+    def start_background_logging(self, log_writer):
+        """Moves this controller's handlers behind a BackgroundLogHandler, which queues records for log_writer"""
+        if self.background_handler is not None:
+            return
+        target_handlers = self.get_output_handlers()
+        for handler in target_handlers:
+            self.logger.removeHandler(handler)
+        self.background_handler = BackgroundLogHandler(log_writer, target_handlers)
+        self.logger.addHandler(self.background_handler)
+
+    def stop_background_logging(self):
+        if self.background_handler is None:
+            return
+        (background_handler, self.background_handler) = (self.background_handler, None)
+        self.logger.removeHandler(background_handler)
+        for handler in background_handler.target_handlers:
+            self.logger.addHandler(handler)
+
     def add_logfile(self, filepath, append=False, formatter=None, die_if_file_fails=False):
         """Enables output from this LogController to a filename"""
         self.filepath = filepath
@@ -88,7 +218,7 @@ class LogController():
             if new_handler is not None:
                 self.handler_file = new_handler
                 self.handler_file.setFormatter(self.formatter_file)
-                self.logger.addHandler(self.handler_file)
+                self.add_handler(self.handler_file)
         except:
             if die_if_file_fails:
                 print('FATAL: Died when opening log file: %s' % filepath)
@@ -120,9 +250,37 @@ class LogController():
         return new_handler
 
 
+class LazyLogArg():
+    """A log message argument that is only worked out if the message is actually output (eg a long list of email
+    details), by calling func(*args, **kwargs). The result is kept, as each log controller formats the message."""
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        try:
+            return self.rendered
+        except AttributeError:
+            self.rendered = str(self.func(*self.args, **self.kwargs))
+        return self.rendered
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class LogMaster(metaclass=Singleton):
-    """Provides unified console and file logging for whole app"""
+    """Provides unified console and file logging for whole app
+
+    min_log_level is the lowest level any log controller outputs, worked out again whenever levels or log files
+    change. Lower-level messages are dropped straight away, and hot code can check debug_enabled, ultra_debug_enabled
+    or insane_debug_enabled before logging (so disabled debug logging costs one attribute check)."""
     debug_this_class = False
+    log_writer = None  # The BackgroundLogWriter, while background logging is on
+    min_log_level = 0
+    debug_enabled = True
+    ultra_debug_enabled = True
+    insane_debug_enabled = True
     name_console = 'console'
     name_logfile = 'logfile'
     name_debugfile = 'debugfile'
@@ -134,9 +292,53 @@ class LogMaster(metaclass=Singleton):
     if debug_this_class:
         print('New log controllers established: ', log_controllers)
 
+    @classmethod
+    def update_min_log_level(cls):
+        output_levels = [level for level in (log_controller.get_output_level() for log_controller in cls.log_controllers.values())
+            if level is not None]
+        cls.min_log_level = min(output_levels) if len(output_levels) > 0 else logging.CRITICAL + 1
+        cls.debug_enabled = cls.is_enabled_for(10)
+        cls.ultra_debug_enabled = cls.is_enabled_for(8)
+        cls.insane_debug_enabled = cls.is_enabled_for(5)
+        if cls.debug_this_class:
+            print('Minimum log level across all log controllers is now: ', cls.min_log_level)
+
+    @classmethod
+    def is_enabled_for(cls, lvl):
+        return (lvl >= cls.min_log_level)
+
+    # Background logging: console and log file output is written by a background thread
+    @classmethod
+    def start_background_logging(cls, max_queued_records=10000):
+        if cls.log_writer is not None:
+            return
+        cls.log_writer = BackgroundLogWriter(max_queued_records)
+        for log_controller in cls.log_controllers.values():
+            log_controller.start_background_logging(cls.log_writer)
+        atexit.register(cls.stop_background_logging)
+
+    @classmethod
+    def flush(cls):
+        """Waits until everything logged so far has been written out (only needed for background logging)"""
+        if cls.log_writer is not None:
+            cls.log_writer.flush()
+
+    @classmethod
+    def stop_background_logging(cls):
+        """Writes out everything still queued, then goes back to writing log output straight away"""
+        if cls.log_writer is None:
+            return
+        (log_writer, cls.log_writer) = (cls.log_writer, None)
+        log_writer.flush()  # So that nothing logged from now on is written before what is already queued
+        for log_controller in cls.log_controllers.values():
+            log_controller.stop_background_logging()
+        log_writer.stop()
+
     # General Methods to operate on all log_controllers
     @classmethod
     def log(cls, lvl, msg, *args, **kwargs):
+        if lvl < cls.min_log_level:
+            return
         for log_controller in cls.log_controllers.values():
             if cls.debug_this_class:
                 print('Now logging a message for controller. Name: ', log_controller.name, ", msg: ", msg, str(*args), str(**kwargs))
@@ -144,11 +346,15 @@ class LogMaster(metaclass=Singleton):
 
     @classmethod
     def debug(cls, msg, *args, **kwargs):
+        if not cls.debug_enabled:
+            return
         for log_controller in cls.log_controllers.values():
             log_controller.logger.debug(msg, *args, **kwargs)
 
     @classmethod
     def info(cls, msg, *args, **kwargs):
+        if 20 < cls.min_log_level:
+            return
         for log_controller in cls.log_controllers.values():
             log_controller.logger.info(msg, *args, **kwargs)
 
@@ -174,10 +380,14 @@ class LogMaster(metaclass=Singleton):
 
     @classmethod
     def ultra_debug(cls, msg, *args, **kwargs):
+        if not cls.ultra_debug_enabled:
+            return
         cls.log(8, '*UltraDebug :: ' + msg, *args, **kwargs)
 
     @classmethod
     def insane_debug(cls, msg, *args, **kwargs):
+        if not cls.insane_debug_enabled:
+            return
         cls.log(5, '*InsaneDebug:: ' + msg, *args, **kwargs)
 
     # Methods to operate on specific log_controllers
@@ -197,6 +407,7 @@ class LogMaster(metaclass=Singleton):
     @classmethod
     def _set_loglevel_namedcontr(cls, contr_name, log_level):
         cls.log_controllers[contr_name].logger.setLevel(log_level)
+        cls.update_min_log_level()
 
     @classmethod
     def _log_to_namedcontr(cls, contr_name, lvl, msg, *args, **kwargs):
@@ -208,6 +419,7 @@ class LogMaster(metaclass=Singleton):
             print ('Now adding new log file handler to log file output.')
             print ('  Log controller: ', contr_name, '. Logfile path:', filepath)
         cls.log_controllers[contr_name].add_logfile(filepath, append, formatter, die_if_file_fails)
+        cls.update_min_log_level()
 
     # Methods to set up specific log_controllers
     @classmethod
@@ -231,6 +443,9 @@ class LogMaster(metaclass=Singleton):
         cls._add_logfile_to_namedcontr(cls.name_debugfile, *args, **kwargs)
 
 
+LogMaster.update_min_log_level()
+
+
 def add_log_files_from_config(config):
     """Add all of the logging config from config files and enacts them on the LogMaster object"""
 
@@ -273,6 +488,10 @@ def add_log_files_from_config(config):
         LogMaster.log_to_logfile(50, get_logfile_headers(config, 'Output Log File'))
         LogMaster.info('New LogFile added, path: %s', settings_logfile.log_fullpath)
 
+    if config['log_in_background']:
+        LogMaster.start_background_logging(config['log_background_max_queued_records'])
+        LogMaster.debug('Background logging started: console and log file output is now written by a background thread.')
+
 
 
 # log_levels = OrderedDict([
@@ -1,73 +1,99 @@
-from modules.logging import LogMaster
-from modules.models.RuleMatches import Match
+import queue
+import threading
+from modules.logging import LogMaster, LazyLogArg
+from modules.models.RuleMatches import Match, MatchBody
+from modules.models.Rules import Rules
 from modules.email.supportingfunctions_email import convert_bytes_to_utf8
 from modules.email.supportingfunctions_email import get_extended_email_headers_for_logging, get_basic_email_headers_for_logging
 from modules.supportingfunctions import strip_quotes
+from modules.models.RuleActions import Action, ActionForwardEmail
+from modules.search_planner import compile_search_criteria, join_or
+from modules.match_ordering import AdaptiveMatchOrdering
+from modules.rule_index import iterate_candidate_rules
+from modules.email.IMAPServerConnection import IMAPServerConnection
+import modules.email.smtp_send as smtp_send
+from modules.settings.default_counters_and_timers import create_default_rule_counters
 
 
 def check_match_list(matches, email_to_validate):
+    log_ultra_debug = LogMaster.ultra_debug_enabled  # This is checked for every email against every rule
     num_required_matches = len(matches)
     num_actual_matches = 0
 
     if num_required_matches == 0:
-        LogMaster.ultra_debug('Zero matches required for this rule - rule invalid, not attempting.')
+        if log_ultra_debug:
+            LogMaster.ultra_debug('Zero matches required for this rule - rule invalid, not attempting.')
         return False
 
     for match_check in matches:
         if isinstance(match_check, list):  # Then we know this is an 'OR' clause, and match on any of these
-            LogMaster.ultra_debug('Email matching is now in \'or\' clause.')
+            if log_ultra_debug:
+                LogMaster.ultra_debug('Email matching is now in \'or\' clause.')
             matched_or = False
             for match_or in match_check:
-                if match_or.test_match_email(email_to_validate):
+                if match_or.test_match_email_cached(email_to_validate):
                     matched_or = True
                     num_actual_matches += 1
-                    LogMaster.ultra_debug('Email \'or\' is now matched, continuing.')
+                    if log_ultra_debug:
+                        LogMaster.ultra_debug('Email \'or\' is now matched, continuing.')
                     break  # Stop counting
             else:
-                LogMaster.ultra_debug('Email \'or\' is unmatched; matching over.')
+                if log_ultra_debug:
+                    LogMaster.ultra_debug('Email \'or\' is unmatched; matching over.')
 
         elif (isinstance(match_check, Match)):
-            LogMaster.ultra_debug('Email matching is now a match Match ID %s, of type %s.',
-                match_check.id, match_check.__class__.__name__)
-            if match_check.test_match_email(email_to_validate):
-                LogMaster.ultra_debug('Email matched this field; continuing matching.')
+            if log_ultra_debug:
+                LogMaster.ultra_debug('Email matching is now a match Match ID %s, of type %s.',
+                    match_check.id, match_check.__class__.__name__)
+            if match_check.test_match_email_cached(email_to_validate):
+                if log_ultra_debug:
+                    LogMaster.ultra_debug('Email matched this field; continuing matching.')
                 num_actual_matches += 1
             else:
-                LogMaster.ultra_debug('Email did not match this field.')
+                if log_ultra_debug:
+                    LogMaster.ultra_debug('Email did not match this field.')
                 break
-        else:
+        elif log_ultra_debug:
             LogMaster.ultra_debug('Match ID %s is neither of type Match nor List. Is actually type: %s.', match_check.id, type(match_check))
 
     if num_actual_matches == num_required_matches:
-        LogMaster.ultra_debug('Email matched. Num matches required: %s, num matches found: %s', num_required_matches, num_actual_matches)
+        if log_ultra_debug:
+            LogMaster.ultra_debug('Email matched. Num matches required: %s, num matches found: %s', num_required_matches, num_actual_matches)
         return True
     else:
-        LogMaster.ultra_debug('Email unmatched. Num matches required: %s, num matches found: %s', num_required_matches, num_actual_matches)
+        if log_ultra_debug:
+            LogMaster.ultra_debug('Email unmatched. Num matches required: %s, num matches found: %s', num_required_matches, num_actual_matches)
         return False
 
 
 def check_email_against_rule(rule, email_to_validate):
     email_matched = False
     email_excepted = False
+    log_insane_debug = LogMaster.insane_debug_enabled
+    AdaptiveMatchOrdering.reorder_if_due(rule)
     # First we check each match, to see if they all match
     # If not matched, exit this rule and onto the next
     if not (check_match_list(rule.get_matches(), email_to_validate)):
-        LogMaster.insane_debug('Now checking Rule ID %s: not matched', rule.id)
+        if log_insane_debug:
+            LogMaster.insane_debug('Now checking Rule ID %s: not matched', rule.id)
     else:
-        LogMaster.insane_debug('Now checking Rule ID %s: matched against all criteria', rule.id)
+        if log_insane_debug:
+            LogMaster.insane_debug('Now checking Rule ID %s: matched against all criteria', rule.id)
         email_matched = True
 
     if (email_matched):
         # Now we see if the exceptions apply
-        LogMaster.insane_debug('Now checking Rule ID %s against match exceptions', rule.id)
+        if log_insane_debug:
+            LogMaster.insane_debug('Now checking Rule ID %s against match exceptions', rule.id)
         # If so, exit this rule and onto the next
         if len(rule.get_match_exceptions()) != 0:
             if (check_match_list(rule.match_exceptions, email_to_validate)):
-                LogMaster.insane_debug('Valid exception(s) found. Rule ID %s was matched, but also excepted', rule.id)
+                if log_insane_debug:
+                    LogMaster.insane_debug('Valid exception(s) found. Rule ID %s was matched, but also excepted', rule.id)
                 email_excepted = True
-            else:
+            elif log_insane_debug:
                 LogMaster.insane_debug('Exceptions not matched on Rule ID %s', rule.id)
-        else:
+        elif log_insane_debug:
             LogMaster.insane_debug('Skipping exception checking: No exceptions in Rule ID %s.', rule.id)
 
         if (email_excepted):
@@ -94,7 +120,7 @@ def perform_actions(imap_connection, config, rule, email_to_validate, counters):
 
         counters.incr('actions_taken')
         action_to_perform.perform_action(email_to_action=email_to_validate, config=config,
-            imap_connection=imap_connection, LogMaster=LogMaster)
+            imap_connection=imap_connection, LogMaster=LogMaster, counters=counters)
 
     for action_to_perform in rule.actions:
         action_type = action_to_perform.action_type
@@ -110,16 +136,33 @@ def perform_actions(imap_connection, config, rule, email_to_validate, counters):
 
         counters.incr('actions_taken')
         action_to_perform.perform_action(email_to_action=email_to_validate, config=config,
-            imap_connection=imap_connection, LogMaster=LogMaster)
-        break  # Email gone now, no more actions
+            imap_connection=imap_connection, LogMaster=LogMaster, counters=counters)
+        return action_to_perform.actually_perform_actions()  # Email gone now, no more actions
 
+    return False
 
-def check_email_against_rules_and_perform_actions(imap_connection, config, rules, email_to_validate, counters):
+
+def send_forward_digests(config, rules, counters):
+    """Sends the emails waiting in the digests of the rules' digest Forward actions"""
     for rule in rules:
+        for action in rule.actions:
+            if isinstance(action, ActionForwardEmail) and action.digest:
+                action.send_digest(config, counters)
+
+
+def check_email_against_rules_and_perform_actions(imap_connection, config, rules, email_to_validate, counters):
+    """Returns True if a destructive action (move or delete) has removed the email from the current folder.
+
+    No more rules are checked against the email once a matched rule has moved or deleted it, or once a matched rule
+    is set not to continue rule checks (continue_rule_checks_if_matched)."""
+    email_removed = False
+    candidate_rules = iterate_candidate_rules(rules, email_to_validate)
+    for rule in candidate_rules:
         email_matched = False
         email_actioned = False
 
-        LogMaster.ultra_debug('Now checking Email UID %s against Rule ID %s (Rule Name: \"%s\"")', email_to_validate.uid_str, rule.id, rule.name)
+        if LogMaster.ultra_debug_enabled:
+            LogMaster.ultra_debug('Now checking Email UID %s against Rule ID %s (Rule Name: \"%s\"")', email_to_validate.uid_str, rule.id, rule.name)
 
         if len(rule.get_matches()) == 0:
             LogMaster.ultra_debug('Zero matches required for Rule %s - rule invalid, not attempting.', rule.id)
@@ -134,31 +177,280 @@ def check_email_against_rules_and_perform_actions(imap_connection, config, rules
 
         if (email_matched):
             LogMaster.info('Now performing all actions for Rule ID %s', rule.id)
-            perform_actions(imap_connection, config, rule, email_to_validate, counters)
+            if perform_actions(imap_connection, config, rule, email_to_validate, counters):
+                email_removed = True
+            elif Action.actually_perform_actions():
+                # The actions may have changed the email's flags (eg marked it as read), so later rules see the new flags
+                refresh_email_flags(imap_connection, email_to_validate)
+                reset_match_results(email_to_validate)
             counters.incr('emails_matched')
+            if rule_has_destructive_action(rule):
+                # Even if actions aren't actually performed, so that the same rules are checked as would be otherwise
+                LogMaster.debug('Rule ID %s has moved or deleted Email UID %s, so no further rules will be checked against it.',
+                    rule.id, email_to_validate.uid_str)
+                break
+            if not rule.get_continue_rule_checks_if_matched():
+                LogMaster.debug('Rule ID %s matched, and is set not to continue rule checks, so no further rules will be '
+                    'checked against Email UID %s.', rule.id, email_to_validate.uid_str)
+                break
         else:
             LogMaster.debug('Rule ID %s not matched, ignoring.', rule.id)
 
+    # Count the rule checks saved by stopping early (the candidate rules not yet checked)
+    counters.incr('rule_checks_skipped', sum(1 for rule in candidate_rules if rule_is_checkable(rule)))
+    return email_removed
+
+
+def refresh_email_flags(imap_connection, email_to_validate):
+    """Updates the email's flags with the changes its actions have made: queued ones, or (if actions aren't batched,
+    so have been sent already) the flags now on the server"""
+    if imap_connection.action_queue.batch_actions:
+        imap_connection.action_queue.apply_queued_flags(email_to_validate)
+    else:
+        email_to_validate.imap_flags = imap_connection.get_imap_flags_byuid(email_to_validate.uid)
+        email_to_validate.is_read = imap_connection.is_email_currently_read_fromflags(email_to_validate.imap_flags)
+
+
+def rule_has_destructive_action(rule):
+    return any(action.is_destructive() for action in rule.get_actions())
+
+
+def rule_is_checkable(rule):
+    return (len(rule.get_matches()) > 0) and (len(rule.get_actions()) > 0)
+
+
+def reset_match_results(email_to_validate, match_class=Match):
+    """Forgets the email's cached results for Matches of match_class (by default, all of them)"""
+    match_results = getattr(email_to_validate, 'match_results', None)
+    if match_results is None:
+        return
+    for match in [match for match in match_results if isinstance(match, match_class)]:
+        del match_results[match]
+
+
+def check_match_on_metadata(match, email_metadata):
+    """Returns the result of a Match if it only needs IMAP metadata, or None if it needs the email's headers/body"""
+    if isinstance(match, list):  # Then we know this is an 'OR' clause
+        or_result = False
+        for match_or in match:
+            match_result = check_match_on_metadata(match_or, email_metadata)
+            if match_result:
+                return True
+            elif match_result is None:
+                or_result = None
+        return or_result
+    elif isinstance(match, Match) and match.is_metadata_only():
+        return match.test_match_email(email_metadata)
+    return None
+
+
+def rule_could_match_metadata(rule, email_metadata):
+    """False if the rule's metadata-only Matches already rule the email out; otherwise the email must be fully checked"""
+    if (len(rule.get_matches()) == 0) or (len(rule.get_actions()) == 0):
+        return False  # Invalid rules are never checked
+    for match in rule.get_matches():
+        if check_match_on_metadata(match, email_metadata) is False:
+            return False
+    return True
+
+
+def rules_can_be_prefiltered_on_metadata(rules):
+    """True if every valid rule has a required Match that only needs IMAP metadata"""
+    for rule in rules:
+        if (len(rule.get_matches()) == 0) or (len(rule.get_actions()) == 0):
+            continue
+        for match in rule.get_matches():
+            match_list = match if isinstance(match, list) else [match]
+            if (len(match_list) > 0) and all((isinstance(match_or, Match) and match_or.is_metadata_only()) for match_or in match_list):
+                break
+        else:
+            return False
+    return True
+
+
+def prefilter_uids_on_metadata(imap_connection, config, rules_list, counters, uid_list):
+    """Phase one of fetching: fetches only size, flags & INTERNALDATE, and returns the uids that a rule in one of
+    the rule sets could still match. Only these emails go on to the (more expensive) header/body fetch."""
+    if (not config['imap_metadata_prefilter']) or (len(uid_list) == 0):
+        return uid_list
+    if not all(rules_can_be_prefiltered_on_metadata(rules) for rules in rules_list):
+        return uid_list
+
+    email_metadata = imap_connection.get_email_metadata_byuids(uid_list)
+    remaining_uids = []
+    for uid in uid_list:
+        metadata = email_metadata.get(convert_bytes_to_utf8(uid))
+        if metadata is None:
+            remaining_uids.append(uid)  # Let the full fetch deal with it
+            continue
+        counters.incr('emails_metadata_checked')
+        if any(rule_could_match_metadata(rule, metadata) for rules in rules_list for rule in rules):
+            remaining_uids.append(uid)
+        else:
+            LogMaster.ultra_debug('Email UID %s ruled out by IMAP metadata, so will not be fetched: %s', metadata.uid_str, metadata)
+            counters.incr('emails_metadata_excluded')
+    LogMaster.debug('IMAP metadata check: %s of %s emails in folder \"%s\" still need to be fully checked.',
+        len(remaining_uids), len(uid_list), imap_connection.get_currfolder())
+    return remaining_uids
+
+
+def get_emails_for_rules(imap_connection, config, rules_list, counters, uid_list, headers_only=False, partial_body=None):
+    """Returns parsed emails for the uids that the rule sets in rules_list could match, checking IMAP metadata first"""
+    uid_list = prefilter_uids_on_metadata(imap_connection, config, rules_list, counters, uid_list)
+    return imap_connection.get_emails_byuids(uid_list, headers_only, partial_body)
+
+
+def get_search_criteria_for_rules(config, rules):
+    """Returns an IMAP SEARCH query to prefilter emails for this rule set, or None to check all emails"""
+    if not config['imap_search_pushdown']:
+        return None
+    return compile_search_criteria(rules)
+
+
+def get_headers_only_fetch_mode(config, folder_type):
+    """Returns headers_only for fetching emails for a rule set ('main_folder' or 'all_folders'):
+    False (whole emails), True (all headers), or a tuple of the only header field names the rules need"""
+    if not config['imap_headers_only_for_%s' % folder_type]:
+        return False
+    if config['imap_header_fields_for_%s' % folder_type] is None:
+        return True
+    return config['imap_header_fields_for_%s' % folder_type]
+
+
+def combine_headers_only_fetch_modes(*headers_only_list):
+    """Returns the headers_only fetch mode that gives every rule set what it needs"""
+    if not all(headers_only_list):
+        return False
+    if any((headers_only is True) for headers_only in headers_only_list):
+        return True
+    header_fields = []
+    for headers_only in headers_only_list:
+        header_fields.extend(field_name for field_name in headers_only if field_name not in header_fields)
+    return tuple(header_fields)
+
+
+def get_partial_body_fetch_mode(config, folder_type):
+    """Returns partial_body for fetching emails for a rule set: None (whole emails), or the maximum number of bytes
+    of body text to fetch (0 for no maximum)"""
+    if not config['imap_partial_body_for_%s' % folder_type]:
+        return None
+    return config['imap_partial_body_max_bytes_for_%s' % folder_type]
+
+
+def combine_partial_body_fetch_modes(config, *folder_types):
+    """Returns the partial_body fetch mode that gives every rule set that needs the body what it needs"""
+    max_bytes_list = [get_partial_body_fetch_mode(config, folder_type) for folder_type in folder_types
+        if not get_headers_only_fetch_mode(config, folder_type)]
+    if (len(max_bytes_list) == 0) or (None in max_bytes_list):
+        return None
+    if 0 in max_bytes_list:
+        return 0
+    return max(max_bytes_list)
+
+
+def get_uid_range_search_criteria(first_uid, last_uid=None, search_criteria=None):
+    """Returns an IMAP SEARCH query limited to a UID range; last_uid=None means no upper limit"""
+    uid_range = 'UID %s:%s' % (first_uid, last_uid if last_uid is not None else '*')
+    if search_criteria is None:
+        return uid_range
+    return '%s %s' % (uid_range, search_criteria)
+
 
-def iterate_rules_over_mailfolder(imap_connection, config, rules, counters, headers_only=False):
+def iterate_rules_over_mailfolder(imap_connection, config, rules, counters, headers_only=False, search_criteria=None,
+        checkpoints=None, partial_body=None):
     LogMaster.log(40, 'Now commencing iteration of Rules over all emails in folder {0}'.format(
         imap_connection.currfolder_name
     ))
 
-    for email_to_validate in imap_connection.get_emails_in_currfolder(headers_only):
+    if checkpoints is not None:
+        iterate_rules_over_mailfolder_incrementally(imap_connection, config, rules, counters, headers_only,
+            search_criteria, checkpoints, partial_body)
+    else:
+        iterate_rules_over_emails(imap_connection, config, rules, counters,
+            get_emails_for_rules(imap_connection, config, [rules], counters,
+                imap_connection.get_list_uids_in_currfolder(search_criteria or "ALL"), headers_only, partial_body))
+    imap_connection.flush_queued_actions()
+
+
+def iterate_rules_over_mailfolder_incrementally(imap_connection, config, rules, counters, headers_only, search_criteria,
+        checkpoints, partial_body=None):
+    """Only checks emails that have arrived since the last run, as recorded in the folder checkpoints.
+
+    Rules set for a periodic full sweep are also checked against older emails, once every sweep interval.
+    On CONDSTORE servers, rules that depend on IMAP flags are also checked against older emails whose
+    flags have changed since the last run."""
+    folder_name = imap_connection.get_currfolder()
+    uidvalidity = imap_connection.get_currfolder_uidvalidity()
+    if uidvalidity is None:
+        LogMaster.info('IMAP Server did not report UIDVALIDITY for folder \"%s\", so all emails will be checked.', folder_name)
+        return iterate_rules_over_emails(imap_connection, config, rules, counters,
+            get_emails_for_rules(imap_connection, config, [rules], counters,
+                imap_connection.get_list_uids_in_currfolder(search_criteria or "ALL"), headers_only, partial_body))
+
+    last_uid = checkpoints.get_last_uid(rules.name, folder_name, uidvalidity)
+    highest_uid = imap_connection.get_currfolder_highest_uid()
+    LogMaster.debug('Folder \"%s\" checkpoint for rule set \"%s\": UIDVALIDITY %s, last processed UID %s, highest UID %s',
+        folder_name, rules.name, uidvalidity, last_uid, highest_uid)
+
+    full_sweep_rules = Rules(rule for rule in rules if rule.get_periodic_full_sweep())
+    if (last_uid > 0) and (len(full_sweep_rules) > 0) and \
+            checkpoints.full_sweep_is_due(rules.name, folder_name, config['incremental_full_sweep_interval_days']):
+        LogMaster.info('Full sweep is due for folder \"%s\": now checking %s rule(s) against previously-checked emails.',
+            folder_name, len(full_sweep_rules))
+        old_uids = imap_connection.get_list_uids_in_currfolder(
+            get_uid_range_search_criteria(1, last_uid, get_search_criteria_for_rules(config, full_sweep_rules)))
+        iterate_rules_over_emails(imap_connection, config, full_sweep_rules, counters,
+            get_emails_for_rules(imap_connection, config, [full_sweep_rules], counters, old_uids, headers_only, partial_body))
+        checkpoints.set_full_sweep_done(rules.name, folder_name, uidvalidity)
+
+    last_highestmodseq = checkpoints.get_highestmodseq(rules.name, folder_name, uidvalidity)
+    highestmodseq = imap_connection.get_currfolder_highestmodseq()
+    flag_dependent_rules = Rules(rule for rule in rules if rule.depends_on_imap_flags())
+    if (last_uid > 0) and (len(flag_dependent_rules) > 0):
+        if (last_highestmodseq is None) or (highestmodseq is None):
+            LogMaster.debug('Flag changes in folder \"%s\" cannot be tracked (no CONDSTORE/HIGHESTMODSEQ), '
+                'so only new emails are checked against flag-based rules.', folder_name)
+        elif highestmodseq > last_highestmodseq:
+            changed_uids = imap_connection.get_list_changed_uids_in_currfolder(last_uid, last_highestmodseq)
+            LogMaster.info('%s previously-checked email(s) in folder \"%s\" have changed flags; now checking %s flag-based rule(s).',
+                len(changed_uids), folder_name, len(flag_dependent_rules))
+            iterate_rules_over_emails(imap_connection, config, flag_dependent_rules, counters,
+                get_emails_for_rules(imap_connection, config, [flag_dependent_rules], counters, changed_uids, headers_only,
+                    partial_body))
+
+    if (highest_uid is not None) and (highest_uid <= last_uid):
+        LogMaster.info('No new emails in folder \"%s\" since last run.', folder_name)
+        new_uids = []
+    else:
+        # Only up to the highest UID when the folder was selected, which is what the checkpoint records: emails arriving
+        # since are left for the next run. NB: "UID n:*" always includes the highest UID in the folder, even if it is less than n
+        new_uids = [uid for uid in imap_connection.get_list_uids_in_currfolder(
+            get_uid_range_search_criteria(last_uid + 1, highest_uid, search_criteria))
+            if (int(uid) > last_uid) and ((highest_uid is None) or (int(uid) <= highest_uid))]
+    iterate_rules_over_emails(imap_connection, config, rules, counters,
+        get_emails_for_rules(imap_connection, config, [rules], counters, new_uids, headers_only, partial_body))
+
+    if highest_uid is None:
+        highest_uid = max([last_uid] + [int(uid) for uid in new_uids])
+    if highestmodseq is not None:
+        # Re-read once this run's own actions have been sent, so that the emails they changed aren't seen as changed next run
+        imap_connection.flush_queued_actions()
+        highestmodseq = imap_connection.refresh_currfolder_highestmodseq()
+    checkpoints.set_last_uid(rules.name, folder_name, uidvalidity, max(last_uid, highest_uid))
+    checkpoints.set_highestmodseq(rules.name, folder_name, uidvalidity, highestmodseq)
+    checkpoints.save()
+
+
+def iterate_rules_over_emails(imap_connection, config, rules, counters, emails_to_validate):
+    for email_to_validate in emails_to_validate:
         if email_to_validate is None:
             continue
-        LogMaster.info('Email UID %s found in IMAP folder (\"%s\"). Email Date: %s; From: %s',
-            email_to_validate.uid_str,
-            imap_connection.get_currfolder(),
-            email_to_validate.date_datetime,
-            email_to_validate.addr_from
-        )
-
-        LogMaster.debug('Now assessing this email against all rules.')
-        LogMaster.ultra_debug('Extended Email Details for UID %s:\n%s',
-            email_to_validate.uid_str,
-            get_extended_email_headers_for_logging(email_to_validate))
+        if imap_connection.action_queue.is_removed(email_to_validate.uid):
+            LogMaster.debug('Email UID %s is already queued to be moved or deleted, so will not be checked again.',
+                email_to_validate.uid_str)
+            continue
+        imap_connection.action_queue.apply_queued_flags(email_to_validate)
+        log_email_found(imap_connection, email_to_validate)
 
         counters.incr('emails_seen')
         check_email_against_rules_and_perform_actions(imap_connection, config, rules, email_to_validate, counters)
@@ -166,7 +458,72 @@ def iterate_rules_over_mailfolder(imap_connection, config, rules, counters, head
         LogMaster.debug('Completed assessment of all rules against this email.\n')
 
 
-def iterate_rules_over_mainfolder(imap_connection, config, rules, counters):
+def iterate_rules_over_emails_for_both_rule_sets(imap_connection, config, rules, counters, rules_allfolders, counters_allfolders,
+        emails_to_validate):
+    """Checks each email against the main folder rules, then (if still in the folder) against the All Folders rules.
+
+    As long as the All Folders rules don't depend on IMAP flags (see can_check_allfolders_rules_in_mainfolder_pass),
+    this gives the same results as checking the main folder rules against every email first, then the All Folders
+    rules, but each email is only fetched once."""
+    for email_to_validate in emails_to_validate:
+        if email_to_validate is None:
+            continue
+        if imap_connection.action_queue.is_removed(email_to_validate.uid):
+            LogMaster.debug('Email UID %s is already queued to be moved or deleted, so will not be checked again.',
+                email_to_validate.uid_str)
+            continue
+        imap_connection.action_queue.apply_queued_flags(email_to_validate)
+        log_email_found(imap_connection, email_to_validate)
+
+        counters.incr('emails_seen')
+        if check_email_against_rules_and_perform_actions(imap_connection, config, rules, email_to_validate, counters):
+            LogMaster.debug('Email UID %s was removed from this folder by the Main Folder rules, so the All Folders rules '
+                'will not be checked against it here.\n', email_to_validate.uid_str)
+            continue
+
+        # Any flag changes by the main folder rules' actions have already been applied to the email
+        # The All Folders rules would normally only see the body if it is downloaded for them
+        hide_body = config['imap_headers_only_for_all_folders']
+        if hide_body:
+            # Only keep the body if it has been decoded already; otherwise it can still be decoded later if needed
+            email_body = email_to_validate.body if email_to_validate.is_field_worked_out('body') else None
+            email_to_validate.body = ''
+            reset_match_results(email_to_validate, MatchBody)
+
+        LogMaster.debug('Now assessing this email against all All Folders rules.')
+        counters_allfolders.incr('emails_seen')
+        check_email_against_rules_and_perform_actions(imap_connection, config, rules_allfolders, email_to_validate,
+            counters_allfolders)
+
+        if hide_body:
+            del email_to_validate.body
+            if email_body is not None:
+                email_to_validate.body = email_body
+
+        LogMaster.debug('Completed assessment of all rules against this email.\n')
+
+
+def log_email_found(imap_connection, email_to_validate):
+    # The email's date and From address are only worked out if the message is output (see EmailView)
+    LogMaster.info('Email UID %s found in IMAP folder (\"%s\"). Email Date: %s; From: %s',
+        email_to_validate.uid_str,
+        imap_connection.get_currfolder(),
+        LazyLogArg(getattr, email_to_validate, 'date_datetime'),
+        LazyLogArg(getattr, email_to_validate, 'addr_from')
+    )
+
+    LogMaster.debug('Now assessing this email against all rules.')
+    LogMaster.ultra_debug('Extended Email Details for UID %s:\n%s',
+        email_to_validate.uid_str,
+        LazyLogArg(get_extended_email_headers_for_logging, email_to_validate))
+
+
+def iterate_rules_over_mainfolder(imap_connection, config, rules, counters, checkpoints=None, rules_allfolders=None,
+        counters_allfolders=None):
+    """Checks the main folder rules against the main folder.
+
+    If rules_allfolders are given and can be checked in the same pass, they are checked against each email too,
+    and True is returned so that the All Folders pass can skip the main folder."""
     LogMaster.log(40, 'Now commencing iteration of Rules over all emails in Main folder')
 
     if (not config['assess_rules_againt_mainfolder']):
@@ -182,10 +539,52 @@ def iterate_rules_over_mainfolder(imap_connection, config, rules, counters):
         return None
 
     counters.incr('folders_processed')
-    return iterate_rules_over_mailfolder(imap_connection, config, rules, counters, headers_only=config['imap_headers_only_for_main_folder'])
+    if can_check_allfolders_rules_in_mainfolder_pass(config, rules_allfolders, counters_allfolders, checkpoints):
+        LogMaster.info('Main Folder and All Folders rules will be checked in a single pass over the Main folder.')
+        counters_allfolders.incr('folders_processed')
+        search_criteria = combine_search_criteria(get_search_criteria_for_rules(config, rules),
+            get_search_criteria_for_rules(config, rules_allfolders))
+        iterate_rules_over_emails_for_both_rule_sets(imap_connection, config, rules, counters, rules_allfolders,
+            counters_allfolders, get_emails_for_rules(imap_connection, config, [rules, rules_allfolders], counters,
+                imap_connection.get_list_uids_in_currfolder(search_criteria or "ALL"),
+                headers_only=combine_headers_only_fetch_modes(get_headers_only_fetch_mode(config, 'main_folder'),
+                    get_headers_only_fetch_mode(config, 'all_folders')),
+                partial_body=combine_partial_body_fetch_modes(config, 'main_folder', 'all_folders')))
+        imap_connection.flush_queued_actions()
+        return True
+
+    iterate_rules_over_mailfolder(imap_connection, config, rules, counters,
+        headers_only=get_headers_only_fetch_mode(config, 'main_folder'),
+        search_criteria=get_search_criteria_for_rules(config, rules),
+        checkpoints=checkpoints,
+        partial_body=get_partial_body_fetch_mode(config, 'main_folder'))
+    return False
+
+
+def can_check_allfolders_rules_in_mainfolder_pass(config, rules_allfolders, counters_allfolders, checkpoints):
+    if (rules_allfolders is None) or (len(rules_allfolders) == 0) or (counters_allfolders is None):
+        return False
+    if (not config['assess_rules_againt_allfolders']):
+        return False
+    if folder_is_excluded(strip_quotes(config['imap_initial_folder']), config['imap_folders_to_exclude']):
+        return False
+    if checkpoints is not None:
+        return False  # Each rule set keeps its own checkpoints, so they may need different emails
+    if any(rule.depends_on_imap_flags() for rule in rules_allfolders):
+        # The emails for both rule sets are searched for (and prefiltered) before the Main Folder rules' actions change
+        # any flags, so All Folders rules checking flags could miss emails that a separate pass would check
+        return False
+    return True
+
+
+def combine_search_criteria(*search_criteria_list):
+    """Combines IMAP SEARCH queries with OR; None (all emails) if any of them is None"""
+    if None in search_criteria_list:
+        return None
+    return join_or(list(search_criteria_list))
 
 
-def iterate_rules_over_allfolders(imap_connection, config, rules, counters):
+def iterate_rules_over_allfolders(imap_connection, config, rules, counters, checkpoints=None, skip_initial_folder=False):
 
     if (not config['assess_rules_againt_allfolders']):
         LogMaster.info('All Folders Rules Not Processed: this processing has been disabled in the program config files.')
@@ -201,7 +600,25 @@ def iterate_rules_over_allfolders(imap_connection, config, rules, counters):
 
     LogMaster.log(40, 'Now commencing iteration of a rule over all emails in all folders in the mailbox')
     LogMaster.info('\nNow looping over all folders in the mailbox.')
-    LogMaster.ultra_debug("All folders: %s", imap_connection.get_all_folders())
+    LogMaster.ultra_debug("All folders: %s", LazyLogArg(imap_connection.get_all_folders))
+    search_criteria = get_search_criteria_for_rules(config, rules)
+    folder_names = get_folder_names_to_check(imap_connection, config, skip_initial_folder)
+
+    num_connections = min(config['imap_allfolders_connections'], len(folder_names))
+    if num_connections > 1:
+        iterate_rules_over_folders_in_parallel(imap_connection, config, rules, counters, search_criteria, checkpoints,
+            folder_names, num_connections)
+    else:
+        for folder_name in folder_names:
+            iterate_rules_over_named_folder(imap_connection, config, rules, counters, search_criteria, checkpoints, folder_name)
+
+    LogMaster.info('Now resetting IMAP connection back to default folder.')
+    imap_connection.connect_to_default_folder()
+
+
+def get_folder_names_to_check(imap_connection, config, skip_initial_folder=False):
+    """Returns the (quoted) names of all folders in the mailbox, less those excluded in the config"""
+    folder_names = []
     for folder_record in imap_connection.get_all_folders():
         folder_record_utf8 = convert_bytes_to_utf8(folder_record)
         (folder_flags, folder_parent_and_name) = folder_record_utf8.split(')', 1)
@@ -212,14 +629,86 @@ def iterate_rules_over_allfolders(imap_connection, config, rules, counters):
         LogMaster.ultra_debug('Now checking folder "%s" for folder exclusions.', folder_name)
         if folder_is_excluded(folder_name_noquotes, config['imap_folders_to_exclude']):
             LogMaster.info('Skipping folder "%s" due to folder exclusions.', folder_name)
+        elif skip_initial_folder and folder_is_same(folder_name_noquotes, strip_quotes(config['imap_initial_folder'])):
+            LogMaster.info('Skipping folder "%s": All Folders rules were checked with the Main Folder rules.', folder_name)
         else:
-            LogMaster.info('Now connecting to folder \"%s\".', folder_name_noquotes)
-            imap_connection.connect_to_folder(folder_name)
-            counters.incr('folders_processed')
-            iterate_rules_over_mailfolder(imap_connection, config, rules, counters, headers_only=config['imap_headers_only_for_all_folders'])
+            folder_names.append(folder_name)
+    return folder_names
 
-    LogMaster.info('Now resetting IMAP connection back to default folder.')
-    imap_connection.connect_to_default_folder()
+
+def iterate_rules_over_named_folder(imap_connection, config, rules, counters, search_criteria, checkpoints, folder_name):
+    LogMaster.info('Now connecting to folder \"%s\".', strip_quotes(folder_name))
+    imap_connection.connect_to_folder(folder_name)
+    counters.incr('folders_processed')
+    iterate_rules_over_mailfolder(imap_connection, config, rules, counters,
+        headers_only=get_headers_only_fetch_mode(config, 'all_folders'),
+        search_criteria=search_criteria,
+        checkpoints=checkpoints,
+        partial_body=get_partial_body_fetch_mode(config, 'all_folders'))
+
+
+def iterate_rules_over_folders_in_parallel(imap_connection, config, rules, counters, search_criteria, checkpoints,
+        folder_names, num_connections):
+    """Works through the folders using several IMAP connections at once, each with its own selected folder.
+
+    The existing connection is used by one worker; the others log in with their own connections.
+    Each worker keeps its own counters, which are merged into counters once all workers have finished."""
+    LogMaster.info('Now checking %s folders using %s IMAP connections.', len(folder_names), num_connections)
+    folder_queue = queue.Queue()
+    for folder_name in folder_names:
+        folder_queue.put(folder_name)
+
+    worker_counters = [create_default_rule_counters() for i in range(num_connections)]
+    worker_errors = []
+    workers = []
+    for worker_num in range(num_connections):
+        worker = threading.Thread(target=iterate_rules_over_queued_folders, name='AllFolders-%s' % worker_num,
+            args=(imap_connection if worker_num == 0 else None, config, rules, worker_counters[worker_num], search_criteria,
+                checkpoints, folder_queue, worker_errors))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+    smtp_send.drain_outbound_mail_queue()  # So the workers' forwards_sent/forwards_failed are counted before merging
+    for worker_counter in worker_counters:
+        counters.merge(worker_counter)
+
+    if len(worker_errors) > 0:
+        raise worker_errors[0]  # Leave the error handling to the caller, as for a single connection
+
+
+def iterate_rules_over_queued_folders(imap_connection, config, rules, counters, search_criteria, checkpoints, folder_queue,
+        worker_errors):
+    """Worker thread: takes folders from the queue until it's empty. If imap_connection is None, opens its own."""
+    own_connection = (imap_connection is None)
+    if own_connection:
+        imap_connection = IMAPServerConnection()
+        imap_connection.set_parameters_from_config(config)
+        if not imap_connection.connect_to_server():
+            LogMaster.error('Additional IMAP connection failed, so the remaining folders will be shared by the other connections.')
+            return
+
+    try:
+        while len(worker_errors) == 0:
+            try:
+                folder_name = folder_queue.get_nowait()
+            except queue.Empty:
+                break
+            iterate_rules_over_named_folder(imap_connection, config, rules, counters, search_criteria, checkpoints, folder_name)
+    except Exception as e:
+        LogMaster.exception('Error whilst checking folders with IMAP connection %s:', threading.current_thread().name)
+        worker_errors.append(e)
+    finally:
+        if own_connection:
+            imap_connection.disconnect()
+
+
+def folder_is_same(folder_name, other_folder_name):
+    if folder_name.upper() == 'INBOX':  # INBOX is the only case-insensitive folder name
+        return other_folder_name.upper() == 'INBOX'
+    return folder_name == other_folder_name
 
 
 def folder_is_excluded(folder_name, exclusion_set):
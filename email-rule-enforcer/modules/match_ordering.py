@@ -0,0 +1,110 @@
+from modules.logging import LogMaster
+from modules.models.RuleMatches import Match
+import modules.models.RuleMatches as RuleMatches
+
+# Orders the Matches of each rule so that the cheapest, most decisive ones are checked first.
+#
+# All of a rule's matches (and all of its exceptions) must match, so checking stops at the first one that fails;
+# an 'or' clause stops at the first of its matches that succeeds. The result is the same in any order, so the order
+# is chosen to settle it for the least work: each Match has a cost (from its cost class) and a pass rate (how often it
+# has matched recently). Terms of an 'and' are checked in order of cost / chance of failing, and terms of an 'or' in
+# order of cost / chance of matching. The order starts from the cost classes alone, and is revised as pass rates change.
+
+# Relative cost of checking a Match of each cost class
+cost_of_class = {
+    RuleMatches.cost_class_flag: 1,
+    RuleMatches.cost_class_size: 2,
+    RuleMatches.cost_class_folder: 3,
+    RuleMatches.cost_class_header: 10,
+    RuleMatches.cost_class_body: 50,
+    RuleMatches.cost_class_regex_body: 200,
+}
+
+# Pass rate assumed for a Match that hasn't been checked yet
+default_pass_rate = 0.5
+
+# Stops a Match that (so far) always fails, or always matches, from being treated as infinitely cheap or expensive
+min_rate = 0.01
+
+
+class AdaptiveMatchOrdering():
+    enabled = True
+    reorder_interval = 100  # Number of times a rule is checked between reorderings of its matches
+
+    @classmethod
+    def set_enabled(cls, flag):
+        cls.enabled = flag
+
+    @classmethod
+    def order_rules(cls, *rule_sets):
+        """Puts the matches of every rule into their initial order (by cost class)"""
+        if not cls.enabled:
+            return
+        for rules in rule_sets:
+            for rule in rules:
+                order_rule_matches(rule)
+
+    @classmethod
+    def reorder_if_due(cls, rule):
+        """Called each time a rule is checked; reorders its matches every reorder_interval checks"""
+        if not cls.enabled:
+            return
+        rule.checks_since_match_reorder += 1
+        if rule.checks_since_match_reorder >= cls.reorder_interval:
+            rule.checks_since_match_reorder = 0
+            order_rule_matches(rule)
+
+
+def order_rule_matches(rule):
+    # New lists replace the old ones (rather than sorting them in place), as other threads may be checking this rule
+    rule.matches = get_ordered_and_list(rule.matches)
+    rule.match_exceptions = get_ordered_and_list(rule.match_exceptions)
+    LogMaster.insane_debug('Rule ID %s matches are now checked in this order: %s; exceptions: %s', rule.id,
+        get_match_ids(rule.matches), get_match_ids(rule.match_exceptions))
+
+
+def get_ordered_and_list(matches):
+    ordered_matches = []
+    for match_check in matches:
+        if isinstance(match_check, list):
+            match_check = match_check.__class__(sorted(match_check, key=get_or_term_rank))
+        ordered_matches.append(match_check)
+    return matches.__class__(sorted(ordered_matches, key=get_and_term_rank))
+
+
+def get_and_term_rank(match_check):
+    return get_expected_cost(match_check) / max(1 - get_pass_rate(match_check), min_rate)
+
+
+def get_or_term_rank(match_check):
+    return get_expected_cost(match_check) / max(get_pass_rate(match_check), min_rate)
+
+
+def get_pass_rate(match_check):
+    if isinstance(match_check, list):  # An 'or' clause matches unless all of its matches fail
+        chance_all_fail = 1
+        for match_or in match_check:
+            chance_all_fail *= (1 - get_pass_rate(match_or))
+        return 1 - chance_all_fail
+    elif isinstance(match_check, Match):
+        pass_rate = match_check.get_pass_rate()
+        return default_pass_rate if pass_rate is None else pass_rate
+    return 1
+
+
+def get_expected_cost(match_check):
+    if isinstance(match_check, list):  # Each match of an 'or' clause is only checked if the ones before it failed
+        expected_cost = 0
+        chance_checked = 1
+        for match_or in match_check:
+            expected_cost += chance_checked * get_expected_cost(match_or)
+            chance_checked *= (1 - get_pass_rate(match_or))
+        return expected_cost
+    elif isinstance(match_check, Match):
+        return cost_of_class.get(match_check.get_cost_class(), cost_of_class[RuleMatches.cost_class_header])
+    return 0
+
+
+def get_match_ids(matches):
+    return [get_match_ids(match_check) if isinstance(match_check, list) else getattr(match_check, 'id', None)
+        for match_check in matches]
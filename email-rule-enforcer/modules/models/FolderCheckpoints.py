@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import threading
+from modules.logging import LogMaster
+
+
+class FolderCheckpoints():
+    """Persistent record of how far each rule set has processed each IMAP folder.
+
+    Checkpoints are stored per rule set and folder as the folder's UIDVALIDITY, the highest UID processed,
+    the time of the last full sweep and (for CONDSTORE servers) the folder's HIGHESTMODSEQ.
+    A checkpoint is only valid while the folder's UIDVALIDITY is unchanged.
+    Checkpoints may be updated from several threads (one per IMAP connection), so changes are made under a lock."""
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.checkpoints = dict()
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if (self.filepath is None) or (not os.path.exists(self.filepath)):
+            return
+        try:
+            with open(self.filepath, encoding='utf8') as f:
+                loaded_checkpoints = json.load(f)
+            if isinstance(loaded_checkpoints, dict):
+                self.checkpoints = loaded_checkpoints
+        except (IOError, ValueError) as e:
+            LogMaster.log(30, 'Failed to read checkpoint file %s, so all folders will be fully checked. Error was: %s',
+                self.filepath, e)
+            self.checkpoints = dict()
+
+    def save(self):
+        if self.filepath is None:
+            return
+        temp_filepath = self.filepath + '.tmp'
+        with self.lock:
+            try:
+                with open(temp_filepath, 'w', encoding='utf8') as f:
+                    json.dump(self.checkpoints, f, indent=1, sort_keys=True)
+                os.replace(temp_filepath, self.filepath)
+            except (IOError, OSError) as e:
+                LogMaster.log(30, 'Failed to save checkpoint file %s. Error was: %s', self.filepath, e)
+
+    def get_checkpoint(self, ruleset_name, folder_name):
+        try:
+            return self.checkpoints[ruleset_name][folder_name]
+        except (KeyError, TypeError):
+            return None
+
+    def _get_or_create_checkpoint(self, ruleset_name, folder_name, uidvalidity):
+        checkpoint = self.get_checkpoint(ruleset_name, folder_name)
+        if (checkpoint is None) or (checkpoint.get('uidvalidity') != uidvalidity):
+            checkpoint = {'uidvalidity': uidvalidity, 'last_uid': 0, 'last_full_sweep': time.time(), 'highestmodseq': None}
+            self.checkpoints.setdefault(ruleset_name, dict())[folder_name] = checkpoint
+        return checkpoint
+
+    def get_last_uid(self, ruleset_name, folder_name, uidvalidity):
+        """Returns the highest UID already processed, or 0 if the folder needs to be fully checked"""
+        checkpoint = self.get_checkpoint(ruleset_name, folder_name)
+        if checkpoint is None:
+            return 0
+        if checkpoint.get('uidvalidity') != uidvalidity:
+            LogMaster.info('UIDVALIDITY of folder "%s" has changed (was %s, now %s), so all emails will be checked.',
+                folder_name, checkpoint.get('uidvalidity'), uidvalidity)
+            return 0
+        return checkpoint.get('last_uid', 0)
+
+    def set_last_uid(self, ruleset_name, folder_name, uidvalidity, last_uid):
+        with self.lock:
+            checkpoint = self._get_or_create_checkpoint(ruleset_name, folder_name, uidvalidity)
+            checkpoint['last_uid'] = last_uid
+
+    def get_highestmodseq(self, ruleset_name, folder_name, uidvalidity):
+        """Returns the HIGHESTMODSEQ recorded at the last run, or None if unknown"""
+        checkpoint = self.get_checkpoint(ruleset_name, folder_name)
+        if (checkpoint is None) or (checkpoint.get('uidvalidity') != uidvalidity):
+            return None
+        return checkpoint.get('highestmodseq')
+
+    def set_highestmodseq(self, ruleset_name, folder_name, uidvalidity, highestmodseq):
+        with self.lock:
+            checkpoint = self._get_or_create_checkpoint(ruleset_name, folder_name, uidvalidity)
+            checkpoint['highestmodseq'] = highestmodseq
+
+    def full_sweep_is_due(self, ruleset_name, folder_name, interval_days):
+        checkpoint = self.get_checkpoint(ruleset_name, folder_name)
+        if checkpoint is None:
+            return True
+        last_full_sweep = checkpoint.get('last_full_sweep', 0)
+        return (time.time() - last_full_sweep) >= (interval_days * 86400)
+
+    def set_full_sweep_done(self, ruleset_name, folder_name, uidvalidity):
+        with self.lock:
+            checkpoint = self._get_or_create_checkpoint(ruleset_name, folder_name, uidvalidity)
+            checkpoint['last_full_sweep'] = time.time()
+
+    def __repr__(self):
+        return '%s:(%s: %s)' % (self.__class__.__name__, self.filepath, str(self.checkpoints))
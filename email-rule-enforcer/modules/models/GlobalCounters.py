@@ -23,6 +23,15 @@ class GlobalCounters(dict):
             self.add_counter(counter_name=counter_name, start_val=(-1 * incr))
         return self[counter_name]
 
+    def merge(self, other_counters):
+        """Adds the counts from another GlobalCounters into this one"""
+        for counter_name in other_counters:
+            if counter_name in self:
+                self[counter_name].incr(incr=other_counters.get(counter_name))
+            else:
+                self.new_counter(counter_name=counter_name, start_val=other_counters.get(counter_name))
+        return self
+
     def get(self, counter_name):
         try:
             return self[counter_name].get()
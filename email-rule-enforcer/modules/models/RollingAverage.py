@@ -1,4 +1,9 @@
 class RollingAverage():
+    def __init__(self, max_samples=None):
+        # With max_samples, older values count for less and less once there are that many samples,
+        # so the average follows recent values rather than settling on the average of all time
+        self.max_samples = max_samples
+
     def add(self, val):
         try:
             self.avg
@@ -6,8 +11,10 @@ class RollingAverage():
             self.avg = val
             self.sample_count = 0
         prev_count = self.sample_count
+        if (self.max_samples is not None) and (prev_count >= self.max_samples):
+            prev_count = self.max_samples - 1
         self.sample_count += 1
-        self.avg = (self.avg * prev_count + val) / self.sample_count
+        self.avg = (self.avg * prev_count + val) / (prev_count + 1)
         return self.avg
 
     def get_avg(self):
@@ -15,4 +22,3 @@ class RollingAverage():
 
     def get_count(self):
         return self.sample_count
-
@@ -1,6 +1,8 @@
+import threading
 from collections import OrderedDict
+from modules.logging import LogMaster
 from modules.models.Counter import Counter
-from modules.email.make_new_emails import new_email_forward
+from modules.email.make_new_emails import new_email_forward, new_email_forward_digest
 import modules.email.smtp_send as smtp_send
 
 
@@ -33,7 +35,7 @@ class Action():
     def set_parent_rule_id(self):
         self.parent_rule_id = parent_rule_id
 
-    def perform_action(self, email_to_action, config, imap_connection, LogMaster):
+    def perform_action(self, email_to_action, config, imap_connection, LogMaster, counters=None):
         raise NotImplementedError('This is the base class for Action, no action possible')
 
     def is_destructive(self):
@@ -62,36 +64,92 @@ class ActionForwardEmail(Action):
     def __init__(self, parent_rule_id=None):
         super().__init__(parent_rule_id)
         self.email_recipients = []
+        self.digest = False
+        self.digest_max_bytes = 10485760
+        self.digest_emails = []  # [(subject, raw email bytes)] waiting to be sent in the next digest
+        self.digest_bytes = 0
+        self.digest_lock = threading.Lock()  # All Folders worker threads may add to the same digest
 
     def add_email_recipient(self, email_addr):
         self.email_recipients.append(email_addr)
 
+    def set_digest(self, flag):
+        self.digest = flag
+
+    def set_digest_max_bytes(self, max_bytes):
+        self.digest_max_bytes = max_bytes
+
     def get_relevant_value(self):
+        if self.digest:
+            return "Recipients = %s, Digest up to %s bytes" % (self.email_recipients, self.digest_max_bytes)
         return "Recipients = %s" % self.email_recipients
 
-    def perform_action(self, email_to_action, config, imap_connection, LogMaster):
+    def perform_action(self, email_to_action, config, imap_connection, LogMaster, counters=None):
         LogMaster.info('Rule Action for Rule ID %s is a Forward, so now forwarding to: %s',
             self.parent_rule_id, self.email_recipients)
         LogMaster.ultra_debug('Now constructing a new email for Rule ID %s, to be sent From: %s',
             self.parent_rule_id, config['smtp_forward_from'])
 
-        if (email_to_action.headers_only):
-            raw_email = imap_connection.get_raw_email_byuid(email_to_action.uid)
-        else:
-            raw_email = email_to_action.original_raw_email
-        email_to_attach = imap_connection.parse_raw_email(raw_email)
+        # Attached as the raw bytes: fetched only once, however many Forward actions the email matches
+        raw_email = email_to_action.get_full_raw_email(imap_connection)
+        if raw_email is None:
+            LogMaster.error('Rule ID %s: Could not fetch email UID %s from the IMAP Server, so it cannot be forwarded.',
+                self.parent_rule_id, email_to_action.uid_str)
+            smtp_send.count_forward_result(counters, False)
+            return
+
+        if self.digest:
+            LogMaster.info('Forward for Rule ID %s is a digest, so email UID %s will be sent in the next digest.',
+                self.parent_rule_id, email_to_action.uid_str)
+            if self.actually_perform_actions():
+                self.add_to_digest(config, email_to_action['subject'], raw_email, counters)
+            return
 
         email_to_forward = new_email_forward(
             email_from=config['smtp_forward_from'],
             email_to=self.email_recipients,
             subject='FWD: ' + email_to_action['subject'],
             bodytext="Forwarded Email Attached",
-            email_to_attach=email_to_attach)
+            email_to_attach=raw_email)
 
         LogMaster.insane_debug('Constructed email for Rule ID %s:\n%s', self.parent_rule_id, email_to_forward)
 
         if self.actually_perform_actions():
-            smtp_send.send_email_from_config(config, email_to_forward)
+            smtp_send.queue_email_from_config(config, email_to_forward, counters)
+
+    def add_to_digest(self, config, subject, raw_email, counters=None):
+        """Adds an email to the digest. If that would take the digest over digest_max_bytes, the emails already in it
+        are sent first, so each digest stays under the limit (unless a single email is bigger than it)."""
+        full_digest = None
+        with self.digest_lock:
+            if (len(self.digest_emails) > 0) and (self.digest_bytes + len(raw_email) > self.digest_max_bytes):
+                full_digest = self.take_digest_emails()
+            self.digest_emails.append((subject, raw_email))
+            self.digest_bytes += len(raw_email)
+        if full_digest is not None:
+            self.send_digest_emails(config, full_digest, counters)
+
+    def send_digest(self, config, counters=None):
+        """Sends the emails waiting in the digest, if there are any"""
+        with self.digest_lock:
+            digest_emails = self.take_digest_emails()
+        if len(digest_emails) > 0:
+            self.send_digest_emails(config, digest_emails, counters)
+
+    def take_digest_emails(self):
+        (digest_emails, self.digest_emails, self.digest_bytes) = (self.digest_emails, [], 0)
+        return digest_emails
+
+    def send_digest_emails(self, config, digest_emails, counters):
+        LogMaster.info('Now sending a digest of %s forwarded emails for Rule ID %s to: %s', len(digest_emails),
+            self.parent_rule_id, self.email_recipients)
+        email_to_forward = new_email_forward_digest(
+            email_from=config['smtp_forward_from'],
+            email_to=self.email_recipients,
+            subject='FWD: Digest of %s emails matched by Rule ID %s' % (len(digest_emails), self.parent_rule_id),
+            bodytext='Forwarded Emails Attached:\n' + '\n'.join(' - %s' % subject for (subject, raw_email) in digest_emails),
+            emails_to_attach=[raw_email for (subject, raw_email) in digest_emails])
+        smtp_send.queue_email_from_config(config, email_to_forward, counters)
 
 
 class ActionMarkAsRead(Action):
@@ -101,10 +159,10 @@ class ActionMarkAsRead(Action):
     def __init__(self, parent_rule_id=None):
         super().__init__(parent_rule_id)
 
-    def perform_action(self, email_to_action, config, imap_connection, LogMaster):
+    def perform_action(self, email_to_action, config, imap_connection, LogMaster, counters=None):
         LogMaster.info('Now Marking Email UID %s as Read', email_to_action.uid_str)
         if self.actually_perform_actions():
-            imap_connection.mark_email_as_read_byuid(email_to_action.uid)
+            imap_connection.action_queue.add_flag(email_to_action.uid, '\\Seen')
 
     def get_relevant_value(self):
         return "Mark as Read = True"
@@ -117,10 +175,10 @@ class ActionMarkAsUnread(Action):
     def __init__(self, parent_rule_id=None):
         super().__init__(parent_rule_id)
 
-    def perform_action(self, email_to_action, config, imap_connection, LogMaster):
+    def perform_action(self, email_to_action, config, imap_connection, LogMaster, counters=None):
         LogMaster.info('Now Marking Email UID %s as Unread', email_to_action.uid_str)
         if self.actually_perform_actions():
-            imap_connection.mark_email_as_unread_byuid(email_to_action.uid)
+            imap_connection.action_queue.remove_flag(email_to_action.uid, '\\Seen')
 
     def get_relevant_value(self):
         return "Mark as Unread = True"
@@ -137,10 +195,13 @@ class ActionDelete(Action):
     def set_delete_permanently(self, flag):
         self.delete_permanently = flag
 
-    def perform_action(self, email_to_action, config, imap_connection, LogMaster):
+    def perform_action(self, email_to_action, config, imap_connection, LogMaster, counters=None):
         LogMaster.info('Now Deleting Email UID %s, permanently=%s', email_to_action.uid_str, self.delete_permanently)
         if self.actually_perform_actions():
-            imap_connection.del_email(email_to_action.uid, self.delete_permanently)
+            if self.delete_permanently:
+                imap_connection.action_queue.delete_permanently(email_to_action.uid)
+            else:
+                imap_connection.action_queue.move(email_to_action.uid, imap_connection.deletions_folder)
 
     def get_relevant_value(self):
         return "Delete, delete_permanently = %s" % self.delete_permanently
@@ -161,13 +222,14 @@ class ActionMoveToNewFolder(Action):
     def set_mark_as_read_on_move(self, flag):
         self.mark_as_read_on_move = flag
 
-    def perform_action(self, email_to_action, config, imap_connection, LogMaster):
+    def perform_action(self, email_to_action, config, imap_connection, LogMaster, counters=None):
         LogMaster.info('Now Moving Email UID %s to folder %s', email_to_action.uid_str, self.dest_folder)
         if self.actually_perform_actions():
-            imap_connection.move_email(
+            imap_connection.action_queue.move(
                 uid=email_to_action.uid,
                 dest_folder=self.dest_folder,
-                mark_as_read_on_move=self.mark_as_read_on_move
+                mark_as_read_on_move=self.mark_as_read_on_move,
+                is_read=email_to_action.is_read
             )
 
     def get_relevant_value(self):
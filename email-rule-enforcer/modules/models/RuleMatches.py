@@ -4,9 +4,16 @@ from collections import OrderedDict
 from modules.logging import LogMaster
 from modules.models.Counter import Counter
 from modules.models.Singleton import Singleton
+from modules.models.RollingAverage import RollingAverage
 from modules.email.supportingfunctions_email import convert_emaildate_to_datetime
 import modules.models.tzinfo_UTC as tzinfo_UTC
 
+# Cost classes: roughly how expensive each kind of Match is to check, cheapest first
+(cost_class_flag, cost_class_size, cost_class_folder, cost_class_header, cost_class_body, cost_class_regex_body) = range(6)
+
+# The number of recent results each Match's pass rate is based on
+pass_rate_samples = 200
+
 
 class MatchOr(list):
     def __repr__(self):
@@ -31,6 +38,10 @@ class MatchesCounter(Singleton):
 
 class Match():
     count = MatchesCounter
+    metadata_only = False  # True if the Match only needs IMAP metadata (size, flags, folder, INTERNALDATE), not headers/body
+    multi_pattern_group = None  # Set by compile_rules if this Match is checked along with others in one pass over the text
+    shared_match = None  # Set by compile_rules to the Match (in any rule) whose result and pass rate this one shares
+    cost_class = cost_class_header
 
     @classmethod
     def get_count(cls):
@@ -47,6 +58,7 @@ class Match():
         self.set_match_type(match_type)
         self.set_value_to_match(value_to_match)
         self.parent_rule_id = parent_rule_id
+        self.pass_rate = RollingAverage(pass_rate_samples)
 
     def set_field_to_match(self, field_to_match):
         if isinstance(field_to_match, str):
@@ -72,6 +84,49 @@ class Match():
     def get_value_to_match(self):
         return self.value_to_match
 
+    def is_metadata_only(self):
+        return self.metadata_only
+
+    def get_cost_class(self):
+        return self.cost_class
+
+    def get_pass_rate(self):
+        """The fraction of recently-checked emails this Match matched, or None if it hasn't been checked yet"""
+        if (self.shared_match is not None) and (self.shared_match is not self):
+            return self.shared_match.get_pass_rate()
+        try:
+            return self.pass_rate.get_avg()
+        except AttributeError:
+            return None
+
+    def get_predicate_key(self):
+        """Matches with the same predicate key always give the same result for an email, so can be shared between rules"""
+        return (self.__class__, self.field_to_match, self.match_type, self.value_to_match)
+
+    def test_match_email_cached(self, email_to_validate):
+        """As test_match_email, but the result is kept in the email's match_results, so it is only worked out once"""
+        if (self.shared_match is not None) and (self.shared_match is not self):
+            return self.shared_match.test_match_email_cached(email_to_validate)
+        match_results = getattr(email_to_validate, 'match_results', None)
+        if match_results is None:
+            return self.test_match_email(email_to_validate)
+        try:
+            return match_results[self]
+        except KeyError:
+            if LogMaster.insane_debug_enabled:
+                LogMaster.insane_debug('Match ID %s not yet checked against Email UID %s.', self.id, email_to_validate.uid_str)
+        if self.multi_pattern_group is not None:
+            self.multi_pattern_group.test_match_email(email_to_validate, match_results)
+            if self in match_results:
+                return match_results[self]
+        match_results[self] = self.test_match_email(email_to_validate)
+        self.record_result(match_results[self])
+        return match_results[self]
+
+    def record_result(self, matched):
+        """Adds a result to this Match's pass rate (once per email), which is used to decide the order Matches are checked in"""
+        self.pass_rate.add(1 if matched else 0)
+
     def test_match_value(self, value):
         raise AttributeError('%s is Abstract Class, and should not be used in this manner' % (self.__class__.__name__))
 
@@ -92,8 +147,15 @@ class Match():
 
 class MatchTextBase(Match):
     default_re = re.compile('This is a default value, never to be matched')
+    regex_special_chars = frozenset('.^$*+?{}[]\\|()')
+    literal_match_modes = {'contains': 'substring', 'starts_with': 'prefix', 'ends_with': 'suffix', 'is': 'equals', 'equals': 'equals'}
+    legacy_regex_matching = False  # If True, every match type is a regex (eg "contains" is '.*value.*'), as in older versions
     field_name = 'BaseClass'
 
+    @classmethod
+    def set_legacy_regex_matching(cls, flag):
+        cls.legacy_regex_matching = flag
+
     def __init__(self, field_to_match=None, match_type=None, value_to_match=None, name=None, parent_rule_id=None, case_sensitive=False):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id)
         self.set_case_sensitive(case_sensitive)
@@ -102,8 +164,40 @@ class MatchTextBase(Match):
     def set_case_sensitive(self, bool_flag):
         self.case_sensitive = bool_flag
 
+    def get_predicate_key(self):
+        return super().get_predicate_key() + (self.case_sensitive,)
+
+    def get_text_to_match(self, email_to_validate):
+        raise AttributeError('%s is Abstract Class, and should not be used in this manner' % (self.__class__.__name__))
+
+    def get_multi_pattern_key(self):
+        """Matches with the same key test the same text of an email in the same way, so can share a MultiPatternMatcher"""
+        return (self.__class__, self.field_to_match, self.case_sensitive)
+
+    def get_literal_match_mode(self):
+        """How this Match tests the text as a plain string: 'substring', 'prefix', 'suffix' or 'equals'.
+        None for regex matches (and, with legacy regex matching, for values with special regex characters)."""
+        if self.legacy_regex_matching:
+            # The regex is applied with re.match, which is anchored at the start only
+            if (self.re is self.default_re) or (not isinstance(self.value_to_match, str)):
+                return None
+            if len(self.regex_special_chars.intersection(self.value_to_match)) > 0:
+                return None
+            if self.match_type in ('contains', 'ends_with'):
+                return 'substring'
+            return 'prefix'
+
+        if (self.match_type == 'regex') or (self.literal_value is None):
+            return None
+        return self.literal_match_modes.get(self.match_type, 'equals')
+
     def _generate_re(self):
         self.re = self.default_re
+        self.literal_value = None
+        if self.value_to_match is not None:
+            self.literal_value = str(self.value_to_match)
+            if not self.case_sensitive:
+                self.literal_value = self.literal_value.lower()
         try:
             if (self.value_to_match is not None):
                 match_str = str(self.value_to_match)[:]
@@ -122,24 +216,51 @@ class MatchTextBase(Match):
                 self.re = re.compile(match_str, flags)
         except (AttributeError, TypeError):
             pass
+        except re.error as regex_error:
+            if (self.match_type == 'regex') or self.legacy_regex_matching:
+                LogMaster.error('Invalid regex \"%s\" in %s match, so it will never match. Error was: %s',
+                    self.value_to_match, self.field_name, regex_error)
 
     def test_match_value(self, str_value):
+        if self.legacy_regex_matching or (self.match_type == 'regex'):
+            return self.test_match_value_regex(str_value)
+        return self.test_match_value_literal(str_value)
+
+    def test_match_value_regex(self, str_value):
         matched_yn = False
         if self.re.match(str_value):
             matched_yn = True
         return matched_yn
 
+    def test_match_value_literal(self, str_value):
+        if (self.literal_value is None) or (not isinstance(str_value, str)):
+            return False
+        if not self.case_sensitive:
+            str_value = str_value.lower()
+        literal_match_mode = self.literal_match_modes.get(self.match_type, 'equals')
+        if literal_match_mode == 'substring':
+            return (self.literal_value in str_value)
+        elif literal_match_mode == 'prefix':
+            return str_value.startswith(self.literal_value)
+        elif literal_match_mode == 'suffix':
+            return str_value.endswith(self.literal_value)
+        return (str_value == self.literal_value)
+
     def test_match_email_text(self, email_uid, str_to_test):
-        LogMaster.ultra_debug('Now matching Email UID: %s against a %s (%s)',
-            email_uid, self.field_name, self.field_to_match)
+        log_ultra_debug = LogMaster.ultra_debug_enabled
+        if log_ultra_debug:
+            LogMaster.ultra_debug('Now matching Email UID: %s against a %s (%s)',
+                email_uid, self.field_name, self.field_to_match)
         matched_yn = False
         try:
-            LogMaster.ultra_debug('Email Matching value is: \"%s\", to be matched against regexp: \"%s\"',
-                str_to_test, self.re.pattern)
+            if log_ultra_debug:
+                LogMaster.ultra_debug('Email Matching value is: \"%s\", to be matched (%s) against: \"%s\"',
+                    str_to_test, self.match_type, self.re.pattern if self.get_literal_match_mode() is None else self.value_to_match)
             if (self.test_match_value(str_to_test)):
                 matched_yn = True
-                LogMaster.ultra_debug('%s Matched: \"%s\"', self.field_name, str_to_test)
-            else:
+                if log_ultra_debug:
+                    LogMaster.ultra_debug('%s Matched: \"%s\"', self.field_name, str_to_test)
+            elif log_ultra_debug:
                 LogMaster.ultra_debug('%s Not Matched: \"%s\"', self.field_name, str_to_test)
         except AttributeError:
             LogMaster.ultra_debug('Error: AttributeError incurred when testing Email UID: %s against %s (%s)',
@@ -174,8 +295,11 @@ class MatchHeader(MatchTextBase):
     def __init__(self, field_to_match='header', match_type='contains', value_to_match=None, name=None, parent_rule_id=None, case_sensitive=False):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id, case_sensitive)
 
+    def get_text_to_match(self, email_to_validate):
+        return email_to_validate[self.field_to_match]
+
     def test_match_email(self, email_to_validate):
-        str_to_test = email_to_validate[self.field_to_match]
+        str_to_test = self.get_text_to_match(email_to_validate)
         return self.test_match_email_text(email_to_validate.uid_str, str_to_test)
 
 
@@ -185,19 +309,31 @@ class MatchSubject(MatchTextBase):
     def __init__(self, field_to_match='subject', match_type='contains', value_to_match=None, name=None, parent_rule_id=None, case_sensitive=False):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id, case_sensitive)
 
+    def get_text_to_match(self, email_to_validate):
+        return email_to_validate[self.field_to_match]
+
     def test_match_email(self, email_to_validate):
-        str_to_test = email_to_validate[self.field_to_match]
+        str_to_test = self.get_text_to_match(email_to_validate)
         return self.test_match_email_text(email_to_validate.uid_str, str_to_test)
 
 
 class MatchBody(MatchTextBase):
     field_name = 'Body'
+    cost_class = cost_class_body
 
     def __init__(self, field_to_match='body', match_type='contains', value_to_match=None, name=None, parent_rule_id=None, case_sensitive=False):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id, case_sensitive)
 
+    def get_cost_class(self):
+        if self.get_literal_match_mode() is None:
+            return cost_class_regex_body
+        return self.cost_class
+
+    def get_text_to_match(self, email_to_validate):
+        return email_to_validate.body
+
     def test_match_email(self, email_to_validate):
-        str_to_test = email_to_validate.body
+        str_to_test = self.get_text_to_match(email_to_validate)
         return self.test_match_email_text(email_to_validate.uid_str, str_to_test)
 
 
@@ -207,8 +343,11 @@ class MatchFrom(MatchTextBase):
     def __init__(self, field_to_match='from', match_type='is', value_to_match=None, name=None, parent_rule_id=None, case_sensitive=False):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id, case_sensitive)
 
+    def get_text_to_match(self, email_to_validate):
+        return email_to_validate.addr_from
+
     def test_match_email(self, email_to_validate):
-        str_to_test = email_to_validate.addr_from
+        str_to_test = self.get_text_to_match(email_to_validate)
         return self.test_match_email_text(email_to_validate.uid_str, str_to_test)
 
 
@@ -220,6 +359,12 @@ class MatchTo(MatchTextBase):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id, case_sensitive)
         self.this_recipient_only = this_recipient_only
 
+    def get_predicate_key(self):
+        return super().get_predicate_key() + (self.this_recipient_only,)
+
+    def get_multi_pattern_key(self):
+        return None  # Each of the email's To addresses is tested separately
+
     def test_match_email(self, email_to_validate):
         LogMaster.ultra_debug('Now matching a value to To Address of an email body. Email UID: %s', email_to_validate.uid_str)
         matched_yn = False
@@ -241,6 +386,8 @@ class MatchTo(MatchTextBase):
 
 class MatchFolder(MatchTextBase):
     field_name = 'IMAP_Folder'
+    metadata_only = True
+    cost_class = cost_class_folder
 
     def __init__(self, field_to_match='IMAP_Folder', match_type='is', value_to_match=None, name=None, parent_rule_id=None,
             case_sensitive=False, include_hierarchy=True):
@@ -250,13 +397,22 @@ class MatchFolder(MatchTextBase):
     def set_include_hierarchy(self, bool_flag):
         self.include_hierarchy = bool_flag
 
-    def test_match_email(self, email_to_validate):
-        LogMaster.ultra_debug('Now matching a value to IMAP Folder Name. Email UID: %s.', email_to_validate.uid_str)
+    def get_predicate_key(self):
+        return super().get_predicate_key() + (self.include_hierarchy,)
+
+    def get_multi_pattern_key(self):
+        return super().get_multi_pattern_key() + (self.include_hierarchy,)
+
+    def get_text_to_match(self, email_to_validate):
         # Generate folder-test name, based on whether the rule wants to include the full folder hierarchy names or not
         str_to_test = email_to_validate.imap_folder
-
         if (not self.include_hierarchy) and (str_to_test.find('/') >= 0):
             str_to_test = email_to_validate.imap_folder.split('/')[-1]
+        return str_to_test
+
+    def test_match_email(self, email_to_validate):
+        LogMaster.ultra_debug('Now matching a value to IMAP Folder Name. Email UID: %s.', email_to_validate.uid_str)
+        str_to_test = self.get_text_to_match(email_to_validate)
 
         LogMaster.ultra_debug('Email IMAP Folder value is: \"%s\", and final match-check-value will be: \"%s\"',
             email_to_validate.imap_folder, str_to_test)
@@ -324,6 +480,13 @@ class MatchDate(Match):
                 matched_yn = True
         return matched_yn
 
+    def is_metadata_only(self):
+        return (isinstance(self.field_to_match, str) and (self.field_to_match.lower() == 'internaldate'))
+
+    def get_cost_class(self):
+        # INTERNALDATE comes with the IMAP metadata, like the size
+        return cost_class_size if self.is_metadata_only() else self.cost_class
+
     def test_match_email(self, email_to_validate):
         LogMaster.ultra_debug('Now matching a date value to an email field. Email UID: %s, field name \"%s\".', email_to_validate.uid_str, self.field_to_match)
         matched_yn = False
@@ -333,6 +496,12 @@ class MatchDate(Match):
                 datetime_to_check = email_to_validate.date_datetime
             except AttributeError:
                 pass
+        elif self.field_to_match.lower() == 'internaldate':
+            # The date the server received the email, rather than the date in its headers
+            try:
+                datetime_to_check = email_to_validate.internaldate_datetime
+            except AttributeError:
+                pass
 
         if (datetime_to_check is None):
             try:
@@ -369,6 +538,8 @@ class MatchDate(Match):
 
 
 class MatchSize(Match):
+    metadata_only = True
+    cost_class = cost_class_size
     match_types = frozenset(['greater_than', 'less_than'])
 
     def __init__(self, field_to_match='size', match_type='greater_than', value_to_match=2147483647, name=None, parent_rule_id=None):
@@ -451,6 +622,9 @@ class MatchSize(Match):
 
 
 class MatchFlag(Match):
+    metadata_only = True
+    cost_class = cost_class_flag
+
     def __init__(self, field_to_match='IMAP_Flags', match_type=None, value_to_match=None, name=None, parent_rule_id=None):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id)
 
@@ -458,7 +632,6 @@ class MatchFlag(Match):
         if (str(value_to_match)[0] != '\\'):
             value_to_match = '\\' + str(value_to_match)
         super().set_value_to_match(value_to_match)
-        self._generate_re()
 
     def test_match_value(self, imap_flags):
         matched_yn = False
@@ -501,6 +674,9 @@ class MatchFlag(Match):
 
 
 class MatchIsUnread(Match):
+    metadata_only = True
+    cost_class = cost_class_flag
+
     def __init__(self, field_to_match='IMAP_Flag_Unread', match_type='is', value_to_match='unread', name=None, parent_rule_id=None):
         super().__init__(field_to_match, match_type, value_to_match, name, parent_rule_id)
 
@@ -2,12 +2,16 @@ import re
 from collections import OrderedDict
 from modules.logging import LogMaster
 from modules.models.Counter import Counter
-from modules.models.RuleMatches import MatchOr
+from modules.models.RuleMatches import MatchOr, MatchFlag, MatchIsUnread
 import modules.models.tzinfo_UTC as tzinfo_UTC
 
 
 class Rules(list):
-    pass
+    name = 'rules'
+    rule_index = None  # Set by compile_rules, to find the rules that could match each email (see modules.rule_index)
+
+    def set_name(self, name):
+        self.name = name
 
 
 class Rule():
@@ -28,6 +32,8 @@ class Rule():
         self.matches = []
         self.match_exceptions = []
         self.continue_rule_checks_if_matched = True
+        self.periodic_full_sweep = False
+        self.checks_since_match_reorder = 0
         self._now_adding_or = False
         self._now_adding_excep_or = False
 
@@ -59,6 +65,9 @@ class Rule():
     def set_continue_rule_checks_if_matched(self, flag):
         self.continue_rule_checks_if_matched = flag
 
+    def set_periodic_full_sweep(self, flag):
+        self.periodic_full_sweep = flag
+
     # Handle or-matches in the match setion
     def start_match_or(self):
         self._temp_match_or = MatchOr()
@@ -95,6 +104,26 @@ class Rule():
     def get_continue_rule_checks_if_matched(self):
         return self.continue_rule_checks_if_matched
 
+    def get_periodic_full_sweep(self):
+        return self.periodic_full_sweep
+
+    def get_all_matches(self):
+        """Returns every Match in this rule, including exceptions and those inside 'or' clauses"""
+        all_matches = []
+        for match in (self.matches + self.match_exceptions):
+            if isinstance(match, list):
+                all_matches.extend(match)
+            else:
+                all_matches.append(match)
+        return all_matches
+
+    def depends_on_imap_flags(self):
+        """True if this rule's result can change when an email's IMAP flags change (eg read/unread)"""
+        for match in self.get_all_matches():
+            if isinstance(match, (MatchFlag, MatchIsUnread)):  # MatchIsRead is a subclass of MatchIsUnread
+                return True
+        return False
+
     # Validation
     def validate(self):
         if len(self.matches) == 0:
@@ -0,0 +1,112 @@
+import re
+from modules.logging import LogMaster
+
+# Checks many literal strings against one piece of text in a single pass, eg all "contains" matches on the Subject.
+#
+# All the literals go into one regex alternation (longest first) inside a lookahead, so a single scan finds the longest
+# literal starting at each position in the text. Any shorter literal that is a prefix of that one also starts there,
+# so every literal that appears in the text, and at which positions, is found from the one scan.
+
+literal_match_modes = frozenset(['substring', 'prefix', 'suffix', 'equals'])
+
+
+class MultiPatternMatcher():
+    """Case-insensitive matching lower()s the text and the literals, unless regex_ignorecase is set, in which case
+    the regex engine's IGNORECASE is used instead (as legacy regex matching does)"""
+    def __init__(self, case_sensitive=False, regex_ignorecase=False):
+        self.case_sensitive = case_sensitive
+        self.regex_ignorecase = regex_ignorecase and (not case_sensitive)
+        self.patterns = []  # (pattern_id, literal, mode)
+        self.combined_re = None
+        self.flags = (re.DOTALL | re.IGNORECASE) if self.regex_ignorecase else re.DOTALL
+        self.prefixes_of_literal = dict()  # folded literal -> folded literals that are prefixes of it (including itself)
+        self.ids_by_literal = dict()  # folded literal -> [(pattern_id, mode)]
+        self.always_hit = []  # Empty literals: (pattern_id, mode)
+
+    def fold(self, text):
+        return text if self.case_sensitive else text.lower()
+
+    def add_pattern(self, pattern_id, literal, mode):
+        if mode not in literal_match_modes:
+            raise ValueError('Unknown literal match mode: %s' % mode)
+        self.patterns.append((pattern_id, literal, mode))
+
+    def compile(self):
+        self.ids_by_literal = dict()
+        self.always_hit = []
+        for (pattern_id, literal, mode) in self.patterns:
+            if literal == '':
+                self.always_hit.append((pattern_id, mode))
+            else:
+                self.ids_by_literal.setdefault(self.fold(literal), []).append((pattern_id, mode))
+
+        literals = sorted(self.ids_by_literal, key=len, reverse=True)
+        self.prefixes_of_literal = dict()
+        for literal in literals:
+            self.prefixes_of_literal[literal] = [other for other in literals if literal.startswith(other)]
+
+        self.combined_re = None
+        if len(literals) > 0:
+            self.combined_re = re.compile('(?=(%s))' % '|'.join(re.escape(literal) for literal in literals), self.flags)
+        return self
+
+    def get_literals_found(self, found_text):
+        """Returns the literals that are prefixes of found_text, the longest literal matched at some position"""
+        try:
+            return self.prefixes_of_literal[self.fold(found_text)]
+        except KeyError:
+            # Case-insensitive regex matching and lower() disagree for a few unicode characters, so check each literal
+            return [literal for literal in self.prefixes_of_literal
+                if re.match(re.escape(literal), found_text, self.flags)]
+
+    def find_hits(self, text):
+        """Returns the set of pattern_ids whose literal is found in the text (according to each pattern's mode)"""
+        if not (self.case_sensitive or self.regex_ignorecase):
+            text = text.lower()
+        text_len = len(text)
+        hits = set()
+        for (pattern_id, mode) in self.always_hit:
+            if (mode != 'equals') or (text_len == 0):
+                hits.add(pattern_id)
+
+        if self.combined_re is None:
+            return hits
+        for found in self.combined_re.finditer(text):
+            position = found.start()
+            for literal in self.get_literals_found(found.group(1)):
+                is_suffix = (position + len(literal) == text_len)
+                for (pattern_id, mode) in self.ids_by_literal[literal]:
+                    if (mode == 'substring') or \
+                            ((mode == 'prefix') and (position == 0)) or \
+                            ((mode == 'suffix') and is_suffix) or \
+                            ((mode == 'equals') and (position == 0) and is_suffix):
+                        hits.add(pattern_id)
+        return hits
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+class MultiPatternMatchGroup():
+    """Matches that test the same text of an email (eg the Subject, case-insensitively) using one MultiPatternMatcher.
+
+    The first time any of these Matches is checked against an email, the text is scanned once, and the results
+    for all of them are put into the email's match_results."""
+    def __init__(self, matches, case_sensitive=False, regex_ignorecase=False):
+        self.matches = list(matches)
+        self.matcher = MultiPatternMatcher(case_sensitive, regex_ignorecase)
+        for match in self.matches:
+            self.matcher.add_pattern(match, match.get_value_to_match(), match.get_literal_match_mode())
+        self.matcher.compile()
+
+    def test_match_email(self, email_to_validate, match_results):
+        text_to_match = self.matches[0].get_text_to_match(email_to_validate)
+        if not isinstance(text_to_match, str):
+            return  # Leave it to each Match to deal with
+        hits = self.matcher.find_hits(text_to_match)
+        if LogMaster.ultra_debug_enabled:
+            LogMaster.ultra_debug('Email UID %s: %s of %s %s matches found in a single pass: %s', email_to_validate.uid_str,
+                len(hits), len(self.matches), self.matches[0].field_name, [match.id for match in hits])
+        for match in self.matches:
+            match_results[match] = (match in hits)
+            match.record_result(match_results[match])
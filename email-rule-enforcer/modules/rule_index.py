@@ -0,0 +1,122 @@
+import heapq
+from modules.logging import LogMaster
+from modules.models.RuleMatches import MatchFrom, MatchSubject, MatchHeader, MatchFolder, MatchFlag, MatchIsUnread, MatchIsRead
+
+# Finds the rules that could possibly match an email, without checking each rule in turn.
+#
+# Every Match in a rule's (top-level) matches must match, so if one of them only matches a single exact value
+# (eg match_from "is" someone@domain, match_folder "is" Archive, or a required flag), the rule can only match emails
+# with that value. Each such rule is indexed under that value, and an email only needs to be checked against the
+# rules indexed under its own values, plus the residual rules that couldn't be indexed. The rules are still checked
+# in the order they were written.
+
+# Exact text matches that can be indexed, most selective first. Body text isn't indexed, as it is costly to get.
+indexable_text_match_classes = (MatchFrom, MatchSubject, MatchHeader, MatchFolder)
+
+
+class RuleIndex():
+    def __init__(self, rules):
+        self.rules = rules
+        self.text_indexes = dict()  # multi-pattern key -> (representative Match, dict of value -> [(position, rule)])
+        self.flag_index = dict()  # flag -> [(position, rule)]
+        self.read_index = dict()  # is_read (True/False) -> [(position, rule)]
+        self.residual_rules = []  # [(position, rule)], checked against every email
+        for position, rule in enumerate(rules):
+            self.add_rule(position, rule)
+        LogMaster.debug('Rule index built: %s of %s rules are indexed (%s by exact text, %s by flag, %s by read status); '
+            'the other %s are checked against every email.', len(rules) - len(self.residual_rules), len(rules),
+            self.count_rules(index for (match, index) in self.text_indexes.values()), self.count_rules([self.flag_index]),
+            self.count_rules([self.read_index]), len(self.residual_rules))
+
+    @staticmethod
+    def count_rules(indexes):
+        return sum(len(entries) for index in indexes for entries in index.values())
+
+    def add_rule(self, position, rule):
+        entry = (position, rule)
+        discriminator = get_discriminator(rule)
+        if discriminator is None:
+            self.residual_rules.append(entry)
+        elif isinstance(discriminator, indexable_text_match_classes):
+            (representative_match, index) = self.text_indexes.setdefault(discriminator.get_multi_pattern_key(),
+                (discriminator, dict()))
+            index.setdefault(discriminator.literal_value, []).append(entry)
+        elif isinstance(discriminator, MatchFlag):
+            self.flag_index.setdefault(discriminator.value_to_match, []).append(entry)
+        else:
+            self.read_index.setdefault(isinstance(discriminator, MatchIsRead), []).append(entry)
+
+    def get_lookup_values(self, email_to_validate):
+        """The values of the email that the index looks up (only those the index uses)"""
+        lookup_values = []
+        for (representative_match, index) in self.text_indexes.values():
+            text_to_match = representative_match.get_text_to_match(email_to_validate)
+            if isinstance(text_to_match, str) and (not representative_match.case_sensitive):
+                text_to_match = text_to_match.lower()
+            lookup_values.append(text_to_match)
+        if len(self.flag_index) > 0:
+            lookup_values.append(frozenset(getattr(email_to_validate, 'imap_flags', None) or []))
+        if len(self.read_index) > 0:
+            lookup_values.append(bool(getattr(email_to_validate, 'is_read', False)))
+        return lookup_values
+
+    def get_candidate_rules(self, lookup_values, after_position=-1):
+        """Returns [(position, rule)] for the rules that could match an email with these lookup values, in rule order"""
+        candidate_lists = [self.residual_rules]
+        lookup_values = iter(lookup_values)
+        for (representative_match, index) in self.text_indexes.values():
+            text_to_match = next(lookup_values)
+            if isinstance(text_to_match, str) and (text_to_match in index):
+                candidate_lists.append(index[text_to_match])
+        if len(self.flag_index) > 0:
+            for flag in next(lookup_values):
+                if flag in self.flag_index:
+                    candidate_lists.append(self.flag_index[flag])
+        if len(self.read_index) > 0:
+            candidate_lists.append(self.read_index.get(next(lookup_values), []))
+        # Each rule is in at most one list, and each list is in rule order
+        return [entry for entry in heapq.merge(*candidate_lists) if entry[0] > after_position]
+
+    def iterate_candidate_rules(self, email_to_validate):
+        """Yields the rules that could match the email, in rule order.
+
+        If a rule's actions change the email (eg mark it as read), the remaining candidates are looked up again."""
+        lookup_values = self.get_lookup_values(email_to_validate)
+        candidates = self.get_candidate_rules(lookup_values)
+        if LogMaster.insane_debug_enabled:
+            LogMaster.insane_debug('Rule index: Email UID %s could match %s of %s rules.', getattr(email_to_validate, 'uid_str', None),
+                len(candidates), len(self.rules))
+        next_candidate = 0
+        while next_candidate < len(candidates):
+            (position, rule) = candidates[next_candidate]
+            yield rule
+            new_lookup_values = self.get_lookup_values(email_to_validate)
+            if new_lookup_values != lookup_values:
+                lookup_values = new_lookup_values
+                candidates = self.get_candidate_rules(lookup_values, after_position=position)
+                next_candidate = 0
+            else:
+                next_candidate += 1
+
+
+def get_discriminator(rule):
+    """Returns the Match that a rule is indexed under, or None if it has none that matches only one exact value"""
+    top_level_matches = [match for match in rule.get_matches() if not isinstance(match, list)]
+    for match_class in indexable_text_match_classes:
+        for match in top_level_matches:
+            if isinstance(match, match_class) and (match.get_literal_match_mode() == 'equals') and \
+                    (match.get_multi_pattern_key() is not None):
+                return match
+    for match_class in (MatchFlag, MatchIsUnread):  # MatchIsRead is a subclass of MatchIsUnread
+        for match in top_level_matches:
+            if isinstance(match, match_class):
+                return match
+    return None
+
+
+def iterate_candidate_rules(rules, email_to_validate):
+    """The rules that could match the email, in rule order: all of them, unless the rule set has been indexed"""
+    rule_index = getattr(rules, 'rule_index', None)
+    if rule_index is None:
+        return iter(rules)
+    return rule_index.iterate_candidate_rules(email_to_validate)
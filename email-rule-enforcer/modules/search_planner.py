@@ -0,0 +1,196 @@
+import re
+import datetime
+from modules.logging import LogMaster
+from modules.models.RuleMatches import MatchHeader, MatchSubject, MatchFrom, MatchDate, MatchSize
+from modules.models.RuleMatches import MatchFlag, MatchIsRead, MatchIsUnread
+import modules.models.tzinfo_UTC as tzinfo_UTC
+
+# Compiles the Matches of a rule set into a single IMAP SEARCH query.
+# The query is always a superset of the emails the rules can match: any Match that can't be expressed
+# exactly (or more loosely) in IMAP SEARCH terms is treated as "could match anything".
+# Emails returned by the query are still fully checked client-side, so this only ever reduces fetches.
+
+max_criteria_length = 8000  # Keep well under common server command-line limits
+date_margin = datetime.timedelta(days=2)  # SENT* keys ignore time and timezone, so allow a margin either side
+imap_month_names = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+imap_system_flags = {
+    '\\Seen': 'SEEN',
+    '\\Answered': 'ANSWERED',
+    '\\Flagged': 'FLAGGED',
+    '\\Deleted': 'DELETED',
+    '\\Draft': 'DRAFT',
+    '\\Recent': 'RECENT'
+}
+header_name_re = re.compile(r'^[!-9;-~]+$')
+# An IMAP atom: printable ASCII, less the atom-specials
+flag_keyword_re = re.compile('^[%s]+$' % ''.join(re.escape(chr(char)) for char in range(0x21, 0x7f) if chr(char) not in '(){%*"\\]'))
+
+
+def quote_search_string(text):
+    """Returns an IMAP quoted-string, or None if the text can't be safely sent without a CHARSET"""
+    if (not isinstance(text, str)) or (text == ''):
+        return None
+    if any((ord(char) > 126) or (ord(char) < 32) for char in text):
+        return None
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def format_search_date(date_to_format):
+    return '%02d-%s-%04d' % (date_to_format.day, imap_month_names[date_to_format.month - 1], date_to_format.year)
+
+
+def join_and(criteria_list):
+    if len(criteria_list) == 1:
+        return criteria_list[0]
+    return '(' + ' '.join(criteria_list) + ')'
+
+
+def join_or(criteria_list):
+    joined = criteria_list[-1]
+    for criteria in reversed(criteria_list[:-1]):
+        joined = 'OR %s %s' % (criteria, joined)
+    return joined
+
+
+def compile_text_match(match, search_key):
+    """We can only push down text matches that are plain strings, not regexes"""
+    if (match.match_type == 'regex') or (match.get_literal_match_mode() is None):
+        return None
+    value = match.get_value_to_match()
+    quoted_value = quote_search_string(value)
+    if quoted_value is None:
+        return None
+    # IMAP SEARCH is a case-insensitive substring match, which is looser than every non-regex match type
+    return '%s %s' % (search_key, quoted_value)
+
+
+def compile_date_match(match):
+    if (match.get_field_to_match() is None) or (match.get_field_to_match().lower() not in ('date', 'internaldate')):
+        return None
+    internaldate = (match.get_field_to_match().lower() == 'internaldate')
+    try:
+        if isinstance(match.value_to_match, datetime.timedelta):
+            date_to_match = datetime.datetime.now(tzinfo_UTC.utc) - match.value_to_match
+        else:
+            date_to_match = match.value_to_match.replace(tzinfo=tzinfo_UTC.utc)
+        if internaldate:
+            # BEFORE/SINCE use the INTERNALDATE (which every email has), but also ignore time and timezone
+            if match.match_type == 'older_than':
+                return 'BEFORE %s' % format_search_date(date_to_match + date_margin)
+            elif match.match_type == 'newer_than':
+                return 'SINCE %s' % format_search_date(date_to_match - date_margin)
+        elif match.match_type == 'older_than':
+            return 'SENTBEFORE %s' % format_search_date(date_to_match + date_margin)
+        elif match.match_type == 'newer_than':
+            # Emails with no Date header are treated as 'newest' client-side, so always include them
+            return 'OR SENTSINCE %s NOT HEADER DATE ""' % format_search_date(date_to_match - date_margin)
+    except (OverflowError, AttributeError, TypeError):
+        pass
+    return None
+
+
+def compile_size_match(match):
+    try:
+        size_to_match = int(match.value_to_match)
+    except (ValueError, TypeError):
+        return None
+    if match.match_type == 'greater_than':
+        if size_to_match <= 0:
+            return None
+        return 'LARGER %s' % (size_to_match - 1)  # Client-side check is inclusive, LARGER is not
+    elif match.match_type == 'less_than':
+        return 'SMALLER %s' % size_to_match
+    return None
+
+
+def compile_match(match):
+    """Returns an IMAP SEARCH key for a single Match, or None if it can't be expressed"""
+    if isinstance(match, list):
+        return compile_match_or(match)
+    elif isinstance(match, MatchFrom):
+        # MatchFrom tests the parsed From address, whatever field_to_match says
+        return compile_text_match(match, 'FROM')
+    elif isinstance(match, MatchSubject):
+        return compile_text_match(match, 'SUBJECT')
+    elif isinstance(match, MatchHeader):
+        header_name = match.get_field_to_match()
+        if (not isinstance(header_name, str)) or (not header_name_re.match(header_name)):
+            return None
+        return compile_text_match(match, 'HEADER %s' % header_name.upper())
+    elif isinstance(match, MatchDate):
+        return compile_date_match(match)
+    elif isinstance(match, MatchSize):
+        return compile_size_match(match)
+    elif isinstance(match, MatchIsRead):
+        return 'SEEN'
+    elif isinstance(match, MatchIsUnread):
+        return 'UNSEEN'
+    elif isinstance(match, MatchFlag):
+        return compile_flag_match(match)
+    return None
+
+
+def compile_flag_match(match):
+    flag = match.get_value_to_match()
+    if flag in imap_system_flags:
+        return imap_system_flags[flag]
+    # MatchFlag puts a backslash before every flag, but servers only report system flags with one: others are keywords
+    if isinstance(flag, str) and flag.startswith('\\'):
+        flag = flag[1:]
+    if (not isinstance(flag, str)) or (not flag_keyword_re.match(flag)):
+        return None
+    return 'KEYWORD %s' % flag
+
+
+def compile_match_or(match_or):
+    """An 'or' clause can only be pushed down if every one of its Matches can"""
+    if len(match_or) == 0:
+        return None
+    criteria_list = []
+    for match in match_or:
+        criteria = compile_match(match)
+        if criteria is None:
+            return None
+        criteria_list.append(criteria)
+    return join_or(criteria_list)
+
+
+def compile_match_list(matches):
+    """All matches in the list are required, so any that can't be pushed down are simply left out"""
+    criteria_list = []
+    for match in matches:
+        criteria = compile_match(match)
+        if criteria is not None:
+            criteria_list.append(criteria)
+    if len(criteria_list) == 0:
+        return None
+    return join_and(criteria_list)
+
+
+def compile_search_criteria(rules):
+    """Compiles a rule set into an IMAP SEARCH query for candidate emails.
+
+    Returns None if no useful query can be built, meaning all emails must be fetched."""
+    if rules is None:
+        return None
+
+    rule_criteria = []
+    for rule in rules:
+        if (len(rule.get_matches()) == 0) or (len(rule.get_actions()) == 0):
+            continue  # Invalid rules are never checked, so they need no candidates
+        criteria = compile_match_list(rule.get_matches())
+        if criteria is None:
+            LogMaster.debug('Rule ID %s cannot be expressed as an IMAP search, so all emails will be fetched.', rule.id)
+            return None
+        rule_criteria.append(criteria)
+
+    if len(rule_criteria) == 0:
+        return None
+
+    search_criteria = join_or(rule_criteria)
+    if len(search_criteria) > max_criteria_length:
+        LogMaster.debug('IMAP search for rule set is too long (%s chars), so all emails will be fetched.', len(search_criteria))
+        return None
+
+    LogMaster.debug('IMAP search for candidate emails compiled from rule set: %s', search_criteria)
+    return search_criteria
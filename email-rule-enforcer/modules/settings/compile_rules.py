@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from modules.logging import LogMaster
+from modules.models.RuleMatches import Match, MatchTextBase
+from modules.multi_pattern_matcher import MultiPatternMatchGroup
+from modules.match_ordering import AdaptiveMatchOrdering
+from modules.models.Rules import Rules
+from modules.rule_index import RuleIndex
+
+
+def compile_rules(*rule_sets):
+    """Makes all rules (in all rule sets) share one result for each distinct predicate.
+
+    Each Match with the same predicate as an earlier one (eg the same subject match in many rules, or in both matches
+    and exceptions) gets that one as its shared_match, whose result is kept per email (see Match.test_match_email_cached),
+    so it is only checked once per email. Each rule keeps its own Match objects, so they still name their own rule.
+    Each rule set is also indexed, so each email is only checked against the rules that could match it.
+    Returns the table of shared Matches, keyed by predicate key."""
+    shared_matches = dict()
+    num_matches = 0
+    for rules in rule_sets:
+        for rule in rules:
+            share_matches_in_list(rule.matches, shared_matches)
+            share_matches_in_list(rule.match_exceptions, shared_matches)
+            num_matches += len(rule.get_all_matches())
+
+    LogMaster.debug('Rules compiled: %s rule matches & exceptions share %s distinct predicates.', num_matches, len(shared_matches))
+    group_text_matches(shared_matches.values())
+    AdaptiveMatchOrdering.order_rules(*rule_sets)
+    for rules in rule_sets:
+        if isinstance(rules, Rules):
+            rules.rule_index = RuleIndex(rules)
+    return shared_matches
+
+
+def share_matches_in_list(matches, shared_matches):
+    for match in matches:
+        if isinstance(match, list):  # Then we know this is an 'OR' clause
+            share_matches_in_list(match, shared_matches)
+        elif isinstance(match, Match):
+            match.shared_match = get_shared_match(match, shared_matches)
+
+
+def get_shared_match(match, shared_matches):
+    predicate_key = match.get_predicate_key()
+    try:
+        return shared_matches.setdefault(predicate_key, match)
+    except TypeError:
+        return match  # An unhashable value can't be looked up, so this Match just isn't shared
+
+
+def group_text_matches(matches):
+    """Groups the text Matches that can be done as plain strings by the text they test (eg all case-insensitive
+    Subject matches), so that each group checks all its strings in one pass over the text"""
+    groups = OrderedDict()
+    for match in matches:
+        match.multi_pattern_group = None
+        if (not isinstance(match, MatchTextBase)) or (match.get_literal_match_mode() is None):
+            continue
+        multi_pattern_key = match.get_multi_pattern_key()
+        if multi_pattern_key is not None:
+            groups.setdefault(multi_pattern_key, []).append(match)
+
+    for multi_pattern_key, group_matches in groups.items():
+        if len(group_matches) < 2:
+            continue  # Nothing to be gained
+        multi_pattern_group = MultiPatternMatchGroup(group_matches, case_sensitive=group_matches[0].case_sensitive,
+            regex_ignorecase=MatchTextBase.legacy_regex_matching)
+        for match in group_matches:
+            match.multi_pattern_group = multi_pattern_group
+        LogMaster.debug('%s %s matches (field \"%s\", case sensitive: %s) will be checked in a single pass.',
+            len(group_matches), group_matches[0].field_name, group_matches[0].field_to_match, group_matches[0].case_sensitive)
@@ -6,10 +6,15 @@ def create_default_rule_counters():
     ret_counters = GlobalCounters()
     ret_counters.new_counter('folders_processed')
     ret_counters.new_counter('emails_seen')
+    ret_counters.new_counter('emails_metadata_checked')
+    ret_counters.new_counter('emails_metadata_excluded')
     ret_counters.new_counter('emails_matched')
     ret_counters.new_counter('rules_in_set')
     ret_counters.new_counter('rules_checked')
+    ret_counters.new_counter('rule_checks_skipped')
     ret_counters.new_counter('actions_taken')
+    ret_counters.new_counter('forwards_sent')
+    ret_counters.new_counter('forwards_failed')
     return ret_counters
 
 
@@ -19,6 +19,16 @@ def set_defaults(config):
     config['imap_folders_to_exclude'] = set()
     config['imap_headers_only_for_all_folders'] = True
     config['imap_headers_only_for_main_folder'] = False
+    config['imap_fetch_batch_size'] = 1
+    config['imap_search_pushdown'] = False
+    config['imap_allfolders_connections'] = 1
+    config['imap_header_cache_file'] = None
+    config['imap_header_cache_max_mb'] = 100
+    config['imap_fetch_needed_headers_only'] = True
+    config['imap_metadata_prefilter'] = True
+    config['imap_batch_actions'] = True
+    config['imap_header_fields_for_main_folder'] = None
+    config['imap_header_fields_for_all_folders'] = None
 
     # SMTP Defaults
     config['smtp_server_name'] = None
@@ -29,6 +39,10 @@ def set_defaults(config):
     config['smtp_auth_required'] = False
     config['smtp_forward_from'] = None
     config['smtp_smtplib_debug'] = False
+    config['smtp_connection_pool_size'] = 2
+    config['smtp_outbound_queue_senders'] = 0  # Forwards are sent straight away unless the queue is configured
+    config['smtp_outbound_queue_max_emails'] = 100
+    config['smtp_outbound_spool_folder'] = None
 
     # Logging Defaults
     config['console_loglevel'] = 2
@@ -36,6 +50,18 @@ def set_defaults(config):
     config['console_insane_debug'] = False
     config['log_settings_logfile'] = None
     config['log_settings_logfile_debug'] = None
+    config['log_in_background'] = False
+    config['log_background_max_queued_records'] = 10000
+
+    # Incremental Run Defaults
+    config['incremental_checkpoint_file'] = None
+    config['incremental_full_sweep_interval_days'] = 7
+
+    # Daemon Mode Defaults
+    config['daemon_mode'] = False
+    config['daemon_idle_timeout_secs'] = 1500
+    config['daemon_poll_interval_secs'] = 60
+    config['daemon_reconnect_delay_secs'] = 60
 
     # Exchange Defaults
     config['Exchange_shared_mailbox_alias'] = None
@@ -45,8 +71,15 @@ def set_defaults(config):
     config['assess_rules_againt_mainfolder'] = True
     config['assess_rules_againt_allfolders'] = True
     config['actually_perform_actions'] = True
+    config['legacy_regex_matching'] = False
+    config['forward_digest_max_bytes'] = 10485760
+    config['adaptive_match_ordering'] = True
     config['allow_body_match_for_all_folders'] = False
     config['allow_body_match_for_main_folder'] = True
+    config['imap_partial_body_for_all_folders'] = False
+    config['imap_partial_body_for_main_folder'] = False
+    config['imap_partial_body_max_bytes_for_all_folders'] = 0
+    config['imap_partial_body_max_bytes_for_main_folder'] = 0
 
     # Finalise
     config['defaults_are_set'] = True
@@ -11,7 +11,7 @@ from modules.models.RuleMatches import Match, MatchHeader, MatchDate, MatchSize,
 from modules.models.RuleMatches import MatchBody, MatchFrom, MatchTo, MatchSubject
 from modules.models.RuleActions import Action, ActionForwardEmail, ActionMarkAsRead, ActionMarkAsUnread, ActionDelete, ActionMoveToNewFolder
 from modules.settings.default_settings import set_defaults
-from modules.settings.set_dependent_config import set_dependent_config, set_headersonly_mode
+from modules.settings.set_dependent_config import set_dependent_config, set_headersonly_mode, set_header_fields_mode
 from modules.settings.supportingfunctions_xml import set_value_if_xmlnode_exists, get_value_if_xmlnode_exists, get_attributes_if_xmlnode_exists
 from modules.settings.supportingfunctions_xml import get_attribvalue_if_exists_in_xmlNode, strip_xml_whitespace, xpath_findall
 from modules.settings.supportingfunctions_xml import set_boolean_if_xmlnode_exists, set_invertedboolean_if_xmlnode_exists
@@ -72,6 +72,9 @@ def parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders):
 
         set_value_if_xmlnode_exists(config, 'console_loglevel', Node, './logging/console_level')
         config['console_loglevel'] = text_to_int(config['console_loglevel'], 2)
+        set_boolean_if_xmlnode_exists(config, 'log_in_background', Node, './logging/log_in_background')
+        set_value_if_xmlnode_exists(config, 'log_background_max_queued_records', Node, './logging/background_max_queued_records')
+        config['log_background_max_queued_records'] = text_to_int(config['log_background_max_queued_records'], 10000)
 
         set_boolean_if_xmlnode_exists(config, 'empty_trash_on_exit', Node, './/empty_trash_on_exit')
         set_boolean_if_xmlnode_exists(config, 'mark_as_read_on_move', Node, './/mark_as_read_on_move')
@@ -83,8 +86,32 @@ def parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders):
         set_boolean_if_xmlnode_exists(config, 'assess_rules_againt_mainfolder', Node, './/assess_rules_againt_mainfolder')
         set_boolean_if_xmlnode_exists(config, 'assess_rules_againt_allfolders', Node, './/assess_rules_againt_allfolders')
         set_boolean_if_xmlnode_exists(config, 'actually_perform_actions', Node, './/actually_perform_actions')
+        set_boolean_if_xmlnode_exists(config, 'legacy_regex_matching', Node, './/legacy_regex_matching')
+        set_boolean_if_xmlnode_exists(config, 'adaptive_match_ordering', Node, './/adaptive_match_ordering')
+        set_value_if_xmlnode_exists(config, 'forward_digest_max_bytes', Node, './/forward_digest_max_bytes')
+        config['forward_digest_max_bytes'] = text_to_int(config['forward_digest_max_bytes'], 10485760)
         set_boolean_if_xmlnode_exists(config, 'allow_body_match_for_all_folders', Node, './/allow_body_match_for_all_folders')
         set_boolean_if_xmlnode_exists(config, 'allow_body_match_for_main_folder', Node, './/allow_body_match_for_main_folder')
+        set_boolean_if_xmlnode_exists(config, 'imap_partial_body_for_all_folders', Node, './/partial_body_fetch_for_all_folders')
+        set_boolean_if_xmlnode_exists(config, 'imap_partial_body_for_main_folder', Node, './/partial_body_fetch_for_main_folder')
+        set_value_if_xmlnode_exists(config, 'imap_partial_body_max_bytes_for_all_folders', Node, './/partial_body_max_bytes_for_all_folders')
+        config['imap_partial_body_max_bytes_for_all_folders'] = text_to_int(config['imap_partial_body_max_bytes_for_all_folders'], 0)
+        set_value_if_xmlnode_exists(config, 'imap_partial_body_max_bytes_for_main_folder', Node, './/partial_body_max_bytes_for_main_folder')
+        config['imap_partial_body_max_bytes_for_main_folder'] = text_to_int(config['imap_partial_body_max_bytes_for_main_folder'], 0)
+
+        # Incremental Runs
+        set_value_if_xmlnode_exists(config, 'incremental_checkpoint_file', Node, './incremental_runs/checkpoint_file')
+        set_value_if_xmlnode_exists(config, 'incremental_full_sweep_interval_days', Node, './incremental_runs/full_sweep_interval_days')
+        config['incremental_full_sweep_interval_days'] = text_to_int(config['incremental_full_sweep_interval_days'], 7)
+
+        # Daemon Mode
+        set_boolean_if_xmlnode_exists(config, 'daemon_mode', Node, './daemon_mode/enabled')
+        set_value_if_xmlnode_exists(config, 'daemon_idle_timeout_secs', Node, './daemon_mode/idle_timeout_secs')
+        config['daemon_idle_timeout_secs'] = text_to_int(config['daemon_idle_timeout_secs'], 1500)
+        set_value_if_xmlnode_exists(config, 'daemon_poll_interval_secs', Node, './daemon_mode/poll_interval_secs')
+        config['daemon_poll_interval_secs'] = text_to_int(config['daemon_poll_interval_secs'], 60)
+        set_value_if_xmlnode_exists(config, 'daemon_reconnect_delay_secs', Node, './daemon_mode/reconnect_delay_secs')
+        config['daemon_reconnect_delay_secs'] = text_to_int(config['daemon_reconnect_delay_secs'], 60)
 
         parse_email_notification_settings(config, Node.find('./notification_email_on_completion'))
         parse_logfile_settings(config, 'logfile', Node.find('./logging/logfile'))
@@ -106,7 +133,19 @@ def parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders):
             set_value_if_xmlnode_exists(config, conf_prefix + 'initial_folder', Node, './initial_folder')  # IMAP only
             set_value_if_xmlnode_exists(config, conf_prefix + 'deletions_folder', Node, './deletions_folder')  # IMAP only
             set_value_if_xmlnode_exists(config, conf_prefix + 'imaplib_debuglevel', Node, './imaplib_debuglevel')  # IMAP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'fetch_batch_size', Node, './fetch_batch_size')  # IMAP only
+            set_boolean_if_xmlnode_exists(config, conf_prefix + 'search_pushdown', Node, './search_pushdown')  # IMAP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'allfolders_connections', Node, './allfolders_connections')  # IMAP only
+            set_boolean_if_xmlnode_exists(config, conf_prefix + 'fetch_needed_headers_only', Node, './fetch_needed_headers_only')  # IMAP only
+            set_boolean_if_xmlnode_exists(config, conf_prefix + 'metadata_prefilter', Node, './metadata_prefilter')  # IMAP only
+            set_boolean_if_xmlnode_exists(config, conf_prefix + 'batch_actions', Node, './batch_actions')  # IMAP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'header_cache_file', Node, './header_cache/cache_file')  # IMAP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'header_cache_max_mb', Node, './header_cache/max_size_mb')  # IMAP only
             set_boolean_if_xmlnode_exists(config, conf_prefix + 'smtplib_debug', Node, './smtplib_debug')  # SMTP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'connection_pool_size', Node, './connection_pool_size')  # SMTP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'outbound_queue_senders', Node, './outbound_queue/senders')  # SMTP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'outbound_queue_max_emails', Node, './outbound_queue/max_queued_emails')  # SMTP only
+            set_value_if_xmlnode_exists(config, conf_prefix + 'outbound_spool_folder', Node, './outbound_queue/spool_folder')  # SMTP only
 
         def parse_email_Exchange_settings(config, Node):
             set_value_if_xmlnode_exists(config, 'Exchange_shared_mailbox_alias', Node, './shared_mailbox_alias')
@@ -116,6 +155,12 @@ def parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders):
         parse_email_Exchange_settings(config, Node.find('./exchange_shared_mailbox'))
 
         config['imap_imaplib_debuglevel'] = text_to_int(config['imap_imaplib_debuglevel'])
+        config['imap_fetch_batch_size'] = text_to_int(config['imap_fetch_batch_size'], 1)
+        config['imap_allfolders_connections'] = text_to_int(config['imap_allfolders_connections'], 1)
+        config['imap_header_cache_max_mb'] = text_to_int(config['imap_header_cache_max_mb'], 100)
+        config['smtp_connection_pool_size'] = text_to_int(config['smtp_connection_pool_size'], 2)
+        config['smtp_outbound_queue_senders'] = text_to_int(config['smtp_outbound_queue_senders'], 0)
+        config['smtp_outbound_queue_max_emails'] = text_to_int(config['smtp_outbound_queue_max_emails'], 100)
         # End Parsing of ServerInfo Section
 
     def parse_rules(Node, config, rules):
@@ -328,6 +373,12 @@ def parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders):
                         action_to_add.add_email_recipient(
                             strip_xml_whitespace(address_node.text)
                         )
+                    action_to_add.set_digest(text_to_bool(get_attribvalue_if_exists_in_xmlNode(Subnode, 'digest'), False))
+                    digest_max_bytes = text_to_int(
+                        get_attribvalue_if_exists_in_xmlNode(Subnode, 'digest_max_bytes'),
+                        config['forward_digest_max_bytes']
+                    )
+                    action_to_add.set_digest_max_bytes(max(digest_max_bytes, 1))
                     rule.add_action(action_to_add)
 
             def parse_rule_matches(Node, rule, maxdepth=2):
@@ -391,6 +442,14 @@ def parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders):
             for subnode in xpath_findall(Node, './rule_match_exceptions'):
                 parse_rule_match_exceptions(subnode, new_rule)
 
+            continue_rule_checks = text_to_bool(get_value_if_xmlnode_exists(Node, './continue_rule_checks_if_matched'), None)
+            if continue_rule_checks is not None:
+                new_rule.set_continue_rule_checks_if_matched(continue_rule_checks)
+
+            periodic_full_sweep = text_to_bool(get_value_if_xmlnode_exists(Node, './periodic_full_sweep'), None)
+            if periodic_full_sweep is not None:
+                new_rule.set_periodic_full_sweep(periodic_full_sweep)
+
             return new_rule
 
         def parse_folder_exceptions(Node, config):
@@ -434,7 +493,9 @@ def parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders):
 def get_settings_from_configtree(xml_config_tree):
     config = Config()
     rules_main = Rules()
+    rules_main.set_name('mainfolder')
     rules_allfolders = Rules()
+    rules_allfolders.set_name('allfolders')
     set_defaults(config)
     parse_config_tree(xml_config_tree, config, rules_main, rules_allfolders)
     set_dependent_config(config)
@@ -442,5 +503,9 @@ def get_settings_from_configtree(xml_config_tree):
         'allow_body_match_for_main_folder', 'imap_headers_only_for_main_folder')
     set_headersonly_mode(config, rules_allfolders,
         'allow_body_match_for_all_folders', 'imap_headers_only_for_all_folders')
+    set_header_fields_mode(config, rules_main,
+        'imap_fetch_needed_headers_only', 'imap_header_fields_for_main_folder')
+    set_header_fields_mode(config, rules_allfolders,
+        'imap_fetch_needed_headers_only', 'imap_header_fields_for_all_folders')
     return (config, rules_main, rules_allfolders)
 
@@ -1,5 +1,9 @@
-from modules.models.RuleMatches import MatchBody
+import re
+from modules.models.RuleMatches import MatchBody, MatchHeader, MatchSubject, MatchDate, MatchFrom, MatchTo
+from modules.models.RuleMatches import MatchFolder, MatchSize, MatchFlag, MatchIsUnread
 import modules.models.RuleActions as RuleActions
+import modules.models.RuleMatches as RuleMatches
+from modules.match_ordering import AdaptiveMatchOrdering
 
 
 def set_dependent_config(config):
@@ -33,6 +37,46 @@ def set_dependent_config(config):
         except:
             config['imap_imaplib_debuglevel'] = 0
 
+    if (not isinstance(config['imap_fetch_batch_size'], int)) or (config['imap_fetch_batch_size'] < 1):
+        config['imap_fetch_batch_size'] = 1
+
+    if (not isinstance(config['imap_allfolders_connections'], int)) or (config['imap_allfolders_connections'] < 1):
+        config['imap_allfolders_connections'] = 1
+
+    if (not isinstance(config['smtp_connection_pool_size'], int)) or (config['smtp_connection_pool_size'] < 1):
+        config['smtp_connection_pool_size'] = 1
+
+    if (not isinstance(config['forward_digest_max_bytes'], int)) or (config['forward_digest_max_bytes'] < 1):
+        config['forward_digest_max_bytes'] = 10485760
+
+    if (not isinstance(config['smtp_outbound_queue_senders'], int)) or (config['smtp_outbound_queue_senders'] < 0):
+        config['smtp_outbound_queue_senders'] = 0
+
+    if (not isinstance(config['smtp_outbound_queue_max_emails'], int)) or (config['smtp_outbound_queue_max_emails'] < 1):
+        config['smtp_outbound_queue_max_emails'] = 100
+
+    if (not isinstance(config['imap_header_cache_max_mb'], int)) or (config['imap_header_cache_max_mb'] < 1):
+        config['imap_header_cache_max_mb'] = 100
+
+    if (not isinstance(config['log_background_max_queued_records'], int)) or (config['log_background_max_queued_records'] < 1):
+        config['log_background_max_queued_records'] = 10000
+
+    for folder_type in ('main_folder', 'all_folders'):
+        conf_setting = 'imap_partial_body_max_bytes_for_%s' % folder_type
+        if (not isinstance(config[conf_setting], int)) or (config[conf_setting] < 0):
+            config[conf_setting] = 0
+
+    # RFC 2177: clients should re-issue IDLE at least every 29 minutes to avoid being logged off
+    if (not isinstance(config['daemon_idle_timeout_secs'], int)) or (config['daemon_idle_timeout_secs'] < 1) or \
+            (config['daemon_idle_timeout_secs'] > 1740):
+        config['daemon_idle_timeout_secs'] = 1500
+
+    if (not isinstance(config['daemon_poll_interval_secs'], int)) or (config['daemon_poll_interval_secs'] < 1):
+        config['daemon_poll_interval_secs'] = 60
+
+    if (not isinstance(config['daemon_reconnect_delay_secs'], int)) or (config['daemon_reconnect_delay_secs'] < 1):
+        config['daemon_reconnect_delay_secs'] = 60
+
     if config['Exchange_shared_mailbox_alias'] is not None:
         config['imap_username'] = config['imap_username'] + '\\' + config['Exchange_shared_mailbox_alias']
 
@@ -40,6 +84,8 @@ def set_dependent_config(config):
         config['send_notification_email_on_completion'] = False
 
     RuleActions.Action.set_actually_perform_actions(config['actually_perform_actions'])
+    RuleMatches.MatchTextBase.set_legacy_regex_matching(config['legacy_regex_matching'])
+    AdaptiveMatchOrdering.set_enabled(config['adaptive_match_ordering'])
 
 
 def set_headersonly_mode(config, rules, conf_check, conf_setting):
@@ -64,3 +110,54 @@ def set_headersonly_mode(config, rules, conf_check, conf_setting):
                 break
         if turn_bodymatch_on:
             config[conf_setting] = False
+
+
+# Header fields always fetched in header-fields mode: these are parsed for every email (and used in logs & forwards)
+base_header_fields = ('From', 'To', 'Cc', 'Subject', 'Date', 'Message-ID')
+header_field_name_re = re.compile(r'^[!-9;-~]+$')
+
+
+def set_header_fields_mode(config, rules, conf_check, conf_setting):
+    """Sets the list of header fields needed by a rule set, so that only those headers are fetched.
+
+    The setting is left as None (fetch all headers) if any rule needs headers that can't be listed in advance."""
+    def get_header_fields_for_match(match):
+        """Returns the header field names a Match tests, or None if it could need any header"""
+        if isinstance(match, (MatchFolder, MatchSize, MatchFlag, MatchIsUnread)):
+            return []  # These test IMAP metadata, not headers
+        elif isinstance(match, MatchDate) and match.is_metadata_only():
+            return []  # INTERNALDATE comes from the FETCH INTERNALDATE item, not a header
+        elif isinstance(match, MatchFrom):
+            return ['From']
+        elif isinstance(match, MatchTo):
+            return ['To']
+        elif isinstance(match, (MatchHeader, MatchSubject, MatchDate)):
+            field_name = match.get_field_to_match()
+            if isinstance(field_name, str) and header_field_name_re.match(field_name):
+                return [field_name]
+        return None
+
+    def add_header_fields_for_matches(match_list, header_fields):
+        for match in match_list:
+            if isinstance(match, list):  # Then we know this is an 'OR' clause
+                if not add_header_fields_for_matches(match, header_fields):
+                    return False
+                continue
+            match_header_fields = get_header_fields_for_match(match)
+            if match_header_fields is None:
+                return False
+            for field_name in match_header_fields:
+                if field_name.lower() not in [known_field.lower() for known_field in header_fields]:
+                    header_fields.append(field_name)
+        return True
+
+    config[conf_setting] = None
+    if not config[conf_check]:
+        return
+
+    header_fields = list(base_header_fields)
+    for rule in rules:
+        if not (add_header_fields_for_matches(rule.matches, header_fields) and
+                add_header_fields_for_matches(rule.match_exceptions, header_fields)):
+            return
+    config[conf_setting] = tuple(header_fields)
@@ -6,6 +6,7 @@ def get_completion_footer(config, global_timers, mainfolder_counters, allfolders
 **
 ** IMAP Server:    {0}
 ** IMAP Mailbox:   {1}
+** IMAP Fetch Batch Size:  {5}
 **
 ** Start Time:                {2}
 ** Completion Time:           {3}
@@ -17,7 +18,8 @@ def get_completion_footer(config, global_timers, mainfolder_counters, allfolders
         config['imap_username'],
         global_timers.get_start_datetime('overall'),
         global_timers.get_stop_datetime('overall'),
-        global_timers.get_elapsed_seconds('overall')
+        global_timers.get_elapsed_seconds('overall'),
+        config['imap_fetch_batch_size']
     )
 
     ret_str += '''
@@ -29,10 +31,14 @@ def get_completion_footer(config, global_timers, mainfolder_counters, allfolders
 **
 ** Total Rules in Set:   {3}
 ** Total Folders Processed: {4}
+** Emails Metadata-Checked: {9}
+** Emails Metadata-Excluded: {10}
 ** Total Emails Checked:    {5}
 ** Total Emails Matched:    {6}
 ** Total Rules Checked:     {7}
+** Rule Checks Skipped:     {11}
 ** Total Actions Taken:     {8}
+** Forwards Sent / Failed:  {12} / {13}
 **
 *********************************************************************
 **'''.format(
@@ -44,7 +50,12 @@ def get_completion_footer(config, global_timers, mainfolder_counters, allfolders
         mainfolder_counters.get('emails_seen'),
         mainfolder_counters.get('emails_matched'),
         mainfolder_counters.get('rules_checked'),
-        mainfolder_counters.get('actions_taken')
+        mainfolder_counters.get('actions_taken'),
+        mainfolder_counters.get('emails_metadata_checked'),
+        mainfolder_counters.get('emails_metadata_excluded'),
+        mainfolder_counters.get('rule_checks_skipped'),
+        mainfolder_counters.get('forwards_sent'),
+        mainfolder_counters.get('forwards_failed')
     )
 
     ret_str += '''
@@ -56,10 +67,14 @@ def get_completion_footer(config, global_timers, mainfolder_counters, allfolders
 **
 ** Total Rules in Set:      {3}
 ** Total Folders Processed: {4}
+** Emails Metadata-Checked: {9}
+** Emails Metadata-Excluded: {10}
 ** Total Emails Checked:    {5}
 ** Total Emails Matched:    {6}
 ** Total Rules Checked:     {7}
+** Rule Checks Skipped:     {11}
 ** Total Actions Taken:     {8}
+** Forwards Sent / Failed:  {12} / {13}
 **
 *********************************************************************
 **'''.format(
@@ -71,7 +86,12 @@ def get_completion_footer(config, global_timers, mainfolder_counters, allfolders
         allfolders_counters.get('emails_seen'),
         allfolders_counters.get('emails_matched'),
         allfolders_counters.get('rules_checked'),
-        allfolders_counters.get('actions_taken')
+        allfolders_counters.get('actions_taken'),
+        allfolders_counters.get('emails_metadata_checked'),
+        allfolders_counters.get('emails_metadata_excluded'),
+        allfolders_counters.get('rule_checks_skipped'),
+        allfolders_counters.get('forwards_sent'),
+        allfolders_counters.get('forwards_failed')
     )
 
     return ret_str
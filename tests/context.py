@@ -0,0 +1,26 @@
+"""Puts the email-rule-enforcer folder on sys.path, so that tests can import its modules as the program does"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'email-rule-enforcer'))
+
+
+class FakeEmail(dict):
+    """Just the parts of an email (see EmailView) that the Matches look at; headers are looked up by lower-case name"""
+    def __init__(self, uid=1, subject='', addr_from='', body='', imap_folder='INBOX', imap_flags=(), is_read=False,
+            size=0, headers=None):
+        super().__init__(headers or dict())
+        self['subject'] = subject
+        self.uid = uid
+        self.uid_str = str(uid)
+        self.addr_from = addr_from
+        self.addr_to = []
+        self.body = body
+        self.imap_folder = imap_folder
+        self.imap_flags = list(imap_flags)
+        self.is_read = is_read
+        self.size = size
+        self.match_results = None  # Each Match is checked afresh, unless a test sets this to a dict
+
+    def __missing__(self, header_name):
+        return None  # As email.message.Message does for a header the email doesn't have
@@ -0,0 +1,125 @@
+import random
+import unittest
+from context import FakeEmail
+from modules.match_ordering import AdaptiveMatchOrdering, order_rule_matches
+from modules.match_emails import check_match_list
+from modules.models.Rules import Rule
+from modules.models.RuleMatches import MatchOr, MatchSubject, MatchBody, MatchIsRead, MatchIsUnread, MatchSize, MatchFolder
+
+
+def record_pass_rate(match, pass_rate, samples=100):
+    for sample in range(samples):
+        match.record_result(sample < pass_rate * samples)
+
+
+class TestMatchOrdering(unittest.TestCase):
+    def setUp(self):
+        AdaptiveMatchOrdering.set_enabled(True)
+
+    def tearDown(self):
+        AdaptiveMatchOrdering.set_enabled(True)
+
+    def test_initial_order_is_by_cost_class(self):
+        rule = Rule('r')
+        body = MatchBody(match_type='regex', value_to_match='x.*y')
+        subject = MatchSubject(value_to_match='a')
+        folder = MatchFolder(value_to_match='INBOX')
+        size = MatchSize(match_type='greater_than', value_to_match=10)
+        is_read = MatchIsRead()
+        for match in (body, subject, folder, size, is_read):
+            rule.add_match(match)
+        AdaptiveMatchOrdering.order_rules([rule])
+        self.assertEqual(rule.matches, [is_read, size, folder, subject, body])
+
+    def test_pass_rates_reorder_and_and_or(self):
+        rule = Rule('r')
+        (often, seldom) = (MatchSubject(value_to_match='often'), MatchSubject(value_to_match='seldom'))
+        (or_often, or_seldom) = (MatchSubject(value_to_match='or often'), MatchSubject(value_to_match='or seldom'))
+        rule.add_match(often)
+        rule.add_match(seldom)
+        rule.start_match_or()
+        rule.add_match(or_seldom)
+        rule.add_match(or_often)
+        rule.stop_match_or()
+        for match in (often, or_often):
+            record_pass_rate(match, 0.9)
+        for match in (seldom, or_seldom):
+            record_pass_rate(match, 0.1)
+        old_matches = rule.matches
+        order_rule_matches(rule)
+        # An 'and' stops at the first failure, so the least likely to match goes first; an 'or' stops at the first success
+        self.assertEqual(rule.matches[:2], [seldom, often])
+        self.assertIsInstance(rule.matches[2], MatchOr)
+        self.assertEqual(list(rule.matches[2]), [or_often, or_seldom])
+        self.assertIsNot(rule.matches, old_matches)  # Replaced, not sorted in place, as other threads may be checking it
+
+    def test_reorder_if_due(self):
+        rule = Rule('r')
+        (often, seldom) = (MatchSubject(value_to_match='often'), MatchSubject(value_to_match='seldom'))
+        rule.add_match(often)
+        rule.add_match(seldom)
+        record_pass_rate(often, 0.9)
+        record_pass_rate(seldom, 0.1)
+        for check in range(AdaptiveMatchOrdering.reorder_interval - 1):
+            AdaptiveMatchOrdering.reorder_if_due(rule)
+        self.assertEqual(rule.matches, [often, seldom])
+        AdaptiveMatchOrdering.reorder_if_due(rule)
+        self.assertEqual(rule.matches, [seldom, often])
+
+    def test_disabled(self):
+        AdaptiveMatchOrdering.set_enabled(False)
+        rule = Rule('r')
+        (body, is_read) = (MatchBody(value_to_match='x'), MatchIsRead())
+        rule.add_match(body)
+        rule.add_match(is_read)
+        AdaptiveMatchOrdering.order_rules([rule])
+        for check in range(AdaptiveMatchOrdering.reorder_interval):
+            AdaptiveMatchOrdering.reorder_if_due(rule)
+        self.assertEqual(rule.matches, [body, is_read])
+
+    def test_empty_rule(self):
+        rule = Rule('r')
+        order_rule_matches(rule)
+        self.assertEqual((rule.matches, rule.match_exceptions), ([], []))
+
+    def test_order_never_changes_the_result(self):
+        rng = random.Random(1)
+        words = ('alpha', 'beta', 'gamma')
+
+        def random_match():
+            choice = rng.randrange(5)
+            if choice == 0:
+                return MatchSubject(match_type=rng.choice(('contains', 'is', 'starts_with')), value_to_match=rng.choice(words))
+            elif choice == 1:
+                return MatchBody(value_to_match=rng.choice(words))
+            elif choice == 2:
+                return rng.choice((MatchIsRead, MatchIsUnread))()
+            elif choice == 3:
+                return MatchSize(match_type=rng.choice(('greater_than', 'less_than')), value_to_match=rng.randint(0, 20))
+            return MatchFolder(value_to_match=rng.choice(('INBOX', 'Archive')))
+
+        emails = [FakeEmail(uid, subject=' '.join(rng.sample(words, rng.randint(0, 3))), body=rng.choice(words),
+            imap_folder=rng.choice(('INBOX', 'Archive')), is_read=rng.choice((True, False)), size=rng.randint(0, 20))
+            for uid in range(30)]
+        for attempt in range(100):
+            rule = Rule('r')
+            for term in range(rng.randint(0, 4)):
+                if rng.random() < 0.3:
+                    rule.start_match_or()
+                    for match_or in range(rng.randint(1, 3)):
+                        rule.add_match(random_match())
+                    rule.stop_match_or()
+                else:
+                    rule.add_match(random_match())
+                rule.add_match_exception(random_match())
+            for match in rule.get_all_matches():
+                record_pass_rate(match, rng.random())
+            results = [(check_match_list(rule.matches, email_to_validate), check_match_list(rule.match_exceptions, email_to_validate))
+                for email_to_validate in emails]
+            order_rule_matches(rule)
+            self.assertEqual(results, [(check_match_list(rule.matches, email_to_validate),
+                check_match_list(rule.match_exceptions, email_to_validate)) for email_to_validate in emails])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import random
+import re
+import unittest
+from context import FakeEmail
+from modules.multi_pattern_matcher import MultiPatternMatcher, MultiPatternMatchGroup
+from modules.models.RuleMatches import MatchTextBase, MatchSubject
+
+
+def search_one_pattern(literal, mode, text, case_sensitive):
+    """The result of checking one literal on its own with re, which the single pass must reproduce"""
+    flags = re.DOTALL if case_sensitive else (re.DOTALL | re.IGNORECASE)
+    if not case_sensitive:
+        (literal, text) = (literal.lower(), text.lower())
+    pattern = re.escape(literal)
+    if mode == 'substring':
+        return re.search(pattern, text, flags) is not None
+    elif mode == 'prefix':
+        return re.match(pattern, text, flags) is not None
+    elif mode == 'suffix':
+        return re.search(pattern + r'\Z', text, flags) is not None
+    return re.match(pattern + r'\Z', text, flags) is not None
+
+
+class TestMultiPatternMatcher(unittest.TestCase):
+    modes = ('substring', 'prefix', 'suffix', 'equals')
+
+    def assert_same_as_each_pattern(self, literals, texts, case_sensitive=False):
+        matcher = MultiPatternMatcher(case_sensitive)
+        patterns = [(literal, mode) for literal in literals for mode in self.modes]
+        for pattern in patterns:
+            matcher.add_pattern(pattern, *pattern)
+        matcher.compile()
+        for text in texts:
+            expected = set(pattern for pattern in patterns if search_one_pattern(pattern[0], pattern[1], text, case_sensitive))
+            self.assertEqual(matcher.find_hits(text), expected, 'Text: %r' % text)
+
+    def test_overlapping_literals(self):
+        self.assert_same_as_each_pattern(['ab', 'abc', 'b', 'bc', 'cab'],
+            ['', 'a', 'ab', 'abc', 'xabcx', 'cabcab', 'bcbc', 'abab', 'ABC', 'zzz'])
+
+    def test_anchors(self):
+        self.assert_same_as_each_pattern(['Re:', 'FW', 'fw: re:'],
+            ['Re: hello', 'hello Re:', 'Re:', 're: fw', 'FW: Re: x', 'x FW', 'fw: re:'])
+
+    def test_regex_special_characters_are_literal(self):
+        self.assert_same_as_each_pattern(['a.c', '^x', 'y$', '(1)', '[*]', '\\d', 'a|b'],
+            ['abc', 'a.c', '^xy$', 'x', 'y', '(1)', '1', '[*]', '*', '\\d', '5', 'a|b', 'a'])
+
+    def test_case_sensitivity(self):
+        texts = ['Hello World', 'hello world', 'HELLO', 'say hello']
+        self.assert_same_as_each_pattern(['Hello', 'world', 'HELLO'], texts, case_sensitive=True)
+        self.assert_same_as_each_pattern(['Hello', 'world', 'HELLO'], texts, case_sensitive=False)
+
+    def test_newlines(self):
+        self.assert_same_as_each_pattern(['a\nb', 'b'], ['a\nb', 'xa\nbx', 'b\n', '\nb'])
+
+    def test_empty_literal(self):
+        self.assert_same_as_each_pattern(['', 'a'], ['', 'a', 'ba'])
+
+    def test_no_patterns(self):
+        matcher = MultiPatternMatcher().compile()
+        self.assertEqual(len(matcher), 0)
+        self.assertEqual(matcher.find_hits('anything'), set())
+        self.assertEqual(matcher.find_hits(''), set())
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            MultiPatternMatcher().add_pattern(1, 'a', 'regex')
+
+    def test_random_texts(self):
+        rng = random.Random(1)
+        for case_sensitive in (True, False):
+            for attempt in range(50):
+                literals = [''.join(rng.choice('abAB') for i in range(rng.randint(1, 4))) for j in range(rng.randint(1, 6))]
+                texts = [''.join(rng.choice('abAB') for i in range(rng.randint(0, 8))) for j in range(10)]
+                self.assert_same_as_each_pattern(literals, texts, case_sensitive)
+
+
+class TestMultiPatternMatchGroup(unittest.TestCase):
+    def setUp(self):
+        MatchTextBase.set_legacy_regex_matching(False)
+
+    def tearDown(self):
+        MatchTextBase.set_legacy_regex_matching(False)
+
+    def make_matches(self, case_sensitive=False):
+        return [MatchSubject(match_type=match_type, value_to_match=value, case_sensitive=case_sensitive)
+            for match_type in ('contains', 'starts_with', 'ends_with', 'is')
+            for value in ('Invoice', 'invoice 42', '42', 'Re: Invoice 42', '[ext]', '')]
+
+    def assert_same_as_each_match(self, matches, subjects, regex_ignorecase=False):
+        group = MultiPatternMatchGroup(matches, case_sensitive=matches[0].case_sensitive, regex_ignorecase=regex_ignorecase)
+        for subject in subjects:
+            email_to_validate = FakeEmail(subject=subject)
+            match_results = dict()
+            group.test_match_email(email_to_validate, match_results)
+            for match in matches:
+                self.assertEqual(match_results[match], match.test_match_email(email_to_validate),
+                    'Subject %r, %s %r' % (subject, match.match_type, match.value_to_match))
+
+    subjects = ['Invoice 42', 'Re: Invoice 42', 'RE: INVOICE 42', 'invoice', 'Your invoice', '[EXT] Invoice 42', '42', '']
+
+    def test_same_as_each_match(self):
+        self.assert_same_as_each_match(self.make_matches(), self.subjects)
+
+    def test_same_as_each_match_case_sensitive(self):
+        self.assert_same_as_each_match(self.make_matches(case_sensitive=True), self.subjects)
+
+    def test_same_as_each_match_legacy_regex(self):
+        # Legacy regex matching anchors every match type at the start (re.match), and never treats it as 'equals'
+        MatchTextBase.set_legacy_regex_matching(True)
+        matches = [match for match in self.make_matches() if match.get_literal_match_mode() is not None]
+        self.assertNotEqual(matches, [])
+        self.assert_same_as_each_match(matches, self.subjects, regex_ignorecase=True)
+
+    def test_subject_missing(self):
+        match = MatchSubject(match_type='contains', value_to_match='x')
+        group = MultiPatternMatchGroup([match, MatchSubject(match_type='is', value_to_match='y')])
+        match_results = dict()
+        group.test_match_email(FakeEmail(subject=None), match_results)
+        self.assertEqual(match_results, dict())  # Left for each Match to check on its own
+
+
+if __name__ == '__main__':
+    unittest.main()
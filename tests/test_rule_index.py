@@ -0,0 +1,136 @@
+import random
+import unittest
+from context import FakeEmail
+from modules.rule_index import RuleIndex, get_discriminator, iterate_candidate_rules
+from modules.match_emails import check_match_list
+from modules.models.Rules import Rules, Rule
+from modules.models.RuleMatches import MatchFrom, MatchSubject, MatchHeader, MatchFolder, MatchFlag, MatchIsRead, MatchIsUnread
+from modules.models.RuleMatches import MatchTextBase
+
+
+def make_rule(*matches, match_or=None):
+    rule = Rule('rule')
+    for match in matches:
+        rule.add_match(match)
+    if match_or is not None:
+        rule.start_match_or()
+        for match in match_or:
+            rule.add_match(match)
+        rule.stop_match_or()
+    return rule
+
+
+def rule_matches(rule, email_to_validate):
+    return check_match_list(rule.get_matches(), email_to_validate)
+
+
+class TestRuleIndex(unittest.TestCase):
+    def setUp(self):
+        MatchTextBase.set_legacy_regex_matching(False)
+        self.rules = Rules([
+            make_rule(MatchFrom(value_to_match='Boss@Example.com')),
+            make_rule(MatchFrom(value_to_match='Boss@Example.com', case_sensitive=True)),
+            make_rule(MatchSubject(match_type='is', value_to_match='Weekly report')),
+            make_rule(MatchHeader(field_to_match='list-id', match_type='is', value_to_match='<dev.lists.example.com>')),
+            make_rule(MatchFolder(value_to_match='Archive', include_hierarchy=False)),
+            make_rule(MatchFolder(value_to_match='Work/Archive')),
+            make_rule(MatchFlag(value_to_match='Flagged')),
+            make_rule(MatchIsRead()),
+            make_rule(MatchIsUnread(), MatchFrom(value_to_match='boss@example.com')),
+            make_rule(MatchSubject(match_type='contains', value_to_match='report')),  # Residual: not an exact value
+            make_rule(match_or=[MatchFrom(value_to_match='boss@example.com'), MatchIsRead()]),  # Residual: only an 'or'
+            make_rule(MatchSubject(match_type='starts_with', value_to_match='Weekly'), MatchIsUnread()),
+            make_rule(MatchSubject(match_type='regex', value_to_match='^Weekly report$')),  # Residual: regex
+        ])
+        self.rule_index = RuleIndex(self.rules)
+
+    def make_emails(self):
+        emails = []
+        uid = 0
+        for addr_from in ('boss@example.com', 'Boss@Example.com', 'someone@example.com'):
+            for subject in ('Weekly report', 'weekly REPORT', 'Weekly', ''):
+                for imap_folder in ('INBOX', 'Archive', 'Work/Archive', 'Other/Archive'):
+                    for imap_flags in ([], ['\\Flagged'], ['\\Seen'], ['\\Seen', '\\Flagged']):
+                        uid += 1
+                        emails.append(FakeEmail(uid, subject=subject, addr_from=addr_from, imap_folder=imap_folder,
+                            imap_flags=imap_flags, is_read=('\\Seen' in imap_flags),
+                            headers={'list-id': '<dev.lists.example.com>' if uid % 2 else '<other>'}))
+        return emails
+
+    def test_discriminators(self):
+        self.assertEqual([get_discriminator(rule) is None for rule in self.rules],
+            [False, False, False, False, False, False, False, False, False, True, True, False, True])
+        # The exact From address is more selective than the read status
+        self.assertIsInstance(get_discriminator(self.rules[8]), MatchFrom)
+
+    def test_candidates_include_every_matching_rule_in_order(self):
+        for email_to_validate in self.make_emails():
+            candidates = list(self.rule_index.iterate_candidate_rules(email_to_validate))
+            self.assertEqual([self.rules.index(rule) for rule in candidates], sorted(self.rules.index(rule) for rule in candidates))
+            matching_rules = [rule for rule in self.rules if rule_matches(rule, email_to_validate)]
+            self.assertEqual([rule for rule in candidates if rule_matches(rule, email_to_validate)], matching_rules,
+                'Email: from %r, subject %r, folder %r, flags %r' % (email_to_validate.addr_from, email_to_validate['subject'],
+                    email_to_validate.imap_folder, email_to_validate.imap_flags))
+
+    def test_candidates_are_fewer(self):
+        email_to_validate = FakeEmail(subject='Hello', addr_from='someone@example.com', imap_folder='INBOX', is_read=True)
+        candidates = list(self.rule_index.iterate_candidate_rules(email_to_validate))
+        self.assertEqual([self.rules.index(rule) for rule in candidates], [7, 9, 10, 12])
+
+    def test_candidates_looked_up_again_when_email_changes(self):
+        # As if each matching rule's actions toggled the email's read status, as mark as read/unread actions do
+        for email_to_validate in self.make_emails():
+            expected_email = FakeEmail(subject=email_to_validate['subject'], addr_from=email_to_validate.addr_from,
+                imap_folder=email_to_validate.imap_folder, imap_flags=email_to_validate.imap_flags,
+                is_read=email_to_validate.is_read, headers={'list-id': email_to_validate['list-id']})
+            expected_rules = []
+            for rule in self.rules:
+                if rule_matches(rule, expected_email):
+                    expected_rules.append(rule)
+                    expected_email.is_read = not expected_email.is_read
+            matched_rules = []
+            for rule in self.rule_index.iterate_candidate_rules(email_to_validate):
+                if rule_matches(rule, email_to_validate):
+                    matched_rules.append(rule)
+                    email_to_validate.is_read = not email_to_validate.is_read
+            self.assertEqual(matched_rules, expected_rules)
+
+    def test_random_rules(self):
+        rng = random.Random(1)
+        values = ('a', 'A', 'b')
+
+        def random_match():
+            choice = rng.randrange(4)
+            if choice == 0:
+                return MatchFrom(match_type=rng.choice(('is', 'contains')), value_to_match=rng.choice(values),
+                    case_sensitive=rng.choice((True, False)))
+            elif choice == 1:
+                return MatchSubject(match_type=rng.choice(('is', 'starts_with')), value_to_match=rng.choice(values))
+            elif choice == 2:
+                return MatchFlag(value_to_match=rng.choice(('Flagged', 'Answered')))
+            return rng.choice((MatchIsRead, MatchIsUnread))()
+
+        emails = [FakeEmail(uid, subject=rng.choice(values), addr_from=rng.choice(values),
+            imap_flags=rng.sample(['\\Flagged', '\\Answered', '\\Seen'], rng.randint(0, 3))) for uid in range(40)]
+        for email_to_validate in emails:
+            email_to_validate.is_read = '\\Seen' in email_to_validate.imap_flags
+        for attempt in range(30):
+            rules = Rules()
+            for rule_num in range(rng.randint(0, 10)):
+                rules.append(make_rule(*[random_match() for term in range(rng.randint(1, 3))],
+                    match_or=[random_match(), random_match()] if rng.random() < 0.2 else None))
+            rules.rule_index = RuleIndex(rules)
+            for email_to_validate in emails:
+                self.assertEqual([rule for rule in iterate_candidate_rules(rules, email_to_validate)
+                    if rule_matches(rule, email_to_validate)], [rule for rule in rules if rule_matches(rule, email_to_validate)])
+
+    def test_unindexed_rule_set(self):
+        rules = Rules([make_rule(MatchIsRead()), make_rule(MatchIsUnread())])
+        self.assertEqual(list(iterate_candidate_rules(rules, FakeEmail(is_read=True))), list(rules))
+
+    def test_empty_rule_set(self):
+        self.assertEqual(list(RuleIndex(Rules()).iterate_candidate_rules(FakeEmail())), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+import datetime
+import random
+import re
+import unittest
+from context import FakeEmail
+from modules.search_planner import compile_match, compile_match_list, compile_search_criteria, quote_search_string
+from modules.match_emails import check_match_list
+from modules.models.Rules import Rules, Rule
+from modules.models.RuleActions import ActionMarkAsRead
+from modules.models.RuleMatches import MatchSubject, MatchFrom, MatchHeader, MatchBody, MatchDate, MatchSize, MatchFlag
+from modules.models.RuleMatches import MatchIsRead, MatchIsUnread, MatchFolder, MatchTextBase
+
+search_token_re = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+')
+system_flag_keys = {'SEEN': '\\Seen', 'ANSWERED': '\\Answered', 'FLAGGED': '\\Flagged', 'DELETED': '\\Deleted',
+    'DRAFT': '\\Draft', 'RECENT': '\\Recent'}
+
+
+def search_matches(search_criteria, email_to_validate):
+    """Evaluates the IMAP SEARCH keys the planner uses (except dates) against a FakeEmail, as a server would"""
+    tokens = search_token_re.findall(search_criteria)
+    position = [0]
+
+    def next_token():
+        token = tokens[position[0]]
+        position[0] += 1
+        if token.startswith('"'):
+            return re.sub(r'\\(.)', r'\1', token[1:-1])
+        return token
+
+    def contains(text, value):
+        return (text is not None) and (value.lower() in text.lower())
+
+    def search_key():
+        key = next_token()
+        if key == '(':
+            result = True
+            while tokens[position[0]] != ')':
+                result = search_key() and result
+            position[0] += 1
+            return result
+        key = key.upper()
+        if key == 'OR':
+            (first, second) = (search_key(), search_key())
+            return first or second
+        elif key == 'NOT':
+            return not search_key()
+        elif key in system_flag_keys:
+            return system_flag_keys[key] in email_to_validate.imap_flags
+        elif key == 'UNSEEN':
+            return '\\Seen' not in email_to_validate.imap_flags
+        elif key == 'KEYWORD':
+            return next_token() in email_to_validate.imap_flags
+        elif key == 'SUBJECT':
+            return contains(email_to_validate['subject'], next_token())
+        elif key == 'FROM':
+            return contains(email_to_validate.addr_from, next_token())
+        elif key == 'HEADER':
+            header_name = next_token().lower()
+            return contains(email_to_validate[header_name], next_token())
+        elif key == 'LARGER':
+            return email_to_validate.size > int(next_token())
+        elif key == 'SMALLER':
+            return email_to_validate.size < int(next_token())
+        raise ValueError('Search key not handled by this test: %s' % key)
+
+    result = search_key()
+    assert position[0] == len(tokens), 'Unparsed search keys: %s' % tokens[position[0]:]
+    return result
+
+
+def make_rules(*match_lists):
+    rules = Rules()
+    for matches in match_lists:
+        rule = Rule('rule')
+        for match in matches:
+            if isinstance(match, list):
+                rule.start_match_or()
+                for match_or in match:
+                    rule.add_match(match_or)
+                rule.stop_match_or()
+            else:
+                rule.add_match(match)
+        rule.add_action(ActionMarkAsRead())
+        rules.append(rule)
+    return rules
+
+
+class TestCompileMatch(unittest.TestCase):
+    def setUp(self):
+        MatchTextBase.set_legacy_regex_matching(False)
+
+    def test_text_matches(self):
+        self.assertEqual(compile_match(MatchSubject(match_type='contains', value_to_match='Invoice')), 'SUBJECT "Invoice"')
+        self.assertEqual(compile_match(MatchSubject(match_type='is', value_to_match='a "b" \\c')), 'SUBJECT "a \\"b\\" \\\\c"')
+        self.assertEqual(compile_match(MatchFrom(value_to_match='boss@example.com')), 'FROM "boss@example.com"')
+        self.assertEqual(compile_match(MatchHeader(field_to_match='List-Id', value_to_match='dev')), 'HEADER LIST-ID "dev"')
+
+    def test_text_matches_not_pushed_down(self):
+        self.assertIsNone(compile_match(MatchSubject(match_type='regex', value_to_match='^Invoice')))
+        self.assertIsNone(compile_match(MatchSubject(value_to_match='café')))  # Would need a CHARSET
+        self.assertIsNone(compile_match(MatchSubject(value_to_match='')))
+        self.assertIsNone(compile_match(MatchHeader(field_to_match='bad header', value_to_match='x')))
+        self.assertIsNone(compile_match(MatchBody(value_to_match='x')))
+        self.assertIsNone(compile_match(MatchFolder(value_to_match='INBOX')))
+
+    def test_legacy_regex_text_matches(self):
+        MatchTextBase.set_legacy_regex_matching(True)
+        try:
+            self.assertEqual(compile_match(MatchSubject(match_type='contains', value_to_match='Invoice')), 'SUBJECT "Invoice"')
+            self.assertIsNone(compile_match(MatchSubject(match_type='contains', value_to_match='Invoice.*42')))
+        finally:
+            MatchTextBase.set_legacy_regex_matching(False)
+
+    def test_flags(self):
+        self.assertEqual(compile_match(MatchIsRead()), 'SEEN')
+        self.assertEqual(compile_match(MatchIsUnread()), 'UNSEEN')
+        self.assertEqual(compile_match(MatchFlag(value_to_match='Flagged')), 'FLAGGED')
+        self.assertEqual(compile_match(MatchFlag(value_to_match='\\Answered')), 'ANSWERED')
+        self.assertEqual(compile_match(MatchFlag(value_to_match='$Junk')), 'KEYWORD $Junk')
+        for not_an_atom in ('two words', 'a]b', 'a*', 'a%', '(a)', 'a"b', 'x\\y', '{1}', 'café'):
+            self.assertIsNone(compile_match(MatchFlag(value_to_match=not_an_atom)), not_an_atom)
+
+    def test_sizes(self):
+        self.assertEqual(compile_match(MatchSize(match_type='greater_than', value_to_match=100)), 'LARGER 99')
+        self.assertEqual(compile_match(MatchSize(match_type='less_than', value_to_match=100)), 'SMALLER 100')
+        self.assertIsNone(compile_match(MatchSize(match_type='greater_than', value_to_match=0)))
+
+    def test_dates(self):
+        date_to_match = datetime.datetime(2020, 6, 15)
+        self.assertEqual(compile_match(MatchDate(field_to_match='internaldate', match_type='older_than', value_to_match=date_to_match)),
+            'BEFORE 17-Jun-2020')
+        self.assertEqual(compile_match(MatchDate(field_to_match='date', match_type='newer_than', value_to_match=date_to_match)),
+            'OR SENTSINCE 13-Jun-2020 NOT HEADER DATE ""')
+
+    def test_or(self):
+        (subject, body) = (MatchSubject(value_to_match='a'), MatchBody(value_to_match='b'))
+        self.assertEqual(compile_match([subject, MatchIsRead(), MatchFlag(value_to_match='$Junk')]),
+            'OR SUBJECT "a" OR SEEN KEYWORD $Junk')
+        # An 'or' can only be pushed down if all of it can: otherwise the query wouldn't include the other emails
+        self.assertIsNone(compile_match([subject, body]))
+        self.assertIsNone(compile_match([subject, MatchFlag(value_to_match='two words')]))
+        self.assertIsNone(compile_match([]))
+
+    def test_and(self):
+        (subject, body) = (MatchSubject(value_to_match='a'), MatchBody(value_to_match='b'))
+        self.assertEqual(compile_match_list([subject, body, MatchIsUnread()]), '(SUBJECT "a" UNSEEN)')
+        self.assertEqual(compile_match_list([body, subject]), 'SUBJECT "a"')
+        self.assertIsNone(compile_match_list([body]))
+        self.assertIsNone(compile_match_list([]))
+
+    def test_quote_search_string(self):
+        self.assertEqual(quote_search_string('plain'), '"plain"')
+        self.assertIsNone(quote_search_string('tab\there'))
+        self.assertIsNone(quote_search_string(None))
+
+
+class TestCompileSearchCriteria(unittest.TestCase):
+    def setUp(self):
+        MatchTextBase.set_legacy_regex_matching(False)
+
+    def test_rules_are_ored(self):
+        rules = make_rules([MatchSubject(value_to_match='a')], [MatchFrom(value_to_match='b@c'), MatchIsUnread()])
+        self.assertEqual(compile_search_criteria(rules), 'OR SUBJECT "a" (FROM "b@c" UNSEEN)')
+
+    def test_unpushable_rule_means_all_emails(self):
+        self.assertIsNone(compile_search_criteria(make_rules([MatchSubject(value_to_match='a')], [MatchBody(value_to_match='b')])))
+        self.assertIsNone(compile_search_criteria(make_rules([[MatchSubject(value_to_match='a'), MatchBody(value_to_match='b')]])))
+
+    def test_no_rules(self):
+        self.assertIsNone(compile_search_criteria(None))
+        self.assertIsNone(compile_search_criteria(Rules()))
+
+    def test_rules_without_actions_are_left_out(self):
+        rules = make_rules([MatchSubject(value_to_match='a')])
+        rule = Rule('no actions')
+        rule.add_match(MatchBody(value_to_match='b'))
+        rules.append(rule)
+        self.assertEqual(compile_search_criteria(rules), 'SUBJECT "a"')
+
+    def test_query_includes_every_email_the_rules_match(self):
+        rng = random.Random(1)
+        words = ('Invoice', 'invoice 42', 'Re:', '42', 'a"b', 'x\\y')
+
+        def random_match(allow_or=True):
+            choice = rng.randrange(8 if allow_or else 7)
+            if choice == 0:
+                return MatchSubject(match_type=rng.choice(('contains', 'is', 'starts_with', 'ends_with', 'regex')),
+                    value_to_match=rng.choice(words), case_sensitive=rng.choice((True, False)))
+            elif choice == 1:
+                return MatchFrom(match_type=rng.choice(('contains', 'is')), value_to_match=rng.choice(('boss@example.com', 'BOSS')))
+            elif choice == 2:
+                return MatchHeader(field_to_match='list-id', match_type=rng.choice(('contains', 'is')), value_to_match=rng.choice(words))
+            elif choice == 3:
+                return MatchSize(match_type=rng.choice(('greater_than', 'less_than')), value_to_match=rng.randint(0, 20))
+            elif choice == 4:
+                return MatchFlag(value_to_match=rng.choice(('Flagged', 'Answered', '$Junk', 'Junk')))
+            elif choice == 5:
+                return rng.choice((MatchIsRead, MatchIsUnread))()
+            elif choice == 6:
+                return MatchBody(value_to_match='x')
+            return [random_match(allow_or=False) for match_or in range(rng.randint(1, 3))]
+
+        emails = []
+        for uid in range(60):
+            # Only system flags start with a backslash, so a server never reports a flag like \Junk
+            imap_flags = rng.sample(['\\Seen', '\\Flagged', '\\Answered', '$Junk', 'Junk'], rng.randint(0, 3))
+            emails.append(FakeEmail(uid, subject=' '.join(rng.sample(words, rng.randint(0, 2))),
+                addr_from=rng.choice(('boss@example.com', 'Boss@Example.com', 'someone@example.com')),
+                body=rng.choice(('x', 'y')), imap_flags=imap_flags, is_read=('\\Seen' in imap_flags), size=rng.randint(0, 20),
+                headers={'list-id': rng.choice(words + (None,))}))
+
+        pushed_down = 0
+        for attempt in range(200):
+            rules = make_rules(*[[random_match() for term in range(rng.randint(1, 3))] for rule_num in range(rng.randint(1, 3))])
+            search_criteria = compile_search_criteria(rules)
+            if search_criteria is None:
+                continue
+            pushed_down += 1
+            for email_to_validate in emails:
+                if any(check_match_list(rule.get_matches(), email_to_validate) for rule in rules):
+                    self.assertTrue(search_matches(search_criteria, email_to_validate),
+                        'Email UID %s is matched by the rules but not by the search: %s' % (email_to_validate.uid, search_criteria))
+        self.assertGreater(pushed_down, 50)
+
+
+if __name__ == '__main__':
+    unittest.main()